@@ -17,6 +17,9 @@ db.createUser({
 db.createCollection('metrics');
 
 // Create indexes for better query performance
+// Note: the stats server writes to per-experiment metrics-{experiment_id}
+// collections and indexes those itself on first write (see storage.py and
+// ensure_indexes.py); these indexes only cover the shared 'metrics' collection.
 db.metrics.createIndex({ "experiment_id": 1, "timestamp": 1 });
 db.metrics.createIndex({ "event_type": 1 });
 db.metrics.createIndex({ "timestamp": 1 });
@@ -0,0 +1,24 @@
+"""
+Offline QoE analytics over exported experiment runs.
+
+    from analytics.offline import summarize_results, load_run
+
+    table = summarize_results("experiments/results")
+    events = load_run("experiments/results/exp_001_basic_dash_20240101_120000")
+"""
+
+from .loader import EVENT_COLUMNS, find_runs, load_run, load_runs
+from .qoe import QOE_WEIGHTS, compute_qoe
+from .batch import summarize_results, summarize_run, summarize_runs
+
+__all__ = [
+    "EVENT_COLUMNS",
+    "QOE_WEIGHTS",
+    "compute_qoe",
+    "find_runs",
+    "load_run",
+    "load_runs",
+    "summarize_results",
+    "summarize_run",
+    "summarize_runs",
+]
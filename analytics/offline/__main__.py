@@ -0,0 +1,57 @@
+"""
+Summarize the QoE of every run in a results directory.
+
+    python3 -m analytics.offline experiments/results
+    python3 -m analytics.offline experiments/results --output qoe.csv
+"""
+
+import argparse
+import sys
+import time
+from .batch import summarize_results
+from .qoe import QOE_WEIGHTS
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the QoE of exported runs")
+    parser.add_argument("results_dir", nargs="?", default="experiments/results",
+                        help="Results directory (default: experiments/results)")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: one per CPU)")
+    parser.add_argument("--output", help="Write the table to a .csv, .json or .parquet file")
+    for name, value in QOE_WEIGHTS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, type=float, default=value,
+                            help=f"QoE score weight (default: {value})")
+    args = parser.parse_args()
+
+    weights = {name: getattr(args, name) for name in QOE_WEIGHTS}
+    start = time.perf_counter()
+    try:
+        table = summarize_results(args.results_dir, args.workers, weights)
+    except OSError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+
+    if table.empty:
+        print(f"No exported runs in {args.results_dir}")
+        sys.exit(1)
+
+    if args.output:
+        if args.output.endswith(".json"):
+            table.reset_index().to_json(args.output, orient="records", indent=2)
+        elif args.output.endswith(".parquet"):
+            table.to_parquet(args.output)
+        else:
+            table.to_csv(args.output)
+        print(f"✓ Wrote {args.output}")
+    else:
+        print(table.drop(columns="error").to_string(float_format=lambda value: f"{value:.3f}"))
+
+    failed = int(table["error"].notna().sum())
+    print(f"{len(table)} runs summarized in {elapsed:.2f}s" + (f", {failed} failed" if failed else ""))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
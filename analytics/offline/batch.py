@@ -0,0 +1,66 @@
+"""
+Summarize every run of a results directory on a process pool.
+
+Each worker loads one run and computes its QoE metrics (see qoe.py), so
+only the small per-run metric dicts cross process boundaries. Loading and
+JSON parsing dominate, and they scale with the number of cores.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from .loader import find_runs, load_run
+from .qoe import compute_qoe
+
+
+def summarize_run(run_id, path, weights=None):
+    """
+    Load a run and compute its QoE metrics.
+
+    Returns:
+        Dict with run_id, the metrics (see qoe.compute_qoe) and error, the
+        message if the run could not be loaded
+    """
+    try:
+        metrics = compute_qoe(load_run(path), weights)
+        error = None
+    except Exception as e:
+        print(f"ERROR: Failed to summarize run {run_id}: {e}")
+        metrics, error = {}, str(e)
+    return dict({"run_id": run_id}, **metrics, error=error)
+
+
+def _summarize(task):
+    return summarize_run(*task)
+
+
+def summarize_runs(runs, workers=None, weights=None):
+    """
+    Compute the QoE metrics of several runs in parallel.
+
+    Args:
+        runs: List of (run_id, path), e.g. from loader.find_runs()
+        workers: Worker processes (default: one per CPU); 1 runs in-process
+        weights: Optional overrides of qoe.QOE_WEIGHTS
+
+    Returns:
+        DataFrame with one row per run, in the order of runs
+    """
+    tasks = [(run_id, path, weights) for run_id, path in runs]
+    workers = min(workers or os.cpu_count() or 1, len(tasks) or 1)
+    if workers == 1:
+        rows = [_summarize(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(_summarize, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    return pd.DataFrame(rows).set_index("run_id") if rows else pd.DataFrame()
+
+
+def summarize_results(results_dir, workers=None, weights=None):
+    """
+    Compute the QoE metrics of every exported run in a results directory.
+
+    Returns:
+        DataFrame with one row per run, indexed by run_id
+    """
+    return summarize_runs(find_runs(results_dir), workers, weights)
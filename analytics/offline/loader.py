@@ -0,0 +1,158 @@
+"""
+Load exported runs into columnar pandas DataFrames.
+
+A run is a directory experiments/results/<run_id>/ whose stats/ directory
+holds the metrics export written by the scenario runner, in any of the stats
+server's export formats (metrics.json, metrics.ndjson, metrics.ndjson.gz,
+metrics.ndjson.zst or metrics.parquet). Every format loads into the same
+frame: one row per event in timestamp order, with the payload fields the
+QoE metrics need as typed columns (see EVENT_COLUMNS).
+
+JSON and NDJSON are parsed by pandas' C JSON reader; Parquet exports only
+read the flattened payload columns and skip the JSON payload strings.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+# Export file extensions, in order of preference when a run has several
+EXPORT_EXTENSIONS = ["parquet", "ndjson.zst", "ndjson.gz", "ndjson", "json"]
+
+# Columns of a loaded run and their dtypes; payload fields are flattened
+EVENT_COLUMNS = {
+    "timestamp": "float64",
+    "event_type": "category",
+    "session_id": "object",
+    "media_type": "object",
+    "buffer_level": "float64",
+    "bitrate": "float64",
+    "old_quality": "float64",
+    "new_quality": "float64",
+}
+
+PAYLOAD_FIELDS = ["media_type", "buffer_level", "bitrate", "old_quality", "new_quality"]
+
+
+def find_export(run_dir):
+    """
+    Find the metrics export of a run.
+
+    Returns:
+        Path of stats/metrics.<format>, or None if the run has no export
+    """
+    for extension in EXPORT_EXTENSIONS:
+        path = os.path.join(run_dir, "stats", f"metrics.{extension}")
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def find_runs(results_dir):
+    """
+    Find the exported runs of a results directory.
+
+    Returns:
+        List of (run_id, export path) sorted by run_id; runs without an
+        export are skipped
+    """
+    runs = []
+    for run_id in sorted(os.listdir(results_dir)):
+        path = find_export(os.path.join(results_dir, run_id))
+        if path is not None:
+            runs.append((run_id, path))
+    return runs
+
+
+def _export_format(path):
+    for extension in EXPORT_EXTENSIONS:
+        if path.endswith(f".{extension}"):
+            return extension
+    raise ValueError(f"Unknown export format: {path}")
+
+
+def _read_json(path, export_format):
+    """Read a JSON or NDJSON export into a frame with a payload dict column."""
+    frame = pd.read_json(
+        path,
+        orient="records",
+        lines=export_format != "json",
+        compression={"ndjson.gz": "gzip", "ndjson.zst": "zstd"}.get(export_format),
+        dtype=False,
+        convert_dates=False,
+        keep_default_dates=False
+    )
+    if "payload" in frame:
+        payloads = [payload if isinstance(payload, dict) else {} for payload in frame["payload"]]
+        fields = pd.DataFrame.from_records(payloads, columns=PAYLOAD_FIELDS, index=frame.index)
+        frame = pd.concat([frame.drop(columns=[field for field in PAYLOAD_FIELDS if field in frame]),
+                           fields], axis=1)
+    return frame
+
+
+def _read_parquet(path):
+    """Read the columns of a Parquet export that the QoE metrics need."""
+    import pyarrow.parquet as pq
+
+    available = set(pq.read_schema(path).names)
+    columns = [column for column in EVENT_COLUMNS if column in available]
+    return pd.read_parquet(path, columns=columns)
+
+
+def load_run(path):
+    """
+    Load one exported run.
+
+    Args:
+        path: Export file (stats/metrics.<format>) or run directory
+
+    Returns:
+        DataFrame with EVENT_COLUMNS, one row per event, in timestamp order
+
+    Raises:
+        FileNotFoundError: If a run directory has no export
+        ValueError: If the export format is unknown
+    """
+    if os.path.isdir(path):
+        export = find_export(path)
+        if export is None:
+            raise FileNotFoundError(f"No metrics export in {path}/stats")
+        path = export
+
+    export_format = _export_format(path)
+    if export_format == "parquet":
+        frame = _read_parquet(path)
+    else:
+        frame = _read_json(path, export_format)
+
+    frame = frame.reindex(columns=list(EVENT_COLUMNS))
+    for column, dtype in EVENT_COLUMNS.items():
+        if dtype == "float64":
+            frame[column] = pd.to_numeric(frame[column], errors="coerce").astype("float64")
+        elif dtype == "category":
+            frame[column] = frame[column].astype("category")
+    order = np.argsort(frame["timestamp"].to_numpy(), kind="stable")
+    return frame.iloc[order].reset_index(drop=True)
+
+
+def load_runs(runs):
+    """
+    Load several runs into one frame.
+
+    Args:
+        runs: List of (run_id, path), e.g. from find_runs()
+
+    Returns:
+        DataFrame with a categorical run_id column followed by EVENT_COLUMNS
+    """
+    frames = []
+    for run_id, path in runs:
+        frame = load_run(path)
+        frame.insert(0, "run_id", run_id)
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=["run_id"] + list(EVENT_COLUMNS))
+    combined = pd.concat(frames, ignore_index=True)
+    combined["run_id"] = combined["run_id"].astype("category")
+    combined["event_type"] = combined["event_type"].astype("category")
+    return combined
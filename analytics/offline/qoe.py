@@ -0,0 +1,155 @@
+"""
+Vectorized QoE metrics of a loaded run.
+
+All metrics are computed with NumPy array operations over the columns of a
+run frame (see loader.load_run); there is no per-event Python loop. They
+follow the stats server's summary (analytics/stats_server/summary.py):
+
+- startup_delay_s: first playback_started minus first stream_initialized
+- rebuffer_count / total_stall_time_s: a stall starts at a rebuffer_event
+  (repeats while stalled are ignored) and ends at the next rebuffer_ended or
+  playback_started; a stall still open at the end counts until the last event
+- stall_ratio: total_stall_time_s / duration_s
+- avg_bitrate_bps: bitrate of quality_change_rendered events weighted by how
+  long each rendition played
+- avg_utility: time-weighted log utility ln(bitrate / reference_bitrate_bps)
+- switch_count / avg_switch_magnitude_bps: rendition changes and their mean
+  absolute bitrate step
+- qoe_score: linear QoE with log utility (as in MPC and Pensieve), per
+  second of session:
+
+      (sum utility * play time - switch_penalty * sum |utility step|
+       - rebuffer_penalty * stall time - startup_penalty * startup delay)
+      / duration_s
+"""
+
+import numpy as np
+
+# Events that end a stall (same as the stats server summary)
+STALL_END_EVENTS = ["rebuffer_ended", "playback_started"]
+
+# Defaults of the QoE score; the reference bitrate is the lowest rendition
+# of the sample DASH ladder (1/2/4 Mbps)
+QOE_WEIGHTS = {
+    "reference_bitrate_bps": 1_000_000,
+    "switch_penalty": 1.0,
+    "rebuffer_penalty": 2.66,
+    "startup_penalty": 2.66,
+}
+
+
+def _first(times, mask):
+    """Time of the first event selected by mask, or None."""
+    index = np.flatnonzero(mask)
+    return float(times[index[0]]) if index.size else None
+
+
+def stall_intervals(times, event_types, last):
+    """
+    Pair stall starts and ends.
+
+    Args:
+        times: Event timestamps in order
+        event_types: Event types
+        last: Timestamp of the last event, closing a stall still open
+
+    Returns:
+        (starts, ends) arrays of equal length
+    """
+    mask = np.isin(event_types, ["rebuffer_event"] + STALL_END_EVENTS)
+    stall_times = times[mask]
+    is_stall = event_types[mask] == "rebuffer_event"
+    was_stalled = np.concatenate(([False], is_stall[:-1]))
+    starts = stall_times[is_stall & ~was_stalled]
+    ends = stall_times[~is_stall & was_stalled]
+    if starts.size > ends.size:
+        ends = np.append(ends, last)
+    return starts, ends
+
+
+def compute_qoe(frame, weights=None):
+    """
+    Compute the QoE metrics of one run.
+
+    Args:
+        frame: Run frame (see loader.load_run)
+        weights: Optional overrides of QOE_WEIGHTS
+
+    Returns:
+        Dict of metric name -> value (None where a metric is undefined)
+    """
+    weights = dict(QOE_WEIGHTS, **(weights or {}))
+    times = frame["timestamp"].to_numpy(dtype="float64")
+    event_types = frame["event_type"].to_numpy(dtype=object)
+    if times.size == 0:
+        return {"event_count": 0}
+
+    first, last = float(times[0]), float(times[-1])
+    duration = last - first
+
+    startup_delay = None
+    initialized = _first(times, event_types == "stream_initialized")
+    started = _first(times, event_types == "playback_started")
+    if initialized is not None and started is not None:
+        startup_delay = started - initialized
+
+    starts, ends = stall_intervals(times, event_types, last)
+    stall_time = float((ends - starts).sum())
+
+    # Renditions: quality changes with a known bitrate
+    changes = (event_types == "quality_change_rendered") & ~np.isnan(frame["bitrate"].to_numpy())
+    change_times = times[changes]
+    bitrates = frame["bitrate"].to_numpy()[changes]
+    old = frame["old_quality"].to_numpy()[event_types == "quality_change_rendered"]
+    new = frame["new_quality"].to_numpy()[event_types == "quality_change_rendered"]
+    switch_count = int(np.count_nonzero(~np.isnan(old) & (old != new)))
+
+    avg_bitrate = avg_utility = switch_magnitude = None
+    utility_time = utility_steps = 0.0
+    if bitrates.size:
+        played = np.diff(np.append(change_times, last))
+        utilities = np.log(np.maximum(bitrates, 1.0) / weights["reference_bitrate_bps"])
+        span = last - change_times[0]
+        utility_time = float((utilities * played).sum())
+        if span > 0:
+            avg_bitrate = float((bitrates * played).sum() / span)
+            avg_utility = utility_time / span
+        else:
+            avg_bitrate, avg_utility = float(bitrates[-1]), float(utilities[-1])
+        steps = np.abs(np.diff(bitrates))
+        steps = steps[steps > 0]
+        if steps.size:
+            switch_magnitude = float(steps.mean())
+        utility_steps = float(np.abs(np.diff(utilities)).sum())
+
+    media_types = frame["media_type"]
+    video = (event_types == "buffer_level_updated") & (
+        media_types.isna() | (media_types == "video")
+    ).to_numpy()
+    buffer_levels = frame["buffer_level"].to_numpy()[video]
+    buffer_levels = buffer_levels[~np.isnan(buffer_levels)]
+
+    stall_ratio = qoe_score = None
+    if duration > 0:
+        stall_ratio = stall_time / duration
+        qoe_score = (
+            utility_time
+            - weights["switch_penalty"] * utility_steps
+            - weights["rebuffer_penalty"] * stall_time
+            - weights["startup_penalty"] * (startup_delay or 0.0)
+        ) / duration
+
+    return {
+        "event_count": int(times.size),
+        "duration_s": duration,
+        "startup_delay_s": startup_delay,
+        "rebuffer_count": int(starts.size),
+        "total_stall_time_s": stall_time,
+        "stall_ratio": stall_ratio,
+        "avg_bitrate_bps": avg_bitrate,
+        "avg_utility": avg_utility,
+        "switch_count": switch_count,
+        "avg_switch_magnitude_bps": switch_magnitude,
+        "buffer_level_p50_s": float(np.median(buffer_levels)) if buffer_levels.size else None,
+        "qoe_score": qoe_score,
+    }
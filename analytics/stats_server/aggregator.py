@@ -0,0 +1,399 @@
+"""
+Bounded-memory incremental QoE aggregates maintained on ingest.
+
+The Aggregator subscribes to the storage backend and folds every accepted
+event into a small per-experiment state: counters, the (rare) stall and
+quality change events, and a mergeable buffer level histogram
+(instrumentation.Histogram, ~4% relative accuracy) instead of raw samples.
+Answering "rebuffers so far", "time-weighted mean bitrate" or "buffer level
+percentiles" then needs no query over raw events.
+
+Each process accumulates the events it receives since its last checkpoint
+and, every AGGREGATE_CHECKPOINT_INTERVAL_S seconds, merges them into the one
+checkpointed state of the experiment (partial id = experiment id), with a
+version check so concurrent checkpoints of gunicorn workers never overwrite
+each other. Reads merge that state with the process's own unsaved events;
+other workers' events are included up to their last checkpoint.
+
+A stall or quality interval often starts in one process and ends in another,
+so states keep the stall and quality change events themselves and replay
+them with the state machines of summary.py. Events older than
+AGGREGATE_REORDER_WINDOW_S before the experiment's last event are folded
+into closed-interval sums (plus the open stall or current bitrate) at
+checkpoint, so a state holds only recent events; an event that arrives even
+later is replayed as if it happened at the fold.
+
+Memory stays bounded: experiments idle for AGGREGATE_IDLE_TIMEOUT_S, or the
+least recently updated ones beyond AGGREGATE_MAX_EXPERIMENTS, are
+checkpointed and dropped from memory.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from instrumentation import Histogram
+from summary import (
+    BUFFER_PERCENTILES, NO_QUALITY, NO_STALLS, STALL_END_EVENTS, advance_quality, advance_stalls
+)
+import config
+
+# Buffer level histogram buckets per doubling (~4.4% wide)
+BUFFER_HISTOGRAM_RESOLUTION = 16
+
+# Attempts to merge events into a checkpoint that other processes keep changing
+CHECKPOINT_ATTEMPTS = 10
+
+
+class ExperimentAggregate:
+    """Incremental aggregates of the events of one experiment not checkpointed yet."""
+
+    def __init__(self, experiment_id):
+        self.experiment_id = experiment_id
+        self.updated_at = time.time()
+        # State of events a failed checkpoint could not save
+        self.unsaved = None
+        # Held while a checkpoint or a read sees saved and unsaved events
+        self.checkpoint_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.event_count = 0
+        self.first = None
+        self.last = None
+        self.startup = {}
+        # [timestamp, True for rebuffer_event / False for a stall end event]
+        self.stall_events = []
+        # [timestamp, bitrate] of quality_change_rendered events
+        self.quality_events = []
+        self.switch_count = 0
+        self.buffer_levels_ms = Histogram(BUFFER_HISTOGRAM_RESOLUTION)
+        self.dirty = False
+
+    def update(self, documents):
+        """Fold a batch of event documents into the aggregates."""
+        with self._lock:
+            for document in documents:
+                t = document["timestamp"]
+                event_type = document["event_type"]
+                payload = document.get("payload") or {}
+
+                self.event_count += 1
+                self.first = t if self.first is None else min(self.first, t)
+                self.last = t if self.last is None else max(self.last, t)
+
+                if event_type in ("stream_initialized", "playback_started"):
+                    self.startup[event_type] = min(self.startup.get(event_type, t), t)
+
+                if event_type == "rebuffer_event" or event_type in STALL_END_EVENTS:
+                    self.stall_events.append([t, event_type == "rebuffer_event"])
+
+                if event_type == "quality_change_rendered":
+                    self.quality_events.append([t, payload.get("bitrate")])
+                    old = payload.get("old_quality")
+                    if old is not None and old != payload.get("new_quality"):
+                        self.switch_count += 1
+                elif event_type == "buffer_level_updated":
+                    level = payload.get("buffer_level")
+                    if level is not None and payload.get("media_type") in ("video", None):
+                        self.buffer_levels_ms.record(level * 1000)
+
+            self.updated_at = time.time()
+            self.dirty = True
+
+    def to_state(self, reset=False):
+        """
+        JSON-serializable state for checkpoints and merging.
+
+        Args:
+            reset: Start over with no events, e.g. for a checkpoint
+        """
+        with self._lock:
+            state = {
+                "event_count": self.event_count,
+                "first": self.first,
+                "last": self.last,
+                "startup": dict(self.startup),
+                "switch_count": self.switch_count,
+                "buffer_levels_ms": self.buffer_levels_ms.to_state(),
+                # Nothing folded yet
+                "horizon": None,
+                "stalls": dict(NO_STALLS),
+                "quality": dict(NO_QUALITY),
+                "stall_events": [list(event) for event in self.stall_events],
+                "quality_events": [list(event) for event in self.quality_events],
+            }
+            if reset:
+                self._reset()
+            return state
+
+    def pending_states(self):
+        """States of the events not checkpointed yet."""
+        states = [self.to_state()]
+        if self.unsaved is not None:
+            states.append(self.unsaved)
+        return states
+
+
+def _combine_folded(states):
+    """Combine the folded stall and quality states of several partials."""
+    stalls = dict(NO_STALLS)
+    quality = dict(NO_QUALITY)
+    for state in states:
+        folded = state["stalls"]
+        stalls["count"] += folded["count"]
+        stalls["total"] += folded["total"]
+        if folded["since"] is not None and (stalls["since"] is None or folded["since"] < stalls["since"]):
+            stalls["since"] = folded["since"]
+        folded = state["quality"]
+        quality["weighted"] += folded["weighted"]
+        if folded["first"] is not None and (quality["first"] is None or folded["first"] < quality["first"]):
+            quality["first"] = folded["first"]
+        if folded["t"] is not None and (quality["t"] is None or folded["t"] > quality["t"]):
+            quality["t"], quality["bitrate"] = folded["t"], folded["bitrate"]
+    return stalls, quality
+
+
+def combine_states(states, reorder_window=None):
+    """
+    Merge partial states into one partial state.
+
+    Partials cover disjoint events: counts add up, bounds take the min/max
+    and histograms merge. Stall and quality change events of all partials
+    are kept, so an interval that started in one partial is closed by an
+    event of another when they are replayed; events older than the fold
+    horizon of a partial are replayed at the horizon.
+
+    Args:
+        states: Partial states (see ExperimentAggregate.to_state), at least one
+        reorder_window: If given, fold the events older than this many
+                        seconds before the last event into the sums
+
+    Returns:
+        Partial state
+    """
+    states = [state for state in states if state["event_count"]] or states[:1]
+    horizon = max((state["horizon"] for state in states if state["horizon"] is not None), default=None)
+    stalls, quality = _combine_folded(states)
+
+    startup = {}
+    stall_events, quality_events = [], []
+    buffer_levels = Histogram(BUFFER_HISTOGRAM_RESOLUTION)
+    for state in states:
+        for event_type, t in state["startup"].items():
+            startup[event_type] = min(startup.get(event_type, t), t)
+        buffer_levels.merge(Histogram.from_state(state["buffer_levels_ms"]))
+        stall_events.extend(state["stall_events"])
+        quality_events.extend(state["quality_events"])
+    if horizon is not None:
+        stall_events = [[max(t, horizon), is_start] for t, is_start in stall_events]
+        quality_events = [[max(t, horizon), bitrate] for t, bitrate in quality_events]
+
+    counted = [state for state in states if state["event_count"]]
+    last = max((state["last"] for state in counted), default=None)
+    if reorder_window is not None and last is not None:
+        if horizon is None or horizon < last - reorder_window:
+            horizon = last - reorder_window
+        stalls = advance_stalls(stalls, [event for event in stall_events if event[0] < horizon])
+        quality = advance_quality(quality, [event for event in quality_events if event[0] < horizon])
+        stall_events = [event for event in stall_events if event[0] >= horizon]
+        quality_events = [event for event in quality_events if event[0] >= horizon]
+
+    return {
+        "event_count": sum(state["event_count"] for state in counted),
+        "first": min((state["first"] for state in counted), default=None),
+        "last": last,
+        "startup": startup,
+        "switch_count": sum(state["switch_count"] for state in counted),
+        "buffer_levels_ms": buffer_levels.to_state(),
+        "horizon": horizon,
+        "stalls": stalls,
+        "quality": quality,
+        "stall_events": stall_events,
+        "quality_events": quality_events,
+    }
+
+
+def merge_states(experiment_id, states):
+    """
+    Merge partial aggregate states into QoE numbers.
+
+    The result has the fields of summary.build_summary, plus a buffer level
+    histogram.
+
+    Returns:
+        Aggregates dict
+    """
+    if not any(state["event_count"] for state in states):
+        return {"experiment_id": experiment_id, "event_count": 0}
+
+    state = combine_states(states)
+    first, last = state["first"], state["last"]
+
+    startup_delay = None
+    if "stream_initialized" in state["startup"] and "playback_started" in state["startup"]:
+        startup_delay = state["startup"]["playback_started"] - state["startup"]["stream_initialized"]
+
+    stalls = advance_stalls(state["stalls"], state["stall_events"])
+    stall_time = stalls["total"]
+    if stalls["since"] is not None:
+        stall_time += last - stalls["since"]
+
+    quality = advance_quality(state["quality"], state["quality_events"])
+    avg_bitrate = None
+    if quality["t"] is not None:
+        weighted = quality["weighted"] + (last - quality["t"]) * (quality["bitrate"] or 0)
+        span = last - quality["first"]
+        avg_bitrate = weighted / span if span > 0 else quality["bitrate"]
+
+    buffer_levels = Histogram.from_state(state["buffer_levels_ms"])
+
+    def seconds(value_ms):
+        return value_ms / 1000.0 if value_ms is not None else None
+
+    return {
+        "experiment_id": experiment_id,
+        "event_count": state["event_count"],
+        "first_timestamp": first,
+        "last_timestamp": last,
+        "duration_s": last - first,
+        "startup_delay_s": startup_delay,
+        "rebuffer_count": stalls["count"],
+        "total_stall_time_s": stall_time,
+        "avg_bitrate_bps": avg_bitrate,
+        "switch_count": state["switch_count"],
+        "buffer_level_percentiles_s": {
+            f"p{p}": seconds(buffer_levels.percentile(p)) for p in BUFFER_PERCENTILES
+        },
+        "buffer_level_histogram_s": [
+            [seconds(upper_bound), count] for upper_bound, count in buffer_levels.buckets()
+        ],
+    }
+
+
+class Aggregator:
+    """Per-experiment incremental aggregates, fed by a storage subscription."""
+
+    def __init__(self, storage,
+                 checkpoint_interval=config.AGGREGATE_CHECKPOINT_INTERVAL_S,
+                 idle_timeout=config.AGGREGATE_IDLE_TIMEOUT_S,
+                 max_experiments=config.AGGREGATE_MAX_EXPERIMENTS,
+                 reorder_window=config.AGGREGATE_REORDER_WINDOW_S):
+        """
+        Subscribe to a storage backend and start the checkpoint thread.
+
+        Args:
+            storage: Storage backend (see storage_base.BaseMetricsStorage)
+            checkpoint_interval: Seconds between checkpoints of changed aggregates
+            idle_timeout: Seconds without events after which an experiment is evicted
+            max_experiments: Maximum experiments kept in memory
+            reorder_window: Seconds before the last event within which stall
+                            and quality change events are kept for replay
+        """
+        self.storage = storage
+        self.checkpoint_interval = checkpoint_interval
+        self.idle_timeout = idle_timeout
+        self.max_experiments = max_experiments
+        self.reorder_window = reorder_window
+
+        self._aggregates = OrderedDict()  # least recently updated first
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="aggregate-checkpoint", daemon=True
+        )
+        self._thread.start()
+
+        storage.subscribe(self.on_documents)
+        storage.on_close(self.close)
+
+    def on_documents(self, documents):
+        """Storage subscriber: update the experiment of a document batch."""
+        experiment_id = documents[0]["experiment_id"]
+        evicted = []
+        with self._lock:
+            aggregate = self._aggregates.get(experiment_id)
+            if aggregate is None:
+                aggregate = self._aggregates[experiment_id] = ExperimentAggregate(experiment_id)
+                while len(self._aggregates) > self.max_experiments:
+                    evicted.append(self._aggregates.popitem(last=False)[1])
+            else:
+                self._aggregates.move_to_end(experiment_id)
+        aggregate.update(documents)
+        if evicted:
+            self._checkpoint(evicted)
+
+    def get(self, experiment_id):
+        """
+        Current aggregates of an experiment across all processes.
+
+        Returns:
+            Aggregates dict (see merge_states); event_count is 0 if the
+            experiment is unknown
+        """
+        aggregate = self._aggregates.get(experiment_id)
+        if aggregate is None:
+            return merge_states(experiment_id, self._load(experiment_id))
+        with aggregate.checkpoint_lock:
+            return merge_states(experiment_id, self._load(experiment_id) + aggregate.pending_states())
+
+    def _load(self, experiment_id):
+        """Checkpointed state of an experiment, as a list of at most one state."""
+        return [state for partial_id, state in self.storage.load_aggregates(experiment_id)
+                if partial_id == experiment_id]
+
+    def _save(self, experiment_id, state):
+        """
+        Merge a state into the experiment's checkpoint.
+
+        The checkpoint is reloaded and merged again if another process
+        changed it in the meantime.
+
+        Raises:
+            RuntimeError: If it kept changing for CHECKPOINT_ATTEMPTS attempts
+        """
+        for _ in range(CHECKPOINT_ATTEMPTS):
+            saved = self._load(experiment_id)
+            version = saved[0]["version"] if saved else None
+            merged = combine_states(saved + [state], self.reorder_window)
+            merged["version"] = (version or 0) + 1
+            if self.storage.replace_aggregate(experiment_id, experiment_id, merged, version):
+                return
+        raise RuntimeError(f"Checkpoint of {experiment_id} kept changing")
+
+    def _checkpoint(self, aggregates):
+        """Merge the events of changed aggregates into their checkpoints."""
+        for aggregate in aggregates:
+            if not aggregate.dirty and aggregate.unsaved is None:
+                continue
+            with aggregate.checkpoint_lock:
+                state = aggregate.to_state(reset=True)
+                if aggregate.unsaved is not None:
+                    state = combine_states([aggregate.unsaved, state])
+                try:
+                    self._save(aggregate.experiment_id, state)
+                    aggregate.unsaved = None
+                except Exception as e:
+                    print(f"ERROR: Failed to checkpoint aggregates of {aggregate.experiment_id}: {e}")
+                    aggregate.unsaved = state
+
+    def checkpoint(self):
+        """Checkpoint changed aggregates and evict idle experiments."""
+        now = time.time()
+        with self._lock:
+            aggregates = list(self._aggregates.values())
+            idle = [aggregate for aggregate in aggregates
+                    if now - aggregate.updated_at > self.idle_timeout]
+            for aggregate in idle:
+                del self._aggregates[aggregate.experiment_id]
+        self._checkpoint(aggregates)
+
+    def _run(self):
+        while not self._stop.wait(self.checkpoint_interval):
+            self.checkpoint()
+
+    def close(self):
+        """Stop the checkpoint thread and write a final checkpoint."""
+        self._stop.set()
+        self._thread.join()
+        self.checkpoint()
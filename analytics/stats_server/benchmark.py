@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+Synthetic multi-session ingest benchmark for the stats server.
+
+Simulates N concurrent dash.js player sessions, each emitting the event mix
+and rates of dash_player.js (fragment loads, buffer level updates, 5 s
+periodic_metrics, quality changes and the occasional stall), and submits them
+to the stats server either in-process (create_app() through Flask's test
+client) or over HTTP to a running server. Reports throughput, request latency
+percentiles and server RSS, and can compare a run against a saved baseline.
+In-process runs report the RSS of the benchmark process, which includes the
+simulated clients.
+
+Examples:
+    # In-process, in-memory stand-in storage (measures the Flask/ingest path)
+    python3 benchmark.py --sessions 50 --duration 30 --storage memory
+
+    # In-process against MongoDB (MONGO_* environment variables) or SQLite
+    python3 benchmark.py --sessions 50 --duration 30 --storage mongo
+    python3 benchmark.py --sessions 50 --duration 30 --storage sqlite
+
+    # Against a running server, e.g. SERVER_MODE=gunicorn
+    python3 benchmark.py --url http://localhost:8000 --server-pid 1234
+
+    # Save a baseline, then compare a later run against it
+    python3 benchmark.py --output baseline.json
+    python3 benchmark.py --baseline baseline.json
+"""
+
+import argparse
+import http.client
+import json
+import random
+import resource
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+from instrumentation import Histogram
+from storage_base import BaseMetricsStorage
+import config
+
+# Event rates of a dash.js session (per simulated second of playback)
+SEGMENT_DURATION_S = 2.0          # one video and one audio fragment per segment
+BUFFER_UPDATES_PER_S = 4.0        # BUFFER_LEVEL_UPDATED, video + audio
+PERIODIC_INTERVAL_S = 5.0         # periodic_metrics timer in dash_player.js
+QUALITY_CHANGE_PROBABILITY = 0.05  # per segment
+STALL_PROBABILITY = 0.01          # per segment
+BITRATES = [400000, 800000, 1500000, 3000000, 6000000]
+
+# Client batching defaults (METRIC_BATCH_SIZE / METRIC_FLUSH_INTERVAL_MS)
+CLIENT_BATCH_SIZE = 50
+CLIENT_FLUSH_INTERVAL_S = 1.0
+
+
+class InMemoryStorage(BaseMetricsStorage):
+    """
+    In-process stand-in for a storage backend.
+
+    Builds the same documents as the real backends and keeps only a count,
+    so a run measures request handling without a database. Writes go
+    through the write-behind queue when ASYNC_WRITES is set.
+    """
+
+    backend = "memory"
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._aggregates = {}
+        super().__init__()
+
+    def ping(self):
+        pass
+
+    def store_metric(self, experiment_id, event_type, protocol, video_id, payload, timestamp,
+                     session_id=None, seq=None):
+        document = self._build_document(
+            experiment_id, event_type, protocol, video_id, payload, timestamp,
+            session_id=session_id, seq=seq
+        )
+        if not self.deduper.filter([document]):
+            return None
+        if self.write_queue:
+            self.write_queue.put(f"metrics-{experiment_id}", [document])
+        else:
+            self._write_documents(f"metrics-{experiment_id}", [document])
+        self._accepted([document])
+
+    def store_metrics(self, events):
+        documents_by_collection = self._build_documents(events)
+        if self.write_queue:
+            self.write_queue.put_many(documents_by_collection)
+        stored = 0
+        for collection_name, documents in documents_by_collection.items():
+            if not self.write_queue:
+                self._write_documents(collection_name, documents)
+            self._accepted(documents)
+            stored += len(documents)
+        return stored
+
+    def _write_documents(self, collection_name, documents):
+        with self._lock:
+            self.count += len(documents)
+        return len(documents)
+
+    def save_aggregates(self, partials):
+        for partial_id, experiment_id, state in partials:
+            self._aggregates[partial_id] = (experiment_id, state)
+
+    def load_aggregates(self, experiment_id):
+        return [
+            (partial_id, state)
+            for partial_id, (aggregate_experiment_id, state) in list(self._aggregates.items())
+            if aggregate_experiment_id == experiment_id
+        ]
+
+    def replace_aggregate(self, partial_id, experiment_id, state, version):
+        with self._lock:
+            saved = self._aggregates.get(partial_id)
+            if (saved[1]["version"] if saved else None) != version:
+                return False
+            self._aggregates[partial_id] = (experiment_id, state)
+            return True
+
+    def delete_aggregates(self, partial_ids):
+        for partial_id in partial_ids:
+            self._aggregates.pop(partial_id, None)
+
+
+def session_events(session_index, duration, rng):
+    """
+    Generate the timed events of one simulated player session.
+
+    Returns:
+        List of (offset_s, event_type, payload) sorted by offset
+    """
+    events = [
+        (0.0, "stream_initialized", {"mpd_url": "http://localhost/manifest.mpd"}),
+        (0.5, "playback_started", {"mpd_url": "http://localhost/manifest.mpd"}),
+    ]
+    quality = rng.randrange(len(BITRATES))
+    buffer_level = 0.0
+    rebuffers = 0
+
+    t = 0.0
+    while t < duration:
+        for media_type in ("video", "audio"):
+            url = f"http://localhost/{media_type}/seg-{int(t / SEGMENT_DURATION_S)}.m4s"
+            events.append((t, "fragment_loading_started",
+                           {"type": "MediaSegment", "url": url, "media_type": media_type}))
+            download_s = rng.uniform(0.05, 0.8)
+            events.append((t + download_s, "fragment_loading_completed", {
+                "type": "MediaSegment", "url": url, "quality": quality,
+                "media_type": media_type, "start_time": t, "duration": SEGMENT_DURATION_S,
+                "bytes_loaded": int(BITRATES[quality] * SEGMENT_DURATION_S / 8),
+                "download_ms": download_s * 1000
+            }))
+        if rng.random() < QUALITY_CHANGE_PROBABILITY:
+            new_quality = min(len(BITRATES) - 1, max(0, quality + rng.choice((-1, 1))))
+            events.append((t + 0.9, "quality_change_rendered", {
+                "old_quality": quality, "new_quality": new_quality,
+                "bitrate": BITRATES[new_quality]
+            }))
+            quality = new_quality
+        if rng.random() < STALL_PROBABILITY:
+            rebuffers += 1
+            stall = rng.uniform(0.5, 3.0)
+            events.append((t + 1.0, "rebuffer_event", {
+                "rebuffer_count": rebuffers, "buffer_level": 0.0,
+                "current_bitrate": BITRATES[quality]
+            }))
+            events.append((t + 1.0 + stall, "rebuffer_ended",
+                           {"stall_duration_s": stall, "buffer_level": 2.0}))
+        t += SEGMENT_DURATION_S
+
+    step = 1.0 / BUFFER_UPDATES_PER_S
+    t = 0.0
+    while t < duration:
+        buffer_level = min(30.0, max(0.0, buffer_level + rng.uniform(-0.5, 1.0)))
+        media_type = "video" if int(t / step) % 2 == 0 else "audio"
+        events.append((t, "buffer_level_updated",
+                       {"buffer_level": buffer_level, "media_type": media_type}))
+        t += step
+
+    t = PERIODIC_INTERVAL_S
+    while t < duration:
+        events.append((t, "periodic_metrics", {
+            "current_time": t, "duration": 600.0, "playback_rate": 1.0,
+            "dropped_frames": 0, "buffer_level": buffer_level,
+            "current_bitrate": BITRATES[quality]
+        }))
+        t += PERIODIC_INTERVAL_S
+
+    events.append((duration, "playback_ended", {"total_rebuffers": rebuffers}))
+    return sorted(events, key=lambda event: event[0])
+
+
+class TestClientTransport:
+    """Submits requests to an in-process Flask app."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, body):
+        response = self.client.post(path, data=body, content_type="application/json")
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class HTTPTransport:
+    """Submits requests over one persistent HTTP connection."""
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+
+    def post(self, path, body):
+        try:
+            self.connection.request("POST", path, body=body,
+                                    headers={"Content-Type": "application/json"})
+            response = self.connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return 0
+
+    def close(self):
+        self.connection.close()
+
+
+class BenchmarkRun:
+    """Shared counters and latency histogram of a benchmark run."""
+
+    def __init__(self):
+        self.latency = Histogram()   # request latency in microseconds
+        self.lag = Histogram()       # send time behind schedule in microseconds
+        self.requests = 0
+        self.events = 0
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, status, latency_us, lag_us, events):
+        self.latency.record(latency_us)
+        self.lag.record(lag_us)
+        with self._lock:
+            self.requests += 1
+            if 200 <= status < 300:
+                self.events += events
+            else:
+                self.errors[str(status)] = self.errors.get(str(status), 0) + 1
+
+
+def run_session(session_index, transport, args, run, start):
+    """Replay one session's events in real time (scaled by --speedup)."""
+    rng = random.Random(args.seed + session_index)
+    common = {
+        "experiment_id": args.experiment_id,
+        "protocol": "dash",
+        "video_id": f"http://localhost/session-{session_index}/manifest.mpd",
+        # Events are stamped like the player's, so deduplication is measured
+        "session_id": uuid.uuid4().hex
+    }
+    events = session_events(session_index, args.duration * args.speedup, rng)
+
+    def send(path, body, count, scheduled):
+        request_start = time.perf_counter()
+        status = transport.post(path, json.dumps(body))
+        finished = time.perf_counter()
+        run.record(status, (finished - request_start) * 1e6,
+                   max(0.0, request_start - scheduled) * 1e6, count)
+
+    batch, batch_due = [], None
+    for seq, (offset, event_type, payload) in enumerate(events):
+        scheduled = start + offset / args.speedup
+        # Flush a pending batch whose timer fires before this event
+        if batch and batch_due <= scheduled:
+            delay = batch_due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            send("/api/submit_batch", {"common": common, "events": batch}, len(batch), batch_due)
+            batch = []
+
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        timestamp = time.time()
+        if args.mode == "single":
+            send("/api/submit", dict(common, timestamp=timestamp, seq=seq,
+                                     event_type=event_type, payload=payload), 1, scheduled)
+            continue
+
+        if not batch:
+            batch_due = scheduled + CLIENT_FLUSH_INTERVAL_S / args.speedup
+        batch.append({"timestamp": timestamp, "seq": seq, "event_type": event_type,
+                      "payload": payload})
+        if len(batch) >= args.batch_size:
+            send("/api/submit_batch", {"common": common, "events": batch}, len(batch), scheduled)
+            batch = []
+
+    if batch:
+        send("/api/submit_batch", {"common": common, "events": batch}, len(batch), time.perf_counter())
+    transport.close()
+
+
+def read_rss(pid=None):
+    """Current and peak resident set size in bytes of a process (default: this one)."""
+    rss, peak = None, None
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        if pid is None:
+            # Linux reports ru_maxrss in KiB, macOS in bytes
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak *= 1 if sys.platform == "darwin" else 1024
+    return rss, peak
+
+
+def _ms(value):
+    return round(value / 1000.0, 3) if value is not None else None
+
+
+def run_benchmark(args):
+    """Run the benchmark and return the result dict."""
+    storage = None
+    if args.url:
+        transports = [HTTPTransport(args.url) for _ in range(args.sessions)]
+    else:
+        from server import create_app
+        if args.storage == "memory":
+            storage = InMemoryStorage()
+        elif args.storage == "sqlite":
+            from sqlite_storage import SQLiteMetricsStorage
+            storage = SQLiteMetricsStorage(args.sqlite_path)
+        else:
+            from storage import MetricsStorage
+            storage = MetricsStorage()
+        app, storage = create_app(storage=storage)
+        transports = [TestClientTransport(app) for _ in range(args.sessions)]
+
+    run = BenchmarkRun()
+    start = time.perf_counter() + 0.1
+    threads = [
+        threading.Thread(target=run_session, args=(i, transports[i], args, run, start), daemon=True)
+        for i in range(args.sessions)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if storage is not None:
+        storage.flush()
+        storage.close()
+
+    rss, peak_rss = read_rss(args.server_pid if args.url else None)
+    latency = run.latency.snapshot()
+    return {
+        "config": {
+            "sessions": args.sessions,
+            "duration_s": args.duration,
+            "speedup": args.speedup,
+            "mode": args.mode,
+            "batch_size": args.batch_size,
+            "target": args.url or f"in-process ({args.storage})",
+        },
+        "elapsed_s": round(elapsed, 3),
+        "requests": run.requests,
+        "events": run.events,
+        "errors": run.errors,
+        "requests_per_s": round(run.requests / elapsed, 1),
+        "events_per_s": round(run.events / elapsed, 1),
+        "latency_ms": {key: _ms(latency[key]) for key in ("mean", "p50", "p95", "p99", "max")},
+        "max_schedule_lag_ms": _ms(run.lag.snapshot()["max"]),
+        "server_rss_mb": round(rss / 2 ** 20, 1) if rss else None,
+        "server_peak_rss_mb": round(peak_rss / 2 ** 20, 1) if peak_rss else None,
+    }
+
+
+# Result fields compared against a baseline, and whether higher is better
+COMPARED_FIELDS = [
+    ("events_per_s", True),
+    ("requests_per_s", True),
+    ("latency_ms.p50", False),
+    ("latency_ms.p95", False),
+    ("latency_ms.p99", False),
+    ("server_peak_rss_mb", False),
+]
+
+
+def _lookup(result, field):
+    value = result
+    for key in field.split("."):
+        value = (value or {}).get(key)
+    return value
+
+
+def print_comparison(result, baseline):
+    """Print each compared field next to its baseline value."""
+    print("\n=== Comparison with baseline ===")
+    for field, higher_is_better in COMPARED_FIELDS:
+        current, previous = _lookup(result, field), _lookup(baseline, field)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous * 100
+        better = change > 0 if higher_is_better else change < 0
+        verdict = "better" if better else "worse" if change else "same"
+        print(f"  {field:<20} {previous:>10} -> {current:>10}  ({change:+.1f}%, {verdict})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stats server ingest benchmark")
+    parser.add_argument("--sessions", type=int, default=20,
+                        help="Number of concurrent player sessions (default: 20)")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="Wall-clock duration of the run in seconds (default: 30)")
+    parser.add_argument("--speedup", type=float, default=1.0,
+                        help="Playback seconds simulated per wall-clock second (default: 1)")
+    parser.add_argument("--mode", choices=["batch", "single"], default="batch",
+                        help="Submit batches like dash_player.js, or one event per request")
+    parser.add_argument("--batch-size", type=int, default=CLIENT_BATCH_SIZE,
+                        help=f"Client batch size in batch mode (default: {CLIENT_BATCH_SIZE})")
+    parser.add_argument("--storage", choices=["memory", "mongo", "sqlite"], default="memory",
+                        help="Storage for the in-process server (default: memory)")
+    parser.add_argument("--sqlite-path", default="benchmark.db",
+                        help="Database file for --storage sqlite (default: benchmark.db)")
+    parser.add_argument("--url", help="Benchmark a running server instead, e.g. http://localhost:8000")
+    parser.add_argument("--server-pid", type=int,
+                        help="PID of the server process to read RSS from (with --url)")
+    parser.add_argument("--experiment-id", default="benchmark",
+                        help="Experiment ID the events are submitted under")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the event mix")
+    parser.add_argument("--output", help="Write the result as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against a result JSON file from an earlier run")
+    args = parser.parse_args()
+
+    print(f"Running {args.sessions} sessions for {args.duration}s "
+          f"({args.mode} mode, {args.url or 'in-process ' + args.storage})...")
+    result = run_benchmark(args)
+    print(json.dumps(result, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Result written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Bucketed storage layout for high-frequency metric events.
+
+With STORAGE_LAYOUT=bucketed, events of the types in BUCKETED_EVENT_TYPES are
+not stored as one document each. They are packed into bucket documents, one
+per (event_type, protocol, video_id, time window), that live in the same
+metrics-{experiment_id} collection as the remaining per-event documents:
+
+    {
+        "_bucket": true,
+        "experiment_id": "exp_001",
+        "event_type": "buffer_level_updated",
+        "protocol": "dash",
+        "video_id": "http://...",
+        "timestamp": 1234567860.0,      # window start, indexed like events
+        "end_timestamp": 1234567920.0,  # window end
+        "count": 412,
+        "samples": [{"_id": ObjectId, "timestamp": ..., "payload": {...},
+                     "session_id": ..., "seq": ...}, ...],
+        "stored_at": datetime           # first write to the bucket
+    }
+
+A bucket holds at most BUCKET_MAX_SAMPLES samples; further samples for the
+same window go to a new bucket. unpack_stages() turns buckets back into
+per-event documents inside an aggregation pipeline, and unpack_bucket() does
+the same for a single bucket in Python, so readers see the same documents in
+either layout. The unique (session_id, seq) index does not cover bucket
+samples; instead the upsert skips samples whose _id or (session_id, seq) the
+bucket already holds. A retried write of a partially applied batch is thus
+idempotent, and a resent event is not stored twice unless its first copy
+went to a different bucket of the same window.
+
+MongoDB 4.4 (the version in docker-compose) has no native time-series
+collections, hence the explicit bucket pattern.
+"""
+
+import math
+from bson import ObjectId
+from pymongo import UpdateOne
+import config
+
+
+def is_bucketed(event_type):
+    """True if events of this type are stored in buckets."""
+    return config.STORAGE_LAYOUT == "bucketed" and event_type in config.BUCKETED_EVENT_TYPES
+
+
+def bucket_start(timestamp):
+    """Start of the bucket window containing a timestamp."""
+    return math.floor(timestamp / config.BUCKET_SPAN_S) * config.BUCKET_SPAN_S
+
+
+def _sample(document):
+    """Bucket sample holding the per-event fields of a document."""
+    sample = {
+        "_id": document.setdefault("_id", ObjectId()),
+        "timestamp": document["timestamp"],
+        "payload": document["payload"]
+    }
+    if "session_id" in document:
+        sample["session_id"] = document["session_id"]
+        sample["seq"] = document["seq"]
+    return sample
+
+
+def build_bucket_updates(documents):
+    """
+    Build upserts that append event documents to their buckets.
+
+    Samples for the same bucket are appended by a single pipeline update,
+    which leaves out those whose _id (a retried write) or (session_id, seq)
+    (a resent event) is already in the bucket. An update only matches a
+    bucket with room for all of its samples, so a full bucket makes the
+    upsert start a new one.
+
+    Args:
+        documents: Event documents (see MetricsStorage._build_document)
+
+    Returns:
+        List of pymongo UpdateOne operations
+    """
+    groups = {}
+    for document in documents:
+        key = (
+            document["event_type"],
+            document["protocol"],
+            document["video_id"],
+            bucket_start(document["timestamp"])
+        )
+        groups.setdefault(key, []).append(document)
+
+    operations = []
+    max_samples = config.BUCKET_MAX_SAMPLES
+    for (event_type, protocol, video_id, start), group in groups.items():
+        for offset in range(0, len(group), max_samples):
+            chunk = group[offset:offset + max_samples]
+            samples = [_sample(document) for document in chunk]
+            on_insert = {
+                "experiment_id": chunk[0]["experiment_id"],
+                "end_timestamp": start + config.BUCKET_SPAN_S,
+                "stored_at": chunk[0]["stored_at"]
+            }
+            operations.append(UpdateOne(
+                {
+                    "_bucket": True,
+                    "event_type": event_type,
+                    "protocol": protocol,
+                    "video_id": video_id,
+                    "timestamp": start,
+                    "count": {"$lte": max_samples - len(samples)}
+                },
+                _dedupe_push(samples, on_insert),
+                upsert=True
+            ))
+    return operations
+
+
+def _dedupe_push(samples, on_insert):
+    """
+    Update pipeline appending the samples whose _id and (session_id, seq)
+    are not in the bucket yet; samples without a session_id are only
+    checked by _id.
+    """
+    held_ids = {"$ifNull": ["$samples._id", []]}
+    held = {"$map": {
+        "input": {"$ifNull": ["$samples", []]},
+        "as": "held",
+        "in": ["$$held.session_id", "$$held.seq"]
+    }}
+    new_samples = {"$filter": {
+        # $literal keeps payload strings starting with "$" from being read as paths
+        "input": {"$literal": samples},
+        "as": "sample",
+        "cond": {"$and": [
+            {"$not": [{"$in": ["$$sample._id", held_ids]}]},
+            {"$or": [
+                {"$eq": [{"$ifNull": ["$$sample.session_id", None]}, None]},
+                {"$not": [{"$in": [["$$sample.session_id", "$$sample.seq"], held]}]}
+            ]}
+        ]}
+    }}
+    fields = {
+        name: {"$ifNull": ["$" + name, {"$literal": value}]}
+        for name, value in on_insert.items()
+    }
+    fields["samples"] = {"$concatArrays": [{"$ifNull": ["$samples", []]}, new_samples]}
+    return [
+        {"$set": fields},
+        {"$set": {"count": {"$size": "$samples"}}}
+    ]
+
+
+def bucket_range_match(start_time=None, end_time=None):
+    """
+    Pre-unpack match selecting event documents and buckets that may hold
+    events in [start_time, end_time]. Exact filtering happens after unpacking.
+    """
+    if start_time is None and end_time is None:
+        return {}
+
+    event_range, bucket_range = {}, {"_bucket": True}
+    if start_time is not None:
+        event_range["timestamp"] = {"$gte": start_time}
+        bucket_range["end_timestamp"] = {"$gt": start_time}
+    if end_time is not None:
+        event_range.setdefault("timestamp", {})["$lte"] = end_time
+        bucket_range["timestamp"] = {"$lte": end_time}
+    event_range["_bucket"] = {"$exists": False}
+
+    return {"$or": [event_range, bucket_range]}
+
+
+def unpack_bucket(document):
+    """
+    Per-event documents of a bucket, as produced by unpack_stages(); other
+    documents are returned unchanged.
+    """
+    if not document.get("_bucket"):
+        return [document]
+    events = []
+    for sample in document.get("samples", []):
+        event = {
+            "_id": sample["_id"],
+            "experiment_id": document["experiment_id"],
+            "timestamp": sample["timestamp"],
+            "event_type": document["event_type"],
+            "protocol": document["protocol"],
+            "video_id": document["video_id"],
+            "payload": sample["payload"],
+            "stored_at": document["stored_at"]
+        }
+        if "session_id" in sample:
+            event["session_id"] = sample["session_id"]
+            event["seq"] = sample["seq"]
+        events.append(event)
+    return events
+
+
+def unpack_stages():
+    """
+    Aggregation stages that expand bucket documents into per-event
+    documents and pass other documents through unchanged.
+    """
+    return [
+        {"$unwind": {"path": "$samples", "preserveNullAndEmptyArrays": True}},
+        {"$replaceRoot": {"newRoot": {"$cond": [
+            {"$eq": ["$_bucket", True]},
+            {
+                "_id": "$samples._id",
+                "experiment_id": "$experiment_id",
+                "timestamp": "$samples.timestamp",
+                "event_type": "$event_type",
+                "protocol": "$protocol",
+                "video_id": "$video_id",
+                "payload": "$samples.payload",
+                "stored_at": "$stored_at",
+                # Omitted for samples without them
+                "session_id": "$samples.session_id",
+                "seq": "$samples.seq"
+            },
+            "$$ROOT"
+        ]}}}
+    ]
@@ -0,0 +1,164 @@
+"""
+Client-side metric coalescing policy served to players.
+
+dash_player.js fetches /api/client_policy at player start and coalesces
+high-frequency events by the rules it gets back, so experiments can trade
+metric resolution against overhead on the emulated link without editing JS.
+
+The policy file (CLIENT_POLICY_FILE) is JSON:
+
+    {
+        "default": {
+            "buffer_level_updated": {
+                "min_interval_ms": 1000,
+                "min_delta": {"buffer_level": 2.0},
+                "summarize": ["buffer_level"]
+            },
+            "fragment_loading_completed": {
+                "min_interval_ms": 2000,
+                "sum": ["bytes_loaded", "download_ms"]
+            }
+        },
+        "experiments": {
+            "highres_": {"buffer_level_updated": {"min_interval_ms": 0}}
+        }
+    }
+
+Rules are per event type (see COALESCE_FIELDS). "experiments" overrides
+apply to experiment ids starting with the given prefix, longer prefixes
+last, and replace the given fields of a rule. Event types without a rule are
+sent as-is; without a policy file nothing is coalesced. The file is re-read
+when it changes, so a running server picks up edits.
+"""
+
+import copy
+import json
+import os
+import threading
+
+# Rule fields: min_interval_ms is the minimum time between two sent events
+# of a type (per media type); min_delta sends an event early when a payload
+# field moved at least this much since the last sent event; summarize adds
+# <field>_min and <field>_max over the window (the field keeps its last
+# value); sum replaces fields with their sum over the window
+COALESCE_FIELDS = ("min_interval_ms", "min_delta", "summarize", "sum")
+
+EMPTY_POLICY = {"default": {}, "experiments": {}}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+
+
+def validate_rules(rules, where):
+    """
+    Check the rules of one policy section.
+
+    Raises:
+        ValueError: If a rule is malformed
+    """
+    if not isinstance(rules, dict):
+        raise ValueError(f"{where} must be an object of event type rules")
+    for event_type, rule in rules.items():
+        name = f"{where}.{event_type}"
+        if not isinstance(rule, dict):
+            raise ValueError(f"{name} must be an object")
+        unknown = set(rule) - set(COALESCE_FIELDS)
+        if unknown:
+            raise ValueError(f"{name}: unknown fields {', '.join(sorted(unknown))}")
+        if "min_interval_ms" in rule and not _is_number(rule["min_interval_ms"]):
+            raise ValueError(f"{name}.min_interval_ms must be a non-negative number")
+        min_delta = rule.get("min_delta", {})
+        if not isinstance(min_delta, dict) or not all(_is_number(v) for v in min_delta.values()):
+            raise ValueError(f"{name}.min_delta must map fields to non-negative numbers")
+        for field in ("summarize", "sum"):
+            values = rule.get(field, [])
+            if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+                raise ValueError(f"{name}.{field} must be a list of field names")
+
+
+def parse_policy(data):
+    """
+    Validate a policy document.
+
+    Returns:
+        Policy dict with "default" and "experiments"
+
+    Raises:
+        ValueError: If the policy is malformed
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Client policy must be a JSON object")
+    policy = {
+        "default": data.get("default", {}),
+        "experiments": data.get("experiments", {})
+    }
+    validate_rules(policy["default"], "default")
+    if not isinstance(policy["experiments"], dict):
+        raise ValueError("experiments must be an object of experiment id prefixes")
+    for prefix, rules in policy["experiments"].items():
+        validate_rules(rules, f"experiments.{prefix}")
+    return policy
+
+
+class ClientPolicy:
+    """Coalescing policy from CLIENT_POLICY_FILE, reloaded when the file changes."""
+
+    def __init__(self, path=None):
+        """
+        Load the policy file.
+
+        Args:
+            path: Policy file path, or None for no coalescing
+
+        Raises:
+            ValueError: If the file is malformed
+            OSError: If it cannot be read
+        """
+        self.path = path
+        self._policy = EMPTY_POLICY
+        self._mtime = None
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+            print(f"Loaded client policy from {path}")
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path) as f:
+            self._policy = parse_policy(json.load(f))
+        self._mtime = mtime
+
+    def _reload_if_changed(self):
+        """Re-read the policy file if it changed; keep the old policy on errors."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return
+            with self._lock:
+                # A broken file is reported once, not on every request
+                self._mtime = mtime
+                self._load()
+            print(f"Reloaded client policy from {self.path}")
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Failed to reload client policy, keeping the previous one: {e}")
+
+    def rules_for(self, experiment_id):
+        """
+        Coalescing rules for an experiment.
+
+        Returns:
+            Dict of event type -> rule
+        """
+        if self.path:
+            self._reload_if_changed()
+        policy = self._policy
+        rules = copy.deepcopy(policy["default"])
+        prefixes = sorted(
+            (prefix for prefix in policy["experiments"] if experiment_id.startswith(prefix)),
+            key=len
+        )
+        for prefix in prefixes:
+            for event_type, rule in policy["experiments"][prefix].items():
+                rules.setdefault(event_type, {}).update(copy.deepcopy(rule))
+        return rules
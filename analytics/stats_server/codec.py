@@ -0,0 +1,100 @@
+"""
+Request body decoding for metric ingest.
+
+Metric submissions may be sent as JSON, MessagePack or CBOR, optionally
+compressed with Content-Encoding: gzip or deflate. MessagePack and CBOR
+support depends on the msgpack and cbor2 packages being installed.
+"""
+
+import json
+import zlib
+import config
+
+JSON_MIMETYPES = ("application/json",)
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+CBOR_MIMETYPES = ("application/cbor",)
+
+
+class PayloadError(Exception):
+    """Raised when a request body cannot be decoded."""
+
+    def __init__(self, message, status=400):
+        """
+        Args:
+            message: Error message returned to the client
+            status: HTTP status code for the response
+        """
+        super().__init__(message)
+        self.status = status
+
+
+def _decompress(body, encoding):
+    """Decompress a gzip/deflate body, refusing to inflate past the size limit."""
+    # 47 = auto-detect gzip or zlib header, 15 = zlib only
+    wbits = 47 if encoding == "gzip" else 15
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        data = decompressor.decompress(body, config.MAX_DECOMPRESSED_BYTES + 1)
+    except zlib.error as e:
+        raise PayloadError(f"Invalid {encoding} body: {e}")
+    if len(data) > config.MAX_DECOMPRESSED_BYTES or decompressor.unconsumed_tail:
+        raise PayloadError(
+            f"Decompressed body exceeds {config.MAX_DECOMPRESSED_BYTES} bytes", status=413
+        )
+    return data
+
+
+def _loads_msgpack(body):
+    try:
+        import msgpack
+    except ImportError:
+        raise PayloadError("MessagePack bodies are not supported by this server", status=415)
+    return msgpack.unpackb(body, raw=False)
+
+
+def _loads_cbor(body):
+    try:
+        import cbor2
+    except ImportError:
+        raise PayloadError("CBOR bodies are not supported by this server", status=415)
+    return cbor2.loads(body)
+
+
+def decode_body(request):
+    """
+    Decode the body of a Flask request according to its headers.
+
+    Args:
+        request: Flask request
+
+    Returns:
+        Decoded data (dict or list), or None if the body is empty
+
+    Raises:
+        PayloadError: If the encoding or content type is unsupported or the
+                      body is malformed
+    """
+    body = request.get_data(cache=False)
+    if not body:
+        return None
+
+    encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+    if encoding in ("gzip", "deflate"):
+        body = _decompress(body, encoding)
+    elif encoding != "identity":
+        raise PayloadError(f"Unsupported Content-Encoding: {encoding}", status=415)
+
+    mimetype = request.mimetype
+    try:
+        if mimetype in JSON_MIMETYPES:
+            return json.loads(body)
+        if mimetype in MSGPACK_MIMETYPES:
+            return _loads_msgpack(body)
+        if mimetype in CBOR_MIMETYPES:
+            return _loads_cbor(body)
+    except PayloadError:
+        raise
+    except Exception as e:
+        raise PayloadError(f"Malformed {mimetype} body: {e}")
+
+    raise PayloadError(f"Unsupported Content-Type: {mimetype or 'none'}", status=415)
@@ -0,0 +1,117 @@
+"""
+Side-by-side comparison of experiment summaries.
+
+/api/compare computes the QoE summary of every requested experiment (see
+summary.py) on a shared thread pool, so the summaries run concurrently on
+the database (one aggregation per metrics-{experiment_id} collection over the
+shared MongoClient pool, or SQLite reads on per-thread connections).
+Comparing N experiments then takes about as long as the slowest one.
+
+The result is one table: a row per experiment, a column per summary metric.
+Nested summary fields are addressed with dots, e.g.
+buffer_level_percentiles_s.p50.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+
+def flatten_summary(summary, prefix=""):
+    """
+    Flatten nested summary fields into dotted names.
+
+    Returns:
+        Dict of metric name -> value, in summary field order
+    """
+    flat = {}
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            flat.update(flatten_summary(value, f"{prefix}{key}."))
+        elif not isinstance(value, list):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+class ExperimentComparer:
+    """Computes experiment summaries concurrently on a shared thread pool."""
+
+    def __init__(self, storage, max_workers=config.COMPARE_MAX_WORKERS):
+        """
+        Args:
+            storage: Storage backend (see storage_base.BaseMetricsStorage)
+            max_workers: Maximum summaries computed at once
+        """
+        self.storage = storage
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="compare")
+        storage.on_close(self.close)
+
+    def _summarize(self, experiment_id):
+        """Summary of one experiment, its query time, and the error if it failed."""
+        start = time.perf_counter()
+        try:
+            summary, error = self.storage.load_summary(experiment_id), None
+        except Exception as e:
+            print(f"ERROR: Failed to summarize experiment {experiment_id}: {e}")
+            summary, error = None, str(e)
+        return summary, (time.perf_counter() - start) * 1000, error
+
+    def compare(self, experiment_ids, metrics=None):
+        """
+        Compare the summaries of several experiments.
+
+        Args:
+            experiment_ids: Experiment identifiers (duplicates are ignored)
+            metrics: Optional metric names (dotted for nested fields);
+                     default: every summary metric
+
+        Returns:
+            Dict with "columns" (experiment_id, then the metrics), "rows" (one
+            list per experiment, None where a value is unavailable),
+            "missing" (experiments without metrics), "errors" and timings
+
+        Raises:
+            ValueError: If a metric name is unknown
+        """
+        experiment_ids = list(dict.fromkeys(experiment_ids))
+        start = time.perf_counter()
+        results = list(self._executor.map(self._summarize, experiment_ids))
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        flat = {}
+        missing, errors, query_ms = [], {}, {}
+        for experiment_id, (summary, summary_ms, error) in zip(experiment_ids, results):
+            query_ms[experiment_id] = round(summary_ms, 1)
+            if error is not None:
+                errors[experiment_id] = error
+            elif summary["event_count"] == 0:
+                missing.append(experiment_id)
+            else:
+                flat[experiment_id] = flatten_summary(summary)
+                flat[experiment_id].pop("experiment_id", None)
+
+        available = []
+        for values in flat.values():
+            available.extend(name for name in values if name not in available)
+        if metrics:
+            unknown = [name for name in metrics if name not in available]
+            if flat and unknown:
+                raise ValueError(f"Unknown metrics: {', '.join(unknown)}")
+        else:
+            metrics = available
+
+        return {
+            "columns": ["experiment_id"] + list(metrics),
+            "rows": [
+                [experiment_id] + [flat.get(experiment_id, {}).get(name) for name in metrics]
+                for experiment_id in experiment_ids
+            ],
+            "missing": missing,
+            "errors": errors,
+            "query_ms": query_ms,
+            "elapsed_ms": round(elapsed_ms, 1)
+        }
+
+    def close(self):
+        """Shut down the thread pool."""
+        self._executor.shutdown(wait=True)
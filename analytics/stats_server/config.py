@@ -15,6 +15,110 @@ MONGO_DATABASE = os.getenv("MONGO_DATABASE", "testbed")
 SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
 SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
 
+# Serving mode:
+# - "development": Flask's built-in server (single process)
+# - "gunicorn": pre-fork gunicorn server with SERVER_WORKERS processes, each
+#   running SERVER_THREADS threads and owning one MongoDB connection pool
+SERVER_MODE = os.getenv("SERVER_MODE", "development")
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", str(2 * (os.cpu_count() or 1) + 1)))
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "8"))
+SERVER_TIMEOUT_S = int(os.getenv("SERVER_TIMEOUT_S", "60"))
+# Maximum MongoDB connections per worker process
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+
+# Ingest configuration
+# Maximum number of events accepted by a single /api/submit_batch request
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+# Maximum size of a request body after gzip/deflate decompression
+MAX_DECOMPRESSED_BYTES = int(os.getenv("MAX_DECOMPRESSED_BYTES", str(16 * 1024 * 1024)))
+
+# Deduplication of retried events by (session_id, seq), see dedupe.py
+# Maximum player sessions tracked per process (least recently used evicted)
+DEDUPE_MAX_SESSIONS = int(os.getenv("DEDUPE_MAX_SESSIONS", "10000"))
+# Maximum out-of-order sequence numbers tracked per session
+DEDUPE_WINDOW = int(os.getenv("DEDUPE_WINDOW", "1024"))
+
+# Client-side coalescing policy served at /api/client_policy (JSON file,
+# see client_policy.py); unset means players send every event
+CLIENT_POLICY_FILE = os.getenv("CLIENT_POLICY_FILE") or None
+
+# Storage backend:
+# - "mongo": MongoDB at MONGO_HOST:MONGO_PORT, one collection per experiment
+# - "sqlite": embedded SQLite database file at SQLITE_PATH (no external
+#   services; see sqlite_storage.py)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "metrics.db")
+# Idle SQLite connections kept open for reuse per process
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "4"))
+
+# Storage layout (mongo backend only):
+# - "document": one MongoDB document per event
+# - "bucketed": events of BUCKETED_EVENT_TYPES are packed into per-window
+#   bucket documents of up to BUCKET_MAX_SAMPLES samples (see bucketing.py)
+STORAGE_LAYOUT = os.getenv("STORAGE_LAYOUT", "document")
+BUCKETED_EVENT_TYPES = set(os.getenv(
+    "BUCKETED_EVENT_TYPES",
+    "buffer_level_updated,fragment_loading_started,fragment_loading_completed,periodic_metrics"
+).split(","))
+BUCKET_SPAN_S = int(os.getenv("BUCKET_SPAN_S", "60"))
+BUCKET_MAX_SAMPLES = int(os.getenv("BUCKET_MAX_SAMPLES", "1000"))
+
+# Query/export configuration
+# Documents fetched per MongoDB cursor batch when streaming metrics
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Maximum page size for paginated /api/metrics requests
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "10000"))
+
+# Write-behind mode: acknowledge submits immediately and write to MongoDB
+# from a background flusher in bulk
+ASYNC_WRITES = os.getenv("ASYNC_WRITES", "false").lower() in ("1", "true", "yes")
+# Maximum number of documents buffered before submits are rejected with 503
+WRITE_QUEUE_MAX_SIZE = int(os.getenv("WRITE_QUEUE_MAX_SIZE", "100000"))
+# Number of buffered documents that triggers an immediate flush
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "1000"))
+# Maximum time a document stays buffered before it is flushed (milliseconds)
+WRITE_FLUSH_INTERVAL_MS = int(os.getenv("WRITE_FLUSH_INTERVAL_MS", "200"))
+# Maximum time an export waits for queued writes to reach the database (seconds)
+FLUSH_TIMEOUT_S = float(os.getenv("FLUSH_TIMEOUT_S", "10"))
+
+# Live aggregates (/api/live/<experiment_id>)
+# Rolling window for event rate and throughput (seconds)
+LIVE_WINDOW_S = int(os.getenv("LIVE_WINDOW_S", "10"))
+# Minimum interval between pushed snapshots (seconds)
+LIVE_PUSH_INTERVAL_S = float(os.getenv("LIVE_PUSH_INTERVAL_S", "1.0"))
+# Experiments without events for this long are dropped (seconds)
+LIVE_IDLE_TIMEOUT_S = int(os.getenv("LIVE_IDLE_TIMEOUT_S", "600"))
+# Interval between publishing live state to storage for other workers (seconds)
+LIVE_SYNC_INTERVAL_S = float(os.getenv("LIVE_SYNC_INTERVAL_S", "2.0"))
+# Maximum open live streams per process; each holds a server thread, so the
+# default leaves three quarters of SERVER_THREADS to ingest
+LIVE_MAX_STREAMS = int(os.getenv("LIVE_MAX_STREAMS", str(max(1, SERVER_THREADS // 4))))
+# Maximum experiments watched over one /api/live?ids=... stream
+LIVE_MAX_STREAM_EXPERIMENTS = int(os.getenv("LIVE_MAX_STREAM_EXPERIMENTS", "50"))
+
+# Incremental aggregates (/api/aggregates/<experiment_id>)
+# Interval between checkpoints of changed aggregates to storage (seconds)
+AGGREGATE_CHECKPOINT_INTERVAL_S = int(os.getenv("AGGREGATE_CHECKPOINT_INTERVAL_S", "10"))
+# Experiments without events for this long are checkpointed and evicted (seconds)
+AGGREGATE_IDLE_TIMEOUT_S = int(os.getenv("AGGREGATE_IDLE_TIMEOUT_S", "600"))
+# Maximum experiments kept in memory per process (least recently updated evicted)
+AGGREGATE_MAX_EXPERIMENTS = int(os.getenv("AGGREGATE_MAX_EXPERIMENTS", "1000"))
+# Stall and quality change events older than this before an experiment's last
+# event are folded into sums at checkpoint; later arrivals count at the fold (seconds)
+AGGREGATE_REORDER_WINDOW_S = int(os.getenv("AGGREGATE_REORDER_WINDOW_S", "60"))
+
+# Experiment comparison (/api/compare)
+# Summaries computed concurrently per request
+COMPARE_MAX_WORKERS = int(os.getenv("COMPARE_MAX_WORKERS", "8"))
+# Maximum experiments per comparison
+MAX_COMPARE_EXPERIMENTS = int(os.getenv("MAX_COMPARE_EXPERIMENTS", "50"))
+
+# Retention (see retention.py): roll up and drop raw events of old experiments
+# Policy file with per-experiment-prefix rules; unset disables the job
+RETENTION_POLICY_FILE = os.getenv("RETENTION_POLICY_FILE") or None
+# Interval between retention runs (seconds)
+RETENTION_INTERVAL_S = int(os.getenv("RETENTION_INTERVAL_S", "3600"))
+
 # MongoDB connection string
 # Authenticate against admin database, then use testbed database
 MONGO_URI = f"mongodb://{MONGO_USERNAME}:{MONGO_PASSWORD}@{MONGO_HOST}:{MONGO_PORT}/{MONGO_DATABASE}?authSource=admin"
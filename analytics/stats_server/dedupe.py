@@ -0,0 +1,118 @@
+"""
+In-memory deduplication of retried metric events.
+
+Players stamp each event with a session_id and a per-session sequence number
+(seq) that increases by one per event. Per session, the deduper keeps a
+high-water mark (every seq up to it has been stored) plus the set of stored
+seqs above it, which stays tiny while batches arrive roughly in order. A
+duplicate check is then a dict lookup and an integer comparison.
+
+Memory is bounded twice: at most DEDUPE_WINDOW seqs above the high-water mark
+per session (older gaps are given up, so a seq that arrives later than that
+is treated as a duplicate), and at most DEDUPE_MAX_SESSIONS sessions, least
+recently used evicted first. Duplicates the deduper misses (evicted sessions,
+retries landing on another gunicorn worker) are rejected by the storage
+backend's unique (session_id, seq) index.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class _SessionWindow:
+    """
+    Stored seqs of one session.
+
+    At most window seqs are kept above the high-water mark, however small
+    the window:
+
+    >>> session = _SessionWindow()
+    >>> for seq in (1, 3, 5, 7, 9):
+    ...     session.add(seq, window=1)
+    >>> session.high, sorted(session.above)
+    (7, [9])
+    """
+
+    __slots__ = ("high", "above")
+
+    def __init__(self):
+        self.high = -1      # every seq <= high has been stored
+        self.above = set()  # stored seqs > high
+
+    def seen(self, seq):
+        return seq <= self.high or seq in self.above
+
+    def add(self, seq, window):
+        if seq <= self.high:
+            return
+        self.above.add(seq)
+        while self.high + 1 in self.above:
+            self.high += 1
+            self.above.remove(self.high)
+        if len(self.above) > window:
+            # Give up on the oldest gaps: keep the newest half of the window
+            # (at least the newest seq; [-0:] would keep them all)
+            kept = sorted(self.above)[-max(1, window // 2):]
+            self.high = kept[0] - 1
+            self.above = set(kept)
+
+
+class SessionDeduper:
+    """Bounded per-session duplicate filter for (session_id, seq) events."""
+
+    def __init__(self, max_sessions, window):
+        """
+        Args:
+            max_sessions: Maximum sessions tracked (LRU eviction)
+            window: Maximum out-of-order seqs tracked per session
+        """
+        self.max_sessions = max_sessions
+        self.window = window
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, events):
+        """
+        Drop events that were already stored or repeat within the batch.
+
+        Events without session_id or seq always pass. Nothing is recorded
+        until mark() is called, so a failed write can be retried.
+
+        Args:
+            events: Event dicts or documents
+
+        Returns:
+            List of events that are not duplicates
+        """
+        fresh = []
+        batch_seen = set()
+        with self._lock:
+            for event in events:
+                session_id, seq = event.get("session_id"), event.get("seq")
+                if session_id is None or seq is None:
+                    fresh.append(event)
+                    continue
+                if (session_id, seq) in batch_seen:
+                    continue
+                session = self._sessions.get(session_id)
+                if session is not None and session.seen(seq):
+                    continue
+                batch_seen.add((session_id, seq))
+                fresh.append(event)
+        return fresh
+
+    def mark(self, events):
+        """Record events as stored."""
+        with self._lock:
+            for event in events:
+                session_id, seq = event.get("session_id"), event.get("seq")
+                if session_id is None or seq is None:
+                    continue
+                session = self._sessions.get(session_id)
+                if session is None:
+                    session = self._sessions[session_id] = _SessionWindow()
+                    if len(self._sessions) > self.max_sessions:
+                        self._sessions.popitem(last=False)
+                else:
+                    self._sessions.move_to_end(session_id)
+                session.add(seq, self.window)
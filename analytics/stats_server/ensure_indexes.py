@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Create metric indexes on existing experiment collections.
+
+The stats server indexes each metrics-{experiment_id} collection when it first
+writes to it. Run this once to backfill indexes on collections created before
+that, e.g.:
+
+    docker exec stats_server python3 ensure_indexes.py
+"""
+
+import sys
+from storage import MetricsStorage
+
+
+def main():
+    storage = MetricsStorage()
+    try:
+        collection_names = storage.ensure_all_indexes()
+    except Exception as e:
+        print(f"ERROR: Failed to create indexes: {e}")
+        sys.exit(1)
+    finally:
+        storage.close()
+    
+    for collection_name in collection_names:
+        print(f"✓ {collection_name}")
+    print(f"Indexed {len(collection_names)} collections")
+
+
+if __name__ == "__main__":
+    main()
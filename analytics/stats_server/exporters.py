@@ -0,0 +1,289 @@
+"""
+Streaming export formats for experiment metrics.
+
+Every exporter consumes an iterator of metric documents (straight from a
+database cursor) and yields encoded bytes chunk by chunk, so exports never
+hold a whole experiment in memory and can be written to a file or streamed
+over HTTP alike.
+
+Formats:
+- json: pretty-printed JSON array (the original metrics.json layout)
+- ndjson: one compact JSON document per line
+- ndjson.gz: gzip-compressed NDJSON
+- ndjson.zst: zstd-compressed NDJSON (requires the zstandard package)
+- parquet: columnar Parquet with frequently used payload fields flattened
+  into typed columns (requires the pyarrow package)
+"""
+
+import importlib.util
+import json
+import textwrap
+import zlib
+from datetime import datetime
+
+# Export formats and their file extensions
+EXPORT_FORMATS = {
+    "json": "json",
+    "ndjson": "ndjson",
+    "ndjson.gz": "ndjson.gz",
+    "ndjson.zst": "ndjson.zst",
+    "parquet": "parquet",
+}
+
+# Payload fields flattened into typed columns in columnar exports
+FLATTENED_FIELDS = {
+    "buffer_level": "float64",
+    "bitrate": "float64",
+    "current_bitrate": "float64",
+    "quality": "int64",
+    "old_quality": "int64",
+    "new_quality": "int64",
+    "media_type": "string",
+    "current_time": "float64",
+    "duration": "float64",
+    "start_time": "float64",
+    "playback_rate": "float64",
+    "dropped_frames": "int64",
+    "rebuffer_count": "int64",
+    "stall_duration_s": "float64",
+    "bytes_loaded": "int64",
+    "download_ms": "float64",
+}
+
+# Rows per Parquet row group / lines per compressed NDJSON chunk
+CHUNK_ROWS = 10000
+
+
+def json_default(value):
+    """JSON encoder fallback for ObjectId and datetime values."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _chunks(metrics, size):
+    """Group an iterator of metrics into lists of at most size items."""
+    chunk = []
+    for metric in metrics:
+        chunk.append(metric)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_json(metrics):
+    """Yield a pretty-printed JSON array, one document at a time."""
+    yield b"["
+    first = True
+    for metric in metrics:
+        document = json.dumps(metric, indent=2, default=json_default)
+        yield (b"\n" if first else b",\n") + textwrap.indent(document, "  ").encode()
+        first = False
+    yield b"]" if first else b"\n]"
+
+
+def iter_ndjson(metrics, chunk_rows=CHUNK_ROWS):
+    """Yield NDJSON in chunks of chunk_rows lines."""
+    for chunk in _chunks(metrics, chunk_rows):
+        lines = [json.dumps(metric, default=json_default, separators=(",", ":")) for metric in chunk]
+        yield ("\n".join(lines) + "\n").encode()
+
+
+def iter_ndjson_gzip(metrics, chunk_rows=CHUNK_ROWS):
+    """Yield gzip-compressed NDJSON."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in iter_ndjson(metrics, chunk_rows):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_ndjson_zstd(metrics, chunk_rows=CHUNK_ROWS):
+    """Yield zstd-compressed NDJSON."""
+    import zstandard
+
+    compressor = zstandard.ZstdCompressor(level=3).compressobj()
+    for chunk in iter_ndjson(metrics, chunk_rows):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def flatten_metric(metric):
+    """
+    Build a flat row for columnar formats.
+
+    Common payload fields become top-level columns; the full payload is kept
+    as a JSON string so the export stays lossless. Payloads that are not
+    objects (lists, strings, numbers) only land in the JSON column.
+
+    >>> row = flatten_metric({"payload": [1, 2]})
+    >>> row["payload"], row["bitrate"]
+    ('[1,2]', None)
+    """
+    payload = metric.get("payload")
+    if payload is None:
+        payload = {}
+    fields = payload if isinstance(payload, dict) else {}
+    row = {
+        "_id": str(metric.get("_id")) if metric.get("_id") is not None else None,
+        "experiment_id": metric.get("experiment_id"),
+        "timestamp": metric.get("timestamp"),
+        "event_type": metric.get("event_type"),
+        "protocol": metric.get("protocol"),
+        "video_id": metric.get("video_id"),
+        "session_id": metric.get("session_id"),
+        "seq": metric.get("seq"),
+        "stored_at": metric.get("stored_at"),
+        "payload": json.dumps(payload, default=json_default, separators=(",", ":")),
+    }
+    for field, column_type in FLATTENED_FIELDS.items():
+        value = fields.get(field)
+        if value is not None and column_type != "string":
+            try:
+                value = float(value) if column_type == "float64" else int(value)
+            except (TypeError, ValueError):
+                value = None
+        row[field] = value
+    return row
+
+
+class _ByteSink:
+    """Minimal writable file object that hands written bytes back to a generator."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def iter_parquet(metrics, chunk_rows=CHUNK_ROWS):
+    """Yield a zstd-compressed Parquet file, one row group per chunk."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    column_types = {
+        "float64": pa.float64(),
+        "int64": pa.int64(),
+        "string": pa.string(),
+    }
+    schema = pa.schema(
+        [
+            ("_id", pa.string()),
+            ("experiment_id", pa.dictionary(pa.int32(), pa.string())),
+            ("timestamp", pa.float64()),
+            ("event_type", pa.dictionary(pa.int32(), pa.string())),
+            ("protocol", pa.dictionary(pa.int32(), pa.string())),
+            ("video_id", pa.dictionary(pa.int32(), pa.string())),
+            ("session_id", pa.dictionary(pa.int32(), pa.string())),
+            ("seq", pa.int64()),
+            ("stored_at", pa.timestamp("ms")),
+            ("payload", pa.string()),
+        ]
+        + [(field, column_types[column_type]) for field, column_type in FLATTENED_FIELDS.items()]
+    )
+
+    sink = _ByteSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for chunk in _chunks(metrics, chunk_rows):
+            rows = [flatten_metric(metric) for metric in chunk]
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            data = sink.take()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+# Optional packages needed by some formats
+_REQUIRED_MODULES = {
+    "ndjson.zst": "zstandard",
+    "parquet": "pyarrow",
+}
+
+_EXPORTERS = {
+    "json": iter_json,
+    "ndjson": iter_ndjson,
+    "ndjson.gz": iter_ndjson_gzip,
+    "ndjson.zst": iter_ndjson_zstd,
+    "parquet": iter_parquet,
+}
+
+
+def iter_export(metrics, export_format):
+    """
+    Encode metrics in an export format.
+
+    Args:
+        metrics: Iterator of metric documents
+        export_format: One of EXPORT_FORMATS
+
+    Returns:
+        Iterator of bytes chunks
+
+    Raises:
+        ValueError: If the format is unknown
+        RuntimeError: If the format needs a package that is not installed
+    """
+    if export_format not in _EXPORTERS:
+        raise ValueError(f"Unknown export format: {export_format} "
+                         f"(expected one of {', '.join(EXPORT_FORMATS)})")
+    required_module = _REQUIRED_MODULES.get(export_format)
+    if required_module and importlib.util.find_spec(required_module) is None:
+        raise RuntimeError(f"{export_format} export requires the {required_module} package")
+    return _EXPORTERS[export_format](metrics)
+
+
+class _CountingIterator:
+    """Iterator wrapper counting how many items were consumed."""
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self.iterator)
+        self.count += 1
+        return item
+
+
+def write_export(metrics, output_file, export_format):
+    """
+    Write metrics to a file in an export format.
+
+    Returns:
+        Number of metrics written
+    """
+    counted = _CountingIterator(metrics)
+    with open(output_file, "wb") as f:
+        for data in iter_export(counted, export_format):
+            f.write(data)
+    return counted.count
@@ -0,0 +1,257 @@
+"""
+Low-overhead self-instrumentation for the stats server.
+
+Request counts, latencies, payload sizes, database write latencies and error
+counts are recorded in-process into fixed-bucket histograms and counters:
+each observation is a bisect and a few integer updates under a lock, cheap
+enough to stay enabled in production. The registry is per process, so with
+several gunicorn workers each worker reports its own numbers.
+"""
+
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request
+
+# Log-spaced bucket upper bounds from 1 to 2^40, enough for microseconds up
+# to days or bytes up to a TiB. The default 4 buckets per power of two are
+# ~19% wide.
+@functools.lru_cache(maxsize=None)
+def _bounds(buckets_per_doubling=4):
+    return [2 ** (i / float(buckets_per_doubling)) for i in range(40 * buckets_per_doubling + 1)]
+
+# Width in seconds of the window used for recent request rates
+RATE_WINDOW_S = 60
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram with approximate percentiles.
+
+    Histograms with the same buckets merge exactly, so they also serve as
+    mergeable streaming sketches (see aggregator.py).
+    """
+
+    def __init__(self, buckets_per_doubling=4):
+        """
+        Args:
+            buckets_per_doubling: Resolution; bucket width is 2^(1/n) - 1
+        """
+        self.buckets_per_doubling = buckets_per_doubling
+        self._bounds = _bounds(buckets_per_doubling)
+        self.counts = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        """Record one observation."""
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def merge(self, other):
+        """Add another histogram's observations (same resolution) to this one."""
+        with self._lock:
+            for index, count in enumerate(other.counts):
+                self.counts[index] += count
+            self.count += other.count
+            self.total += other.total
+            self.max = max(self.max, other.max)
+
+    def to_state(self):
+        """Sparse JSON-serializable representation (see from_state)."""
+        with self._lock:
+            return {
+                "buckets_per_doubling": self.buckets_per_doubling,
+                "buckets": [[index, count] for index, count in enumerate(self.counts) if count],
+                "count": self.count,
+                "total": self.total,
+                "max": self.max,
+            }
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild a histogram from to_state() output."""
+        histogram = cls(state["buckets_per_doubling"])
+        for index, count in state["buckets"]:
+            histogram.counts[index] = count
+        histogram.count = state["count"]
+        histogram.total = state["total"]
+        histogram.max = state["max"]
+        return histogram
+
+    def buckets(self):
+        """Non-empty buckets as (upper bound, count) pairs."""
+        with self._lock:
+            return [
+                (self._bounds[index] if index < len(self._bounds) else self.max, count)
+                for index, count in enumerate(self.counts) if count
+            ]
+
+    def percentile(self, p):
+        """Approximate p-th percentile (upper bound of the bucket it falls in)."""
+        with self._lock:
+            if self.count == 0:
+                return None
+            rank = p / 100.0 * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank and count:
+                    if index < len(self._bounds):
+                        return min(self._bounds[index], self.max)
+                    return self.max
+            return self.max
+
+    def snapshot(self):
+        """Summary dict: count, mean, p50/p95/p99 and max."""
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max if self.count else None,
+        }
+
+
+class RateCounter:
+    """Event counter with a per-second ring buffer for recent rates."""
+
+    def __init__(self, window=RATE_WINDOW_S):
+        self.total = 0
+        self._window = window
+        self._slots = [0] * window
+        self._slot_seconds = [0] * window
+        self._lock = threading.Lock()
+
+    def increment(self, now=None):
+        second = int(now if now is not None else time.time())
+        slot = second % self._window
+        with self._lock:
+            if self._slot_seconds[slot] != second:
+                self._slot_seconds[slot] = second
+                self._slots[slot] = 0
+            self._slots[slot] += 1
+            self.total += 1
+
+    def rate(self, now=None):
+        """Average events per second over the last window (excluding this second)."""
+        second = int(now if now is not None else time.time())
+        with self._lock:
+            recent = sum(
+                count for count, slot_second in zip(self._slots, self._slot_seconds)
+                if second - self._window <= slot_second < second
+            )
+        return recent / float(self._window)
+
+
+class Instrumentation:
+    """Registry of the stats server's internal metrics."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.request_rates = {}      # route -> RateCounter
+        self.request_latency = {}    # route -> Histogram (microseconds)
+        self.request_bytes = {}      # route -> Histogram (request body bytes)
+        self.write_latency = {}      # operation -> Histogram (microseconds)
+        self.write_documents = {}    # operation -> documents written
+        self.errors = {}             # error kind -> count
+        self._lock = threading.Lock()
+
+    def _get(self, table, key, factory):
+        value = table.get(key)
+        if value is None:
+            with self._lock:
+                value = table.setdefault(key, factory())
+        return value
+
+    def record_request(self, route, status, latency_us, request_bytes):
+        """Record one completed HTTP request."""
+        self._get(self.request_rates, route, RateCounter).increment()
+        self._get(self.request_latency, route, Histogram).record(latency_us)
+        if request_bytes:
+            self._get(self.request_bytes, route, Histogram).record(request_bytes)
+        if status >= 400:
+            self.count_error(f"http_{status}")
+
+    def count_error(self, kind, count=1):
+        """Increment an error counter."""
+        with self._lock:
+            self.errors[kind] = self.errors.get(kind, 0) + count
+
+    @contextmanager
+    def time_write(self, operation, documents=1):
+        """Time a database write (e.g. insert_one, insert_many, bulk_write)."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count_error(f"{operation}_failed")
+            raise
+        finally:
+            elapsed_us = (time.perf_counter() - start) * 1e6
+            self._get(self.write_latency, operation, Histogram).record(elapsed_us)
+            with self._lock:
+                self.write_documents[operation] = self.write_documents.get(operation, 0) + documents
+
+    def snapshot(self):
+        """All metrics as a JSON-serializable dict."""
+        now = time.time()
+        routes = {}
+        for route, counter in list(self.request_rates.items()):
+            routes[route] = {
+                "requests": counter.total,
+                "rate_per_s": counter.rate(now),
+                "latency_us": self.request_latency[route].snapshot(),
+            }
+            if route in self.request_bytes:
+                routes[route]["request_bytes"] = self.request_bytes[route].snapshot()
+
+        writes = {
+            operation: dict(
+                histogram.snapshot(),
+                documents=self.write_documents.get(operation, 0)
+            )
+            for operation, histogram in list(self.write_latency.items())
+        }
+
+        return {
+            "uptime_s": now - self.started_at,
+            "routes": routes,
+            "writes": writes,
+            "errors": dict(self.errors),
+        }
+
+
+# Process-wide registry
+STATS = Instrumentation()
+
+
+def register_instrumentation(app, stats=STATS):
+    """Record latency, status and body size of every request handled by app."""
+
+    @app.before_request
+    def start_timer():
+        g.instrumentation_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("instrumentation_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            stats.record_request(
+                route,
+                response.status_code,
+                (time.perf_counter() - start) * 1e6,
+                request.content_length or 0
+            )
+        return response
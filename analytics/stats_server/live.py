@@ -0,0 +1,367 @@
+"""
+Rolling live QoE aggregates per experiment.
+
+LiveAggregates subscribes to the storage backend and updates a small state
+object per experiment for every accepted event, so the cost is a dict lookup
+and a few arithmetic operations per event, independent of how many clients
+watch. /api/live/<experiment_id> pushes snapshots of that state to clients as
+Server-Sent Events, and /api/live?ids=... pushes those of several experiments
+over one connection.
+
+Windowed values (event rate, fragment throughput) are kept in per-second
+slots over the last LIVE_WINDOW_S seconds of server time, and stall events
+older than LIVE_WINDOW_S before the last event are folded into the stall
+counts, so the state stays small however long the experiment runs. In
+gunicorn mode each worker only sees the events it received, so every process
+publishes its changed partial state to storage (the aggregates of aggregator.py, under
+LIVE_KEY_PREFIX + experiment_id) every LIVE_SYNC_INTERVAL_S, and a snapshot
+merges this process's state with the partials the other workers published.
+A process deletes its partials when it shuts down, and partials idle for
+LIVE_IDLE_TIMEOUT_S (e.g. of a crashed worker) are deleted by whichever
+process loads them.
+
+Each open stream holds a server thread for as long as the client watches, so
+a process serves at most LIVE_MAX_STREAMS streams at a time and keeps its
+other threads for ingest.
+"""
+
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from summary import NO_STALLS, STALL_END_EVENTS, advance_stalls
+import config
+
+# Prefix of the experiment key under which live partials are saved, so they
+# never mix with the checkpoints of aggregator.py
+LIVE_KEY_PREFIX = "live:"
+
+
+class LiveAggregate:
+    """Rolling aggregates of one experiment seen by this process."""
+
+    def __init__(self, experiment_id, window=config.LIVE_WINDOW_S):
+        self.experiment_id = experiment_id
+        self.window = window
+        self.version = 0
+        self.updated_at = time.time()
+        self.events_total = 0
+        self.last = None
+        self.current_bitrate = None
+        self.bitrate_at = None
+        self.buffer_level = None
+        self.buffer_at = None
+        # Stall state up to LIVE_WINDOW_S before the last event (see
+        # summary.advance_stalls), then the newer [timestamp, True for
+        # rebuffer_event / False for a stall end event], which are kept so
+        # a stall may start and end in different processes
+        self.stalls = dict(NO_STALLS)
+        self.stall_events = []
+        self.dirty = False
+        # (second, events, fragment bytes, fragment download ms)
+        self._slots = deque()
+        self._lock = threading.Lock()
+
+    def _slot(self, second):
+        if not self._slots or self._slots[-1][0] != second:
+            self._slots.append([second, 0, 0, 0.0])
+            while self._slots[0][0] <= second - self.window:
+                self._slots.popleft()
+        return self._slots[-1]
+
+    def update(self, documents, now=None):
+        """Fold a batch of event documents into the aggregates."""
+        now = now if now is not None else time.time()
+        with self._lock:
+            slot = self._slot(int(now))
+            for document in documents:
+                event_type = document["event_type"]
+                payload = document.get("payload") or {}
+                slot[1] += 1
+                t = document["timestamp"]
+                self.last = t if self.last is None else max(self.last, t)
+
+                if event_type == "fragment_loading_completed":
+                    if payload.get("bytes_loaded") and payload.get("download_ms"):
+                        slot[2] += payload["bytes_loaded"]
+                        slot[3] += payload["download_ms"]
+                elif event_type == "buffer_level_updated":
+                    if payload.get("media_type") in ("video", None):
+                        self.buffer_level = payload.get("buffer_level")
+                        self.buffer_at = now
+                elif event_type == "quality_change_rendered":
+                    self.current_bitrate = payload.get("bitrate")
+                    self.bitrate_at = now
+                elif event_type == "periodic_metrics":
+                    self.current_bitrate = payload.get("current_bitrate", self.current_bitrate)
+                    self.bitrate_at = now
+
+                if event_type == "rebuffer_event" or event_type in STALL_END_EVENTS:
+                    self.stall_events.append([t, event_type == "rebuffer_event"])
+
+            if self.stall_events:
+                horizon = self.last - self.window
+                folded = [event for event in self.stall_events if event[0] < horizon]
+                if folded:
+                    self.stalls = advance_stalls(self.stalls, folded)
+                    self.stall_events = [event for event in self.stall_events if event[0] >= horizon]
+
+            self.events_total += len(documents)
+            self.updated_at = now
+            self.version += 1
+            self.dirty = True
+
+    def to_state(self):
+        """JSON-serializable state for publishing and merging."""
+        with self._lock:
+            return {
+                "version": self.version,
+                "updated_at": self.updated_at,
+                "events_total": self.events_total,
+                "last": self.last,
+                "current_bitrate": self.current_bitrate,
+                "bitrate_at": self.bitrate_at,
+                "buffer_level": self.buffer_level,
+                "buffer_at": self.buffer_at,
+                "stalls": dict(self.stalls),
+                "stall_events": [list(event) for event in self.stall_events],
+                "slots": [list(slot) for slot in self._slots],
+            }
+
+
+def merge_live_states(experiment_id, states, window, now=None):
+    """
+    Merge live partial states of several processes into a snapshot.
+
+    Counts and windowed slots add up, current values come from the partial
+    that updated them last, and the recent stall events of all partials are
+    replayed together so a stall may start and end in different processes.
+
+    Returns:
+        Snapshot dict, as pushed by /api/live
+    """
+    now = now if now is not None else time.time()
+    oldest = int(now) - window
+    events = fragment_bytes = download_ms = 0
+    stalls = dict(NO_STALLS)
+    stall_events = []
+    current_bitrate, bitrate_at = None, None
+    buffer_level, buffer_at = None, None
+    for state in states:
+        for second, slot_events, slot_bytes, slot_ms in state["slots"]:
+            if second > oldest:
+                events += slot_events
+                fragment_bytes += slot_bytes
+                download_ms += slot_ms
+        if state["bitrate_at"] is not None and (bitrate_at is None or state["bitrate_at"] > bitrate_at):
+            current_bitrate, bitrate_at = state["current_bitrate"], state["bitrate_at"]
+        if state["buffer_at"] is not None and (buffer_at is None or state["buffer_at"] > buffer_at):
+            buffer_level, buffer_at = state["buffer_level"], state["buffer_at"]
+        stalls["count"] += state["stalls"]["count"]
+        stalls["total"] += state["stalls"]["total"]
+        since = state["stalls"]["since"]
+        if since is not None and (stalls["since"] is None or since < stalls["since"]):
+            stalls["since"] = since
+        stall_events.extend(state["stall_events"])
+
+    last = max((state["last"] for state in states if state["last"] is not None), default=None)
+    stalls = advance_stalls(stalls, stall_events)
+    stall_time = stalls["total"]
+    if stalls["since"] is not None:
+        stall_time += last - stalls["since"]
+    return {
+        "experiment_id": experiment_id,
+        "version": sum(state["version"] for state in states),
+        "updated_at": max(state["updated_at"] for state in states),
+        "events_total": sum(state["events_total"] for state in states),
+        "window_s": window,
+        "events_per_s": events / float(window),
+        "throughput_bps": fragment_bytes * 8000.0 / download_ms if download_ms else None,
+        "current_bitrate_bps": current_bitrate,
+        "buffer_level_s": buffer_level,
+        "rebuffer_count": stalls["count"],
+        "stalled": stalls["since"] is not None,
+        "total_stall_time_s": stall_time,
+    }
+
+
+class LiveAggregates:
+    """LiveAggregate per experiment, fed by a storage subscription."""
+
+    def __init__(self, storage, window=config.LIVE_WINDOW_S, idle_timeout=config.LIVE_IDLE_TIMEOUT_S,
+                 sync_interval=config.LIVE_SYNC_INTERVAL_S, max_streams=config.LIVE_MAX_STREAMS):
+        """
+        Subscribe to a storage backend and start the publishing thread.
+
+        Args:
+            storage: Storage backend to subscribe to
+            window: Rolling window length in seconds
+            idle_timeout: Seconds without events after which an experiment's
+                          aggregates are dropped
+            sync_interval: Seconds between publishing this process's changed
+                           partials and reloading those of other processes
+            max_streams: Maximum open streams in this process
+        """
+        self.storage = storage
+        self.window = window
+        self.idle_timeout = idle_timeout
+        self.sync_interval = sync_interval
+        self.max_streams = max_streams
+        self._process_id = uuid.uuid4().hex
+        self._aggregates = {}
+        # Partial ids this process saved, deleted on close()
+        self._published = set()
+        # experiment_id -> (loaded at, partial states of other processes)
+        self._remote = {}
+        self._lock = threading.Lock()
+        self._last_expiry = time.time()
+        self._streams = threading.BoundedSemaphore(max_streams)
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="live-publish", daemon=True)
+        self._thread.start()
+
+        storage.subscribe(self.on_documents)
+        storage.on_close(self.close)
+
+    def on_documents(self, documents):
+        """Storage subscriber: update the experiment of a document batch."""
+        experiment_id = documents[0]["experiment_id"]
+        aggregate = self._aggregates.get(experiment_id)
+        if aggregate is None:
+            with self._lock:
+                aggregate = self._aggregates.setdefault(
+                    experiment_id, LiveAggregate(experiment_id, self.window)
+                )
+        now = time.time()
+        aggregate.update(documents, now)
+        if now - self._last_expiry > self.idle_timeout:
+            self._expire(now)
+
+    def _expire(self, now):
+        """Drop aggregates of experiments that stopped sending events."""
+        with self._lock:
+            self._last_expiry = now
+            for experiment_id, aggregate in list(self._aggregates.items()):
+                if now - aggregate.updated_at > self.idle_timeout:
+                    del self._aggregates[experiment_id]
+            for experiment_id, (loaded_at, _) in list(self._remote.items()):
+                if now - loaded_at > self.idle_timeout:
+                    del self._remote[experiment_id]
+
+    def _partial_id(self, experiment_id):
+        """Id of this process's published partial of an experiment."""
+        return f"{self._process_id}:{LIVE_KEY_PREFIX}{experiment_id}"
+
+    def _remote_states(self, experiment_id, now):
+        """Recent partials other processes published, reloaded at most every sync_interval."""
+        cached = self._remote.get(experiment_id)
+        if cached is not None and now - cached[0] < self.sync_interval:
+            return cached[1]
+        try:
+            states, stale = [], []
+            for partial_id, state in self.storage.load_aggregates(LIVE_KEY_PREFIX + experiment_id):
+                if now - state["updated_at"] >= self.idle_timeout:
+                    stale.append(partial_id)
+                elif partial_id != self._partial_id(experiment_id):
+                    states.append(state)
+            if stale:
+                self.storage.delete_aggregates(stale)
+        except Exception as e:
+            print(f"ERROR: Failed to load live aggregates: {e}")
+            states = cached[1] if cached is not None else []
+        self._remote[experiment_id] = (now, states)
+        return states
+
+    def snapshot(self, experiment_id, now=None):
+        """
+        Current aggregates of an experiment across all processes.
+
+        Returns:
+            Snapshot dict (see merge_live_states), or None if no process has
+            recent events of the experiment
+        """
+        now = now if now is not None else time.time()
+        states = list(self._remote_states(experiment_id, now))
+        aggregate = self._aggregates.get(experiment_id)
+        if aggregate is not None:
+            states.append(aggregate.to_state())
+        if not states:
+            return None
+        return merge_live_states(experiment_id, states, self.window, now)
+
+    def open_stream(self):
+        """
+        Reserve one of the max_streams stream slots.
+
+        Returns:
+            True if a slot was reserved; release it with close_stream()
+        """
+        return self._streams.acquire(blocking=False)
+
+    def close_stream(self):
+        """Release a slot reserved by open_stream()."""
+        self._streams.release()
+
+    def stream(self, experiment_ids, interval=config.LIVE_PUSH_INTERVAL_S):
+        """
+        Yield Server-Sent Events with aggregate snapshots of experiments.
+
+        Each experiment's snapshot is sent whenever its aggregates changed,
+        at most once per interval; the snapshot's experiment_id tells them
+        apart. A comment line keeps idle connections open.
+
+        Args:
+            experiment_ids: Experiments to watch over this one stream
+        """
+        yield "retry: 2000\n\n"
+        sent_versions = {}
+        idle = 0.0
+        while True:
+            for experiment_id in experiment_ids:
+                snapshot = self.snapshot(experiment_id)
+                if snapshot is not None and snapshot["version"] != sent_versions.get(experiment_id):
+                    sent_versions[experiment_id] = snapshot["version"]
+                    idle = 0.0
+                    data = json.dumps(snapshot, separators=(",", ":"))
+                    yield f"event: aggregates\ndata: {data}\n\n"
+            if idle >= 15:
+                idle = 0.0
+                yield ": keepalive\n\n"
+            time.sleep(interval)
+            idle += interval
+
+    def publish(self):
+        """Save the changed partials of this process for other workers."""
+        partials = []
+        for aggregate in list(self._aggregates.values()):
+            if aggregate.dirty:
+                aggregate.dirty = False
+                partials.append((
+                    self._partial_id(aggregate.experiment_id),
+                    LIVE_KEY_PREFIX + aggregate.experiment_id,
+                    aggregate.to_state()
+                ))
+        if partials:
+            try:
+                self.storage.save_aggregates(partials)
+                self._published.update(partial_id for partial_id, _, _ in partials)
+            except Exception as e:
+                print(f"ERROR: Failed to publish live aggregates: {e}")
+                for aggregate in self._aggregates.values():
+                    aggregate.dirty = True
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            self.publish()
+
+    def close(self):
+        """Stop the publishing thread and delete this process's partials."""
+        self._stop.set()
+        self._thread.join()
+        if self._published:
+            try:
+                self.storage.delete_aggregates(sorted(self._published))
+            except Exception as e:
+                print(f"ERROR: Failed to delete live aggregates: {e}")
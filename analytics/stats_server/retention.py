@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Retention of old experiment data: roll up, verify, drop raw events.
+
+Experiments whose last event is older than their rule's max_age_days are
+compacted: their raw events are rolled up into resolution_s interval rows
+plus the QoE summary (see rollup.py), the roll-up is written, read back and
+verified against the raw events, and only then are the raw events dropped
+(the metrics-{experiment_id} collection in MongoDB, the experiment's rows in
+SQLite). /api/summary and /api/rollups keep answering from the roll-up.
+
+Rules come from the JSON file at RETENTION_POLICY_FILE:
+
+    {
+        "default": {"max_age_days": 30, "resolution_s": 1},
+        "experiments": {
+            "scratch_": {"max_age_days": 1},
+            "paper_": {"max_age_days": null}
+        }
+    }
+
+"experiments" overrides apply to experiment ids starting with the given
+prefix, longest prefix last; a null max_age_days keeps raw events forever,
+as does a missing "default". The stats server runs the job every
+RETENTION_INTERVAL_S seconds when a policy file is set. Every gunicorn
+worker runs it; a per-experiment claim in storage makes sure only one of
+them compacts an experiment. It can also be run by hand:
+
+    docker exec stats_server python3 retention.py --dry-run
+    docker exec stats_server python3 retention.py --experiment exp_001
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from rollup import RollupError, fill_bitrates, pack_chunks, verify_rollup
+import config
+
+# An in-progress claim older than this is taken over (the worker holding it died)
+CLAIM_TIMEOUT_S = 3600
+
+DEFAULT_RULE = {"max_age_days": None, "resolution_s": 1}
+
+# Outcome of an experiment whose raw events were dropped but which received
+# events since; they cannot be merged into the roll-up and are kept
+LATE_EVENTS = "late events kept"
+
+
+def parse_rule(rule, where):
+    """
+    Validate one retention rule.
+
+    Raises:
+        ValueError: If the rule is malformed
+    """
+    if not isinstance(rule, dict):
+        raise ValueError(f"{where} must be an object")
+    unknown = set(rule) - set(DEFAULT_RULE)
+    if unknown:
+        raise ValueError(f"{where}: unknown fields {', '.join(sorted(unknown))}")
+    max_age = rule.get("max_age_days")
+    if max_age is not None and (not isinstance(max_age, (int, float)) or max_age < 0):
+        raise ValueError(f"{where}.max_age_days must be a non-negative number or null")
+    resolution = rule.get("resolution_s", 1)
+    if not isinstance(resolution, int) or isinstance(resolution, bool) or resolution < 1:
+        raise ValueError(f"{where}.resolution_s must be a positive integer")
+    return rule
+
+
+class RetentionPolicy:
+    """Retention rules per experiment id prefix."""
+
+    def __init__(self, data=None):
+        """
+        Args:
+            data: Policy document (see module docstring), or None to keep
+                  everything
+
+        Raises:
+            ValueError: If the policy is malformed
+        """
+        data = data or {}
+        if not isinstance(data, dict):
+            raise ValueError("Retention policy must be a JSON object")
+        self.default = parse_rule(data.get("default", {}), "default")
+        experiments = data.get("experiments", {})
+        if not isinstance(experiments, dict):
+            raise ValueError("experiments must be an object of experiment id prefixes")
+        self.experiments = {
+            prefix: parse_rule(rule, f"experiments.{prefix}") for prefix, rule in experiments.items()
+        }
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a policy file."""
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def rule_for(self, experiment_id):
+        """
+        Retention rule of an experiment.
+
+        Returns:
+            Dict with max_age_days (None: keep forever) and resolution_s
+        """
+        rule = dict(DEFAULT_RULE, **self.default)
+        for prefix in sorted(self.experiments, key=len):
+            if experiment_id.startswith(prefix):
+                rule.update(self.experiments[prefix])
+        return rule
+
+
+def compact_experiment(storage, experiment_id, resolution_s):
+    """
+    Roll up an experiment, verify the roll-up and drop its raw events.
+
+    An experiment with a complete roll-up whose raw events were not dropped
+    (an interrupted run) has them dropped, or rolled up again if events
+    arrived after the roll-up.
+
+    Returns:
+        Number of raw events rolled up, None if another process holds the
+        experiment's claim, or LATE_EVENTS if its raw events were dropped
+        and it received events since
+
+    Raises:
+        RollupError: If verification failed; raw events are kept
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=CLAIM_TIMEOUT_S)
+    if not storage.claim_rollup(experiment_id, resolution_s, stale_before):
+        record, _ = storage.load_rollup(experiment_id, with_chunks=False)
+        if record is None or record["status"] != "complete":
+            return None
+        if record.get("raw_dropped"):
+            return LATE_EVENTS
+        if storage.count_metrics(experiment_id) == record["event_count"]:
+            _drop_metrics(storage, experiment_id)
+            return 0
+        # Events arrived after the roll-up: roll up all raw events again
+        storage.delete_rollup(experiment_id)
+        if not storage.claim_rollup(experiment_id, resolution_s, stale_before):
+            return None
+
+    try:
+        storage.flush()
+        summary = storage.summarize(experiment_id)
+        if summary["event_count"] == 0:
+            raise RollupError("experiment has no raw events")
+        rows = storage.rollup_rows(experiment_id, resolution_s)
+        fill_bitrates(rows, storage.iter_metrics(experiment_id, event_type="quality_change_rendered"))
+        chunks = pack_chunks(experiment_id, rows)
+        verify_rollup(summary, resolution_s, chunks)
+
+        record = {
+            "status": "in_progress",
+            "resolution_s": resolution_s,
+            "event_count": summary["event_count"],
+            "summary": summary,
+            "rolled_up_at": datetime.utcnow()
+        }
+        storage.save_rollup(experiment_id, record, chunks)
+
+        # Verify what was written, and that no events arrived meanwhile
+        # (whatever their timestamps)
+        _, saved_chunks = storage.load_rollup(experiment_id)
+        verify_rollup(summary, resolution_s, saved_chunks)
+        if storage.count_metrics(experiment_id) != summary["event_count"]:
+            raise RollupError("experiment received events during the roll-up")
+
+        storage.save_rollup(experiment_id, dict(record, status="complete"))
+    except Exception:
+        storage.delete_rollup(experiment_id)
+        raise
+
+    _drop_metrics(storage, experiment_id)
+    return summary["event_count"]
+
+
+def _drop_metrics(storage, experiment_id):
+    """Drop the raw events of a rolled-up experiment and note it in the roll-up."""
+    storage.drop_metrics(experiment_id)
+    storage.save_rollup(experiment_id, {"raw_dropped": True})
+
+
+def run_retention(storage, policy, now=None, dry_run=False):
+    """
+    Compact every experiment that is past its rule's max age.
+
+    Returns:
+        List of (experiment_id, outcome) for the experiments due, where
+        outcome is the number of events rolled up, "claimed" (another process
+        is compacting it), "due" (dry run), LATE_EVENTS or an error message
+    """
+    now = now if now is not None else time.time()
+    results = []
+    for experiment_id in storage.list_experiments():
+        rule = policy.rule_for(experiment_id)
+        if rule["max_age_days"] is None:
+            continue
+        last = storage.last_timestamp(experiment_id)
+        if last is None or now - last < rule["max_age_days"] * 86400:
+            continue
+        if dry_run:
+            results.append((experiment_id, "due"))
+            continue
+        try:
+            events = compact_experiment(storage, experiment_id, rule["resolution_s"])
+            results.append((experiment_id, "claimed" if events is None else events))
+        except Exception as e:
+            print(f"ERROR: Failed to compact experiment {experiment_id}: {e}")
+            results.append((experiment_id, f"error: {e}"))
+    return results
+
+
+class RetentionJob:
+    """Background thread running the retention policy periodically."""
+
+    def __init__(self, storage, policy, interval=config.RETENTION_INTERVAL_S):
+        """
+        Start the retention thread.
+
+        Args:
+            storage: Storage backend (see storage_base.BaseMetricsStorage)
+            policy: RetentionPolicy
+            interval: Seconds between runs
+        """
+        self.storage = storage
+        self.policy = policy
+        self.interval = interval
+        # Experiments reported with LATE_EVENTS (logged once per process)
+        self._late_reported = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+        storage.on_close(self.close)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                for experiment_id, outcome in run_retention(self.storage, self.policy):
+                    if isinstance(outcome, int):
+                        print(f"Rolled up {outcome} events of experiment {experiment_id}")
+                    elif outcome == LATE_EVENTS and experiment_id not in self._late_reported:
+                        self._late_reported.add(experiment_id)
+                        print(f"WARNING: Experiment {experiment_id} received events after its raw "
+                              "events were dropped; they are kept outside its roll-up")
+            except Exception as e:
+                print(f"ERROR: Retention run failed: {e}")
+
+    def close(self):
+        """Stop the retention thread (a running compaction finishes first)."""
+        self._stop.set()
+        self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Roll up and drop old experiment data")
+    parser.add_argument("--policy", default=config.RETENTION_POLICY_FILE,
+                        help="Retention policy file (default: RETENTION_POLICY_FILE)")
+    parser.add_argument("--experiment", action="append", default=[],
+                        help="Compact this experiment now, regardless of its age (repeatable)")
+    parser.add_argument("--resolution", type=int,
+                        help="Roll-up resolution in seconds for --experiment (default: from the policy)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only list the experiments that are due")
+    args = parser.parse_args()
+
+    try:
+        policy = RetentionPolicy.from_file(args.policy) if args.policy else RetentionPolicy()
+    except (OSError, ValueError) as e:
+        print(f"ERROR: Failed to load retention policy: {e}")
+        sys.exit(1)
+
+    from storage import create_storage
+    storage = create_storage()
+    failed = False
+    try:
+        if args.experiment:
+            results = []
+            for experiment_id in args.experiment:
+                resolution = args.resolution or policy.rule_for(experiment_id)["resolution_s"]
+                if args.dry_run:
+                    results.append((experiment_id, "due"))
+                    continue
+                try:
+                    events = compact_experiment(storage, experiment_id, resolution)
+                    results.append((experiment_id, "claimed" if events is None else events))
+                except Exception as e:
+                    results.append((experiment_id, f"error: {e}"))
+        else:
+            results = run_retention(storage, policy, dry_run=args.dry_run)
+    finally:
+        storage.close()
+
+    for experiment_id, outcome in results:
+        if isinstance(outcome, int):
+            print(f"✓ {experiment_id}: rolled up {outcome} events")
+        else:
+            print(f"{'✗' if outcome.startswith('error') else '-'} {experiment_id}: {outcome}")
+            failed = failed or outcome.startswith("error")
+    print(f"{len(results)} experiments {'due' if args.dry_run else 'processed'}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
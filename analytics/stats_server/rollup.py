@@ -0,0 +1,182 @@
+"""
+Compact roll-ups of an experiment's raw metric events.
+
+A roll-up keeps one row per resolution_s interval with the numbers the
+analyses need (event count, video buffer level range and mean, bitrate in
+effect, fragment throughput, rebuffer events), plus the experiment's QoE
+summary (see summary.py). Rows are packed column-wise into chunk documents
+of up to ROLLUP_CHUNK_ROWS rows:
+
+    {
+        "experiment_id": "exp_001",
+        "start": 1234567860.0,          # t of the first row
+        "columns": {"t": [...], "events": [...], "buffer_min_s": [...], ...}
+    }
+
+A two-hour experiment at 1 s resolution is 2 chunks instead of hundreds of
+thousands of event documents. retention.py rolls up old experiments and
+drops their raw events; backends compute the interval rows with
+build_rollup_pipeline() (MongoDB) or ROLLUP_SQL (SQLite).
+"""
+
+# Row fields, in column order. buffer_*_s cover video buffer levels only;
+# bitrate_bps is the bitrate in effect at the end of the interval
+ROLLUP_COLUMNS = (
+    "t", "events", "buffer_min_s", "buffer_max_s", "buffer_avg_s", "bitrate_bps",
+    "fragments", "fragment_bytes", "fragment_download_ms", "rebuffers"
+)
+
+# Rows per chunk document (one hour at 1 s resolution)
+ROLLUP_CHUNK_ROWS = 3600
+
+
+class RollupError(Exception):
+    """Raised when a roll-up does not match the raw events it summarizes."""
+
+
+def _is_video_buffer():
+    """Pipeline expression: true for video buffer level events."""
+    return {"$and": [
+        {"$eq": ["$event_type", "buffer_level_updated"]},
+        {"$eq": [{"$ifNull": ["$payload.media_type", "video"]}, "video"]}
+    ]}
+
+
+def _when(condition, value, otherwise=None):
+    return {"$cond": [condition, value, otherwise]}
+
+
+def build_rollup_pipeline(resolution_s):
+    """
+    Build the aggregation pipeline producing one row per interval.
+
+    Coalesced buffer level events (see client_policy.py) contribute their
+    window minimum and maximum.
+
+    Returns:
+        List of pipeline stages; each output document is a row without
+        bitrate_bps, with the interval start in _id
+    """
+    is_fragment = {"$eq": ["$event_type", "fragment_loading_completed"]}
+    return [
+        {"$group": {
+            "_id": {"$multiply": [{"$floor": {"$divide": ["$timestamp", resolution_s]}}, resolution_s]},
+            "events": {"$sum": 1},
+            "buffer_min_s": {"$min": _when(
+                _is_video_buffer(), {"$ifNull": ["$payload.buffer_level_min", "$payload.buffer_level"]}
+            )},
+            "buffer_max_s": {"$max": _when(
+                _is_video_buffer(), {"$ifNull": ["$payload.buffer_level_max", "$payload.buffer_level"]}
+            )},
+            "buffer_avg_s": {"$avg": _when(_is_video_buffer(), "$payload.buffer_level")},
+            "fragments": {"$sum": _when(is_fragment, {"$ifNull": ["$payload.coalesced_count", 1]}, 0)},
+            "fragment_bytes": {"$sum": _when(is_fragment, {"$ifNull": ["$payload.bytes_loaded", 0]}, 0)},
+            "fragment_download_ms": {"$sum": _when(
+                is_fragment, {"$ifNull": ["$payload.download_ms", 0]}, 0
+            )},
+            "rebuffers": {"$sum": _when({"$eq": ["$event_type", "rebuffer_event"]}, 1, 0)}
+        }},
+        {"$sort": {"_id": 1}}
+    ]
+
+
+_VIDEO_BUFFER = ("event_type = 'buffer_level_updated' "
+                 "AND COALESCE(json_extract(payload, '$.media_type'), 'video') = 'video'")
+_FRAGMENT = "event_type = 'fragment_loading_completed'"
+
+# SQLite equivalent of build_rollup_pipeline; parameters are
+# (resolution_s, resolution_s, experiment_id)
+ROLLUP_SQL = f"""
+    SELECT CAST(timestamp / ? AS INTEGER) * ? AS t,
+           COUNT(*),
+           MIN(CASE WHEN {_VIDEO_BUFFER} THEN COALESCE(json_extract(payload, '$.buffer_level_min'),
+                                                      json_extract(payload, '$.buffer_level')) END),
+           MAX(CASE WHEN {_VIDEO_BUFFER} THEN COALESCE(json_extract(payload, '$.buffer_level_max'),
+                                                      json_extract(payload, '$.buffer_level')) END),
+           AVG(CASE WHEN {_VIDEO_BUFFER} THEN json_extract(payload, '$.buffer_level') END),
+           TOTAL(CASE WHEN {_FRAGMENT} THEN COALESCE(json_extract(payload, '$.coalesced_count'), 1) END),
+           TOTAL(CASE WHEN {_FRAGMENT} THEN json_extract(payload, '$.bytes_loaded') END),
+           TOTAL(CASE WHEN {_FRAGMENT} THEN json_extract(payload, '$.download_ms') END),
+           TOTAL(event_type = 'rebuffer_event')
+    FROM metrics WHERE experiment_id = ?
+    GROUP BY t ORDER BY t
+"""
+
+
+def fill_bitrates(rows, quality_changes):
+    """
+    Set bitrate_bps of each row to the bitrate in effect at its end.
+
+    Args:
+        rows: Rows in t order
+        quality_changes: quality_change_rendered documents in timestamp order
+    """
+    changes = iter(quality_changes)
+    change = next(changes, None)
+    bitrate = None
+    for index, row in enumerate(rows):
+        end = rows[index + 1]["t"] if index + 1 < len(rows) else float("inf")
+        while change is not None and change["timestamp"] < end:
+            bitrate = (change.get("payload") or {}).get("bitrate", bitrate)
+            change = next(changes, None)
+        row["bitrate_bps"] = bitrate
+
+
+def pack_chunks(experiment_id, rows):
+    """
+    Pack rows column-wise into chunk documents.
+
+    Returns:
+        List of chunk dicts (see module docstring)
+    """
+    chunks = []
+    for offset in range(0, len(rows), ROLLUP_CHUNK_ROWS):
+        chunk_rows = rows[offset:offset + ROLLUP_CHUNK_ROWS]
+        chunks.append({
+            "experiment_id": experiment_id,
+            "start": chunk_rows[0]["t"],
+            "columns": {column: [row.get(column) for row in chunk_rows] for column in ROLLUP_COLUMNS}
+        })
+    return chunks
+
+
+def unpack_columns(chunks):
+    """
+    Concatenate the columns of chunks in start order.
+
+    Returns:
+        Dict of column name -> list of values
+    """
+    columns = {column: [] for column in ROLLUP_COLUMNS}
+    for chunk in sorted(chunks, key=lambda chunk: chunk["start"]):
+        for column in ROLLUP_COLUMNS:
+            columns[column].extend(chunk["columns"][column])
+    return columns
+
+
+def verify_rollup(summary, resolution_s, chunks):
+    """
+    Check roll-up chunks against the summary of the raw events.
+
+    The summary is computed from the raw events independently of the
+    roll-up (summary pipeline or compute_facets), so matching event counts
+    and time bounds mean no events were lost.
+
+    Raises:
+        RollupError: If they do not match
+    """
+    columns = unpack_columns(chunks)
+    events = sum(columns["events"])
+    if events != summary["event_count"]:
+        raise RollupError(f"roll-up has {events} events, raw metrics have {summary['event_count']}")
+    if not events:
+        return
+    times = columns["t"]
+    if times != sorted(times) or len(set(times)) != len(times):
+        raise RollupError("roll-up rows are not in time order")
+    # Interval starts are computed in floating point on the database side
+    epsilon = 1e-6
+    if not times[0] - epsilon <= summary["first_timestamp"] < times[0] + resolution_s + epsilon:
+        raise RollupError("roll-up does not start at the first raw event")
+    if not times[-1] - epsilon <= summary["last_timestamp"] < times[-1] + resolution_s + epsilon:
+        raise RollupError("roll-up does not end at the last raw event")
@@ -2,18 +2,118 @@
 HTTP routes for stats server.
 """
 
-from flask import request, jsonify
-from storage import MetricsStorage
+from flask import request, jsonify, Response
+from write_queue import QueueFullError
+from exporters import iter_export, json_default, EXPORT_FORMATS
+from codec import decode_body, PayloadError
+from instrumentation import STATS
+from rollup import unpack_columns
 import traceback
+import base64
+import os
+import json
+import config
 
 
-def register_routes(app, storage):
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Retry-After (seconds) when all live stream slots are taken
+LIVE_STREAMS_RETRY_AFTER_S = 10
+
+
+REQUIRED_FIELDS = ["experiment_id", "timestamp", "event_type", "protocol", "payload"]
+
+
+def validate_metric(data):
+    """
+    Check that a metric event has all required fields.
+    
+    Returns:
+        Error message, or None if the event is valid
+    """
+    if not isinstance(data, dict):
+        return "Metric event must be a JSON object"
+    for field in REQUIRED_FIELDS:
+        if field not in data:
+            return f"Missing required field: {field}"
+    if "seq" in data:
+        seq = data["seq"]
+        if not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+            return "seq must be a non-negative integer"
+        if not isinstance(data.get("session_id"), str):
+            return "seq requires a session_id string"
+    return None
+
+
+def encode_cursor(metric):
+    """Encode the (timestamp, _id) keyset position of a metric as an opaque token."""
+    position = json.dumps([metric["timestamp"], str(metric["_id"])])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(token):
+    """
+    Decode a token produced by encode_cursor.
+    
+    Returns:
+        Tuple of (timestamp, id string)
+    
+    Raises:
+        ValueError: If the token is malformed
+    """
+    try:
+        timestamp, metric_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except Exception:
+        raise ValueError(f"Invalid cursor: {token}")
+    if not isinstance(timestamp, (int, float)) or not isinstance(metric_id, str):
+        raise ValueError(f"Invalid cursor: {token}")
+    return timestamp, metric_id
+
+
+def stream_ndjson(metrics):
+    """Yield metric documents as newline-delimited JSON, one line at a time."""
+    try:
+        for metric in metrics:
+            yield json.dumps(metric, default=json_default, separators=(",", ":")) + "\n"
+    except Exception as e:
+        # Headers are already sent; the client sees a truncated stream
+        print(f"ERROR while streaming metrics: {e}")
+        print(traceback.format_exc())
+
+
+def stream_export(chunks):
+    """Pass export chunks through, logging errors that truncate the stream."""
+    try:
+        for chunk in chunks:
+            yield chunk
+    except Exception as e:
+        # Headers are already sent; the client sees a truncated file
+        print(f"ERROR while streaming export: {e}")
+        print(traceback.format_exc())
+        raise
+
+
+def queue_full_response(error):
+    """Build the 503 response returned when the write-behind queue is full."""
+    response = jsonify({
+        "error": "Stats server is overloaded, retry later",
+        "retry_after": error.retry_after
+    })
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 503
+
+
+def register_routes(app, storage, live, aggregator, client_policy, comparer):
     """
     Register routes with Flask app.
     
     Args:
         app: Flask application instance
-        storage: MetricsStorage instance
+        storage: Storage backend (see storage_base.BaseMetricsStorage)
+        live: LiveAggregates fed by the storage backend
+        aggregator: Aggregator fed by the storage backend
+        client_policy: ClientPolicy served to players
+        comparer: ExperimentComparer for /api/compare
     """
     
     @app.route("/api/submit", methods=["POST"])
@@ -28,20 +128,27 @@ def register_routes(app, storage):
             "event_type": "fragment_loading_completed",
             "protocol": "dash",
             "video_id": "http://...",
-            "payload": {...}
+            "payload": {...},
+            "session_id": "...",   (optional, with seq)
+            "seq": 42              (optional per-session sequence number)
         }
+        
+        Events with a session_id and seq that were already stored are
+        acknowledged without being stored again.
+        
+        The body may also be MessagePack or CBOR (per Content-Type) and
+        gzip/deflate compressed (per Content-Encoding).
         """
         try:
-            data = request.get_json()
+            data = decode_body(request)
             
             if not data:
                 return jsonify({"error": "No JSON data provided"}), 400
             
             # Validate required fields
-            required_fields = ["experiment_id", "timestamp", "event_type", "protocol", "payload"]
-            for field in required_fields:
-                if field not in data:
-                    return jsonify({"error": f"Missing required field: {field}"}), 400
+            error = validate_metric(data)
+            if error:
+                return jsonify({"error": error}), 400
             
             # Store metric
             storage.store_metric(
@@ -50,35 +157,349 @@ def register_routes(app, storage):
                 protocol=data["protocol"],
                 video_id=data.get("video_id", "unknown"),
                 payload=data["payload"],
-                timestamp=data["timestamp"]
+                timestamp=data["timestamp"],
+                session_id=data.get("session_id"),
+                seq=data.get("seq")
             )
             
+            if storage.async_writes:
+                return jsonify({"status": "queued"}), 202
             return jsonify({"status": "success"}), 200
         
+        except PayloadError as e:
+            return jsonify({"error": str(e)}), e.status
+        
+        except QueueFullError as e:
+            return queue_full_response(e)
+        
         except Exception as e:
             print(f"ERROR in /api/submit: {e}")
             print(traceback.format_exc())
             return jsonify({"error": str(e)}), 500
     
+    @app.route("/api/submit_batch", methods=["POST"])
+    def submit_metric_batch():
+        """
+        Receive and store a batch of metric events from a client.
+        
+        Expected JSON format (a bare array of events is also accepted):
+        {
+            "common": {"experiment_id": "exp_001", "protocol": "dash", ...},
+            "events": [
+                {"timestamp": ..., "event_type": ..., "payload": {...}},
+                ...
+            ]
+        }
+        
+        The optional "common" fields are session constants sent once per
+        batch and applied to every event (fields in an event take
+        precedence). After merging, each event has the same format as
+        /api/submit. The batch is rejected as a whole if any event is
+        invalid. Duplicate events (by session_id and seq) are skipped and
+        counted in "duplicates". Bodies may be JSON, MessagePack or CBOR
+        and gzip/deflate compressed, as for /api/submit.
+        """
+        try:
+            data = decode_body(request)
+            
+            common = {}
+            if isinstance(data, dict):
+                events = data.get("events")
+                common = data.get("common") or {}
+            else:
+                events = data
+            
+            if not isinstance(events, list) or not events:
+                return jsonify({"error": "No events provided"}), 400
+            
+            if not isinstance(common, dict):
+                return jsonify({"error": "common must be an object"}), 400
+            
+            if len(events) > config.MAX_BATCH_SIZE:
+                return jsonify({
+                    "error": f"Batch too large: {len(events)} events (max {config.MAX_BATCH_SIZE})"
+                }), 413
+            
+            if common:
+                events = [
+                    {**common, **event} if isinstance(event, dict) else event
+                    for event in events
+                ]
+            
+            # Validate every event before storing any of them
+            for index, event in enumerate(events):
+                error = validate_metric(event)
+                if error:
+                    return jsonify({"error": f"Event {index}: {error}"}), 400
+            
+            stored = storage.store_metrics(events)
+            duplicates = len(events) - stored
+            
+            if storage.async_writes:
+                return jsonify({"status": "queued", "count": stored, "duplicates": duplicates}), 202
+            return jsonify({"status": "success", "count": stored, "duplicates": duplicates}), 200
+        
+        except PayloadError as e:
+            return jsonify({"error": str(e)}), e.status
+        
+        except QueueFullError as e:
+            return queue_full_response(e)
+        
+        except Exception as e:
+            print(f"ERROR in /api/submit_batch: {e}")
+            print(traceback.format_exc())
+            return jsonify({"error": str(e)}), 500
+    
     @app.route("/api/health", methods=["GET"])
     def health_check():
         """Health check endpoint."""
         try:
-            # Try to ping MongoDB
-            storage.db.command('ping')
+            # Try to ping the database
+            storage.ping()
             return jsonify({
                 "status": "healthy",
                 "service": "stats_server",
-                "mongodb": "connected"
+                storage.backend: "connected"
             }), 200
         except Exception as e:
             return jsonify({
                 "status": "unhealthy",
                 "service": "stats_server",
-                "mongodb": "disconnected",
+                storage.backend: "disconnected",
                 "error": str(e)
             }), 503
     
+    @app.route("/api/client_policy", methods=["GET"])
+    def get_client_policy():
+        """
+        Return the metric coalescing rules players should apply.
+        
+        Query parameters:
+            experiment_id: Experiment the player reports to (selects
+                           per-experiment overrides)
+        """
+        experiment_id = request.args.get("experiment_id", "")
+        return jsonify({
+            "experiment_id": experiment_id,
+            "rules": client_policy.rules_for(experiment_id)
+        }), 200
+    
+    @app.route("/api/internal/stats", methods=["GET"])
+    def internal_stats():
+        """
+        Report the server's own hot-path metrics.
+        
+        Counters and histograms are kept per process: with several gunicorn
+        workers, each request is answered by one worker (see "pid").
+        Latencies are in microseconds, sizes in bytes.
+        """
+        stats = STATS.snapshot()
+        stats["pid"] = os.getpid()
+        if storage.async_writes:
+            stats["write_queue"] = {
+                "depth": storage.write_queue.depth(),
+                "max_size": storage.write_queue.max_size
+            }
+        return jsonify(stats), 200
+    
+    @app.route("/api/live/<experiment_id>", methods=["GET"])
+    def live_aggregates(experiment_id):
+        """
+        Push rolling QoE aggregates of an experiment as Server-Sent Events.
+        
+        Query parameters:
+            format: "json" for a single snapshot instead of a stream
+        """
+        if request.args.get("format") == "json":
+            snapshot = live.snapshot(experiment_id)
+            if snapshot is None:
+                return jsonify({"error": f"No recent events for experiment {experiment_id}"}), 404
+            return jsonify(snapshot), 200
+        
+        return live_stream([experiment_id])
+    
+    @app.route("/api/live", methods=["GET"])
+    def live_aggregates_many():
+        """
+        Push rolling QoE aggregates of several experiments over one
+        Server-Sent Events stream, so a dashboard holds one connection (and
+        one server thread) however many experiments it shows.
+        
+        Query parameters:
+            ids: Comma-separated experiment ids (required)
+            format: "json" for a single list of snapshots instead of a stream
+        """
+        experiment_ids = list(dict.fromkeys(i for i in request.args.get("ids", "").split(",") if i))
+        if not experiment_ids:
+            return jsonify({"error": "ids is required"}), 400
+        if len(experiment_ids) > config.LIVE_MAX_STREAM_EXPERIMENTS:
+            return jsonify({
+                "error": f"Too many experiments (max {config.LIVE_MAX_STREAM_EXPERIMENTS})"
+            }), 400
+        
+        if request.args.get("format") == "json":
+            snapshots = [live.snapshot(experiment_id) for experiment_id in experiment_ids]
+            return jsonify([snapshot for snapshot in snapshots if snapshot is not None]), 200
+        
+        return live_stream(experiment_ids)
+    
+    def live_stream(experiment_ids):
+        """Server-Sent Events response streaming live snapshots of experiments."""
+        # Each stream holds a server thread; refuse rather than starve ingest
+        if not live.open_stream():
+            response = jsonify({
+                "error": f"Too many live streams (max {live.max_streams} per process), retry later",
+                "retry_after": LIVE_STREAMS_RETRY_AFTER_S
+            })
+            response.headers["Retry-After"] = str(LIVE_STREAMS_RETRY_AFTER_S)
+            return response, 503
+        
+        response = Response(live.stream(experiment_ids), mimetype="text/event-stream")
+        response.call_on_close(live.close_stream)
+        response.headers["Cache-Control"] = "no-cache"
+        # Disable response buffering in reverse proxies (nginx)
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+    
+    @app.route("/api/aggregates/<experiment_id>", methods=["GET"])
+    def get_aggregates(experiment_id):
+        """
+        Return incrementally maintained QoE aggregates of an experiment.
+        
+        Same numbers as /api/summary without scanning raw events; buffer
+        level percentiles come from a histogram sketch.
+        """
+        try:
+            aggregates = aggregator.get(experiment_id)
+            if aggregates["event_count"] == 0:
+                return jsonify({"error": f"No aggregates for experiment {experiment_id}"}), 404
+            return jsonify(aggregates), 200
+        
+        except Exception as e:
+            print(f"ERROR in /api/aggregates: {e}")
+            print(traceback.format_exc())
+            return jsonify({"error": str(e)}), 500
+    
+    @app.route("/api/rollups/<experiment_id>", methods=["GET"])
+    def get_rollup(experiment_id):
+        """
+        Return the roll-up of an experiment compacted by the retention job.
+        
+        Rows are returned column-wise: columns[name][i] is field name of
+        the i-th resolution_s interval (see rollup.ROLLUP_COLUMNS).
+        """
+        try:
+            record, chunks = storage.load_rollup(experiment_id)
+            if record is None or record["status"] != "complete":
+                return jsonify({"error": f"No roll-up for experiment {experiment_id}"}), 404
+            return jsonify({
+                "experiment_id": experiment_id,
+                "resolution_s": record["resolution_s"],
+                "event_count": record["event_count"],
+                "rolled_up_at": record["rolled_up_at"].isoformat(),
+                "summary": record["summary"],
+                "columns": unpack_columns(chunks)
+            }), 200
+        
+        except Exception as e:
+            print(f"ERROR in /api/rollups: {e}")
+            print(traceback.format_exc())
+            return jsonify({"error": str(e)}), 500
+    
+    @app.route("/api/summary/<experiment_id>", methods=["GET"])
+    def get_summary(experiment_id):
+        """
+        Compute QoE summary numbers for an experiment.
+        
+        Returns startup delay, rebuffer count and total stall time,
+        time-weighted average bitrate, switch count and buffer level
+        percentiles, computed by an aggregation pipeline in MongoDB.
+        Experiments compacted by the retention job answer with the summary
+        saved in their roll-up.
+        """
+        try:
+            summary = storage.load_summary(experiment_id)
+            if summary["event_count"] == 0:
+                return jsonify({"error": f"No metrics for experiment: {experiment_id}"}), 404
+            return jsonify(summary), 200
+        
+        except Exception as e:
+            print(f"ERROR in /api/summary: {e}")
+            print(traceback.format_exc())
+            return jsonify({"error": str(e)}), 500
+    
+    @app.route("/api/compare", methods=["GET"])
+    def compare_experiments():
+        """
+        Compare QoE summaries of several experiments in one table.
+        
+        Summaries are computed concurrently, so the request takes about as
+        long as the slowest experiment.
+        
+        Query parameters:
+        - ids: Comma-separated experiment ids (required)
+        - metric: Comma-separated summary metrics, dotted for nested fields
+                  (e.g. buffer_level_percentiles_s.p50); default: all
+        """
+        try:
+            experiment_ids = [i for i in request.args.get("ids", "").split(",") if i]
+            metrics = [m for m in request.args.get("metric", "").split(",") if m]
+            if not experiment_ids:
+                return jsonify({"error": "ids is required"}), 400
+            if len(experiment_ids) > config.MAX_COMPARE_EXPERIMENTS:
+                return jsonify({
+                    "error": f"At most {config.MAX_COMPARE_EXPERIMENTS} experiments can be compared"
+                }), 400
+            
+            try:
+                comparison = comparer.compare(experiment_ids, metrics)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            return jsonify(comparison), 200
+        
+        except Exception as e:
+            print(f"ERROR in /api/compare: {e}")
+            print(traceback.format_exc())
+            return jsonify({"error": str(e)}), 500
+    
+    @app.route("/api/export/<experiment_id>", methods=["GET"])
+    def export_metrics(experiment_id):
+        """
+        Stream a full export of an experiment in a file format.
+        
+        Query parameters:
+        - format: One of exporters.EXPORT_FORMATS (default: json)
+        
+        The export is encoded chunk by chunk from the database cursor, so it
+        can be written straight to disk by the client.
+        """
+        export_format = request.args.get("format", "json")
+        if not storage.flush(config.FLUSH_TIMEOUT_S):
+            # Queued writes are still being written; an export now would miss them
+            retry_after = max(1, round(config.FLUSH_TIMEOUT_S))
+            response = jsonify({
+                "error": "Queued metrics are still being written, retry later",
+                "retry_after": retry_after
+            })
+            response.headers["Retry-After"] = str(retry_after)
+            return response, 503
+        try:
+            chunks = iter_export(storage.iter_metrics(experiment_id), export_format)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 501
+        except Exception as e:
+            print(f"ERROR in /api/export: {e}")
+            return jsonify({"error": str(e)}), 500
+        
+        filename = f"metrics.{EXPORT_FORMATS[export_format]}"
+        return Response(
+            stream_export(chunks),
+            mimetype="application/octet-stream",
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
+    
     @app.route("/api/metrics/<experiment_id>", methods=["GET"])
     def get_metrics(experiment_id):
         """
@@ -88,31 +509,78 @@ def register_routes(app, storage):
         - event_type: Filter by event type
         - start_time: Start timestamp filter
         - end_time: End timestamp filter
+        - format: "json" (default) or "ndjson" to stream one document per line
+        - limit: Return at most this many documents plus a next_cursor
+        - cursor: Opaque next_cursor from a previous page
+        - batch_size: Documents per database cursor batch when streaming
         """
         try:
             event_type = request.args.get("event_type")
             start_time = request.args.get("start_time", type=float)
             end_time = request.args.get("end_time", type=float)
+            output_format = request.args.get("format", "json")
+            limit = request.args.get("limit", type=int)
+            batch_size = request.args.get("batch_size", type=int)
+            
+            after = None
+            if request.args.get("cursor"):
+                try:
+                    after_timestamp, after_id = decode_cursor(request.args["cursor"])
+                    after = (after_timestamp, storage.parse_metric_id(after_id))
+                except ValueError:
+                    return jsonify({"error": "Invalid cursor"}), 400
             
-            metrics = storage.get_metrics(
+            if limit is not None and not 0 < limit <= config.MAX_PAGE_SIZE:
+                return jsonify({
+                    "error": f"limit must be between 1 and {config.MAX_PAGE_SIZE}"
+                }), 400
+            
+            query = dict(
                 experiment_id=experiment_id,
                 event_type=event_type,
                 start_time=start_time,
-                end_time=end_time
+                end_time=end_time,
+                after=after,
+                batch_size=batch_size
             )
             
+            if output_format == "ndjson" or request.accept_mimetypes.best == NDJSON_MIMETYPE:
+                metrics = storage.iter_metrics(limit=limit, **query)
+                return Response(stream_ndjson(metrics), mimetype=NDJSON_MIMETYPE)
+            
+            if limit is not None:
+                # Fetch one extra document to know whether another page exists
+                metrics = list(storage.iter_metrics(limit=limit + 1, **query))
+                next_cursor = None
+                if len(metrics) > limit:
+                    metrics = metrics[:limit]
+                    next_cursor = encode_cursor(metrics[-1])
+            elif after is not None:
+                metrics = list(storage.iter_metrics(**query))
+                next_cursor = None
+            else:
+                metrics = storage.get_metrics(
+                    experiment_id=experiment_id,
+                    event_type=event_type,
+                    start_time=start_time,
+                    end_time=end_time
+                )
+                next_cursor = None
+            
             # Convert ObjectId to string
             for metric in metrics:
                 if "_id" in metric:
                     metric["_id"] = str(metric["_id"])
             
-            return jsonify({
+            response = {
                 "experiment_id": experiment_id,
                 "count": len(metrics),
                 "metrics": metrics
-            }), 200
+            }
+            if limit is not None:
+                response["next_cursor"] = next_cursor
+            return jsonify(response), 200
         
         except Exception as e:
             print(f"ERROR in /api/metrics: {e}")
             return jsonify({"error": str(e)}), 500
-
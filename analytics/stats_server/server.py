@@ -3,44 +3,81 @@ Stats Server - Receives and stores playback metrics from clients.
 
 This server follows the MMSys'24 stats-server approach:
 - Receives JSON metrics via POST requests
-- Stores metrics in MongoDB
+- Stores metrics in MongoDB (or an embedded SQLite database)
 - No Prometheus/Grafana dependencies
 """
 
+import signal
+import sys
 from flask import Flask
 from flask_cors import CORS
-from storage import MetricsStorage
+from storage import create_storage
 from routes import register_routes
+from instrumentation import register_instrumentation
+from live import LiveAggregates
+from aggregator import Aggregator
+from client_policy import ClientPolicy
+from compare import ExperimentComparer
+from retention import RetentionPolicy, RetentionJob
 import config
 
 
-def create_app():
-    """Create and configure Flask application."""
+def create_app(storage=None):
+    """
+    Create and configure Flask application.
+    
+    Args:
+        storage: Optional storage instance to use instead of the backend
+                 selected by config.STORAGE_BACKEND (e.g. for tests)
+    
+    Returns:
+        Tuple of (Flask app, storage)
+    """
     app = Flask(__name__)
     
-    # Enable CORS for all routes
-    CORS(app)
+    # Enable CORS for all routes; players read Retry-After to back off
+    CORS(app, expose_headers=["Retry-After"])
     
     # Initialize storage
-    try:
-        storage = MetricsStorage()
-    except Exception as e:
-        print(f"FATAL: Failed to initialize storage: {e}")
-        raise
+    if storage is None:
+        try:
+            storage = create_storage()
+        except Exception as e:
+            print(f"FATAL: Failed to initialize storage: {e}")
+            raise
+    
+    # Record per-route request counts, latencies and body sizes
+    register_instrumentation(app)
+    
+    # Rolling and cumulative per-experiment aggregates, updated on ingest
+    live = LiveAggregates(storage)
+    aggregator = Aggregator(storage)
+    
+    # Coalescing rules for players (CLIENT_POLICY_FILE)
+    client_policy = ClientPolicy(config.CLIENT_POLICY_FILE)
+    
+    # Concurrent per-experiment summaries for /api/compare
+    comparer = ExperimentComparer(storage)
+    
+    # Roll up and drop raw events of old experiments (RETENTION_POLICY_FILE)
+    if config.RETENTION_POLICY_FILE:
+        RetentionJob(storage, RetentionPolicy.from_file(config.RETENTION_POLICY_FILE))
+        print(f"Retention enabled (policy {config.RETENTION_POLICY_FILE})")
     
     # Register routes
-    register_routes(app, storage)
+    register_routes(app, storage, live, aggregator, client_policy, comparer)
     
     return app, storage
 
 
-if __name__ == "__main__":
-    print("=== Stats Server Starting ===")
-    print(f"MongoDB: {config.MONGO_HOST}:{config.MONGO_PORT}")
-    print(f"Server: {config.SERVER_HOST}:{config.SERVER_PORT}")
-    
+def run_development_server():
+    """Run the Flask built-in server in this process."""
     app, storage = create_app()
     
+    # Turn SIGTERM (docker stop) into a normal exit so queued writes are
+    # flushed in the finally block below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
     try:
         app.run(
             host=config.SERVER_HOST,
@@ -52,3 +89,58 @@ if __name__ == "__main__":
     finally:
         storage.close()
 
+
+def run_gunicorn_server():
+    """
+    Run a pre-fork gunicorn server.
+    
+    The app is created inside each worker after the fork (no preload), so
+    every worker owns exactly one MongoClient connection pool and its own
+    write-behind flusher thread. Storage is closed when a worker exits.
+    """
+    from gunicorn.app.base import BaseApplication
+    
+    class StatsServerApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            self.storage = None
+            super().__init__()
+        
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            app, self.storage = create_app()
+            return app
+    
+    def close_worker_storage(server, worker):
+        if worker.app.storage is not None:
+            worker.app.storage.close()
+    
+    options = {
+        "bind": f"{config.SERVER_HOST}:{config.SERVER_PORT}",
+        "workers": config.SERVER_WORKERS,
+        "threads": config.SERVER_THREADS,
+        "worker_class": "gthread",
+        "timeout": config.SERVER_TIMEOUT_S,
+        "preload_app": False,
+        "worker_exit": close_worker_storage,
+    }
+    
+    print(f"Workers: {config.SERVER_WORKERS} x {config.SERVER_THREADS} threads")
+    StatsServerApplication(options).run()
+
+
+if __name__ == "__main__":
+    print("=== Stats Server Starting ===")
+    print(f"MongoDB: {config.MONGO_HOST}:{config.MONGO_PORT}")
+    print(f"Server: {config.SERVER_HOST}:{config.SERVER_PORT} ({config.SERVER_MODE})")
+    
+    if config.SERVER_MODE == "gunicorn":
+        run_gunicorn_server()
+    elif config.SERVER_MODE == "development":
+        run_development_server()
+    else:
+        print(f"FATAL: Unknown SERVER_MODE: {config.SERVER_MODE}")
+        sys.exit(1)
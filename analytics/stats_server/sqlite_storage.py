@@ -0,0 +1,527 @@
+"""
+Embedded SQLite storage backend for metrics.
+
+Selected with STORAGE_BACKEND=sqlite: metrics go to a single SQLite database
+file (SQLITE_PATH) instead of MongoDB, so small deployments need no external
+services. The database runs in WAL mode, so readers never block the writer
+and several gunicorn workers can share the file; each batch is written in a
+single transaction.
+
+All experiments share one metrics table:
+
+    metrics(id INTEGER PRIMARY KEY, experiment_id, timestamp, event_type,
+            protocol, video_id, payload, stored_at, session_id, seq)
+
+with payload stored as JSON text. The (experiment_id, timestamp) and
+(experiment_id, event_type, timestamp) indexes serve the time/event filters
+and the (timestamp, id) ordering of iter_metrics (the rowid id is implicitly
+the last index column). Document ids are the integer row ids. A unique
+(session_id, seq) index rejects duplicate events from player retries.
+"""
+
+import json
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from storage_base import BaseMetricsStorage
+from summary import compute_facets, build_summary
+from rollup import ROLLUP_SQL
+from instrumentation import STATS
+import config
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS metrics (
+        id INTEGER PRIMARY KEY,
+        experiment_id TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        event_type TEXT NOT NULL,
+        protocol TEXT,
+        video_id TEXT,
+        payload TEXT,
+        stored_at TEXT,
+        session_id TEXT,
+        seq INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS metrics_experiment_time "
+    "ON metrics (experiment_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS metrics_experiment_event_time "
+    "ON metrics (experiment_id, event_type, timestamp)",
+    # Last-resort protection against duplicate events the in-memory deduper misses
+    "CREATE UNIQUE INDEX IF NOT EXISTS metrics_session_seq "
+    "ON metrics (session_id, seq) WHERE session_id IS NOT NULL",
+    # Checkpointed partial aggregates (see aggregator.py)
+    """CREATE TABLE IF NOT EXISTS aggregates (
+        partial_id TEXT PRIMARY KEY,
+        experiment_id TEXT NOT NULL,
+        state TEXT NOT NULL,
+        updated_at TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS aggregates_experiment ON aggregates (experiment_id)",
+    # Roll-ups of compacted experiments (see retention.py); record holds the
+    # JSON roll-up fields, columns the JSON column chunk
+    """CREATE TABLE IF NOT EXISTS rollup_experiments (
+        experiment_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        claimed_at TEXT,
+        record TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS rollups (
+        experiment_id TEXT NOT NULL,
+        start REAL NOT NULL,
+        columns TEXT NOT NULL,
+        PRIMARY KEY (experiment_id, start)
+    )""",
+]
+
+# Columns added after the first release, created on databases that lack them
+MIGRATIONS = {
+    "session_id": "ALTER TABLE metrics ADD COLUMN session_id TEXT",
+    "seq": "ALTER TABLE metrics ADD COLUMN seq INTEGER",
+}
+
+_COLUMNS = ("id, experiment_id, timestamp, event_type, protocol, video_id, payload, "
+            "stored_at, session_id, seq")
+
+# Duplicate (session_id, seq) events are skipped
+_INSERT = (
+    "INSERT OR IGNORE INTO metrics (experiment_id, timestamp, event_type, protocol, "
+    "video_id, payload, stored_at, session_id, seq) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+class SQLiteMetricsStorage(BaseMetricsStorage):
+    """Metrics storage in an embedded SQLite database."""
+
+    backend = "sqlite"
+
+    def __init__(self, path):
+        """
+        Open (and create if needed) the database.
+
+        Args:
+            path: Database file path
+        """
+        self.path = path
+        # Idle connections; a request borrows one for each storage call, so
+        # open connections are bounded by concurrent calls, not by threads
+        self._idle = queue.LifoQueue(maxsize=config.SQLITE_POOL_SIZE)
+        # SQLite allows one writer at a time; queueing writers on a lock
+        # avoids the busy handler's sleep-and-retry between threads
+        self._write_lock = threading.Lock()
+
+        with self._connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute(SCHEMA[0])
+                columns = {row[1] for row in connection.execute("PRAGMA table_info(metrics)")}
+                for column, statement in MIGRATIONS.items():
+                    if column not in columns:
+                        connection.execute(statement)
+                for statement in SCHEMA[1:]:
+                    connection.execute(statement)
+        print(f"Opened SQLite database at {path}")
+
+        # Optional write-behind queue (see config.ASYNC_WRITES)
+        super().__init__()
+
+    @contextmanager
+    def _connection(self):
+        """
+        Borrow a connection from the pool, opening one if none is idle.
+
+        The connection goes back to the pool afterwards, or is closed if
+        SQLITE_POOL_SIZE connections are already idle.
+        """
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # WAL makes NORMAL durable against application crashes; only an
+            # OS crash can lose the last transactions
+            connection.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield connection
+        finally:
+            try:
+                self._idle.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+
+    def parse_metric_id(self, metric_id):
+        """Integer row id from its string form."""
+        return int(metric_id)
+
+    def ping(self):
+        """Check that the database can be queried."""
+        with self._connection() as connection:
+            connection.execute("SELECT 1").fetchone()
+
+    def store_metric(self, experiment_id, event_type, protocol, video_id, payload, timestamp,
+                     session_id=None, seq=None):
+        document = self._build_document(
+            experiment_id, event_type, protocol, video_id, payload, timestamp,
+            session_id=session_id, seq=seq
+        )
+        if not self.deduper.filter([document]):
+            return None
+
+        if self.write_queue:
+            self.write_queue.put(f"metrics-{experiment_id}", [document])
+            self._accepted([document])
+            return None
+
+        try:
+            if not self._insert([document]):
+                # Retried event already stored by another worker
+                return None
+        except Exception as e:
+            print(f"ERROR: Failed to store metric: {e}")
+            raise
+        self._accepted([document])
+        return document["_id"]
+
+    def store_metrics(self, events):
+        documents_by_collection = self._build_documents(events)
+
+        if self.write_queue:
+            self.write_queue.put_many(documents_by_collection)
+            stored = 0
+            for documents in documents_by_collection.values():
+                self._accepted(documents)
+                stored += len(documents)
+            return stored
+
+        documents = [
+            document
+            for collection_documents in documents_by_collection.values()
+            for document in collection_documents
+        ]
+        if not documents:
+            return 0
+        try:
+            inserted = {id(document) for document in self._insert(documents)}
+        except Exception as e:
+            print(f"ERROR: Failed to store metric batch: {e}")
+            raise
+
+        # Only rows the unique (session_id, seq) index let through are passed on
+        for collection_documents in documents_by_collection.values():
+            accepted = [document for document in collection_documents if id(document) in inserted]
+            if accepted:
+                self._accepted(accepted)
+        return len(inserted)
+
+    def _write_documents(self, collection_name, documents):
+        """Write-behind queue writer: insert documents, returning the number inserted."""
+        return len(self._insert(documents))
+
+    def _insert(self, documents):
+        """
+        Insert documents in a single transaction.
+
+        A failed transaction is rolled back as a whole, so the write-behind
+        queue can retry it without creating duplicates.
+
+        Returns:
+            The documents actually inserted, without those the unique
+            (session_id, seq) index ignored
+        """
+        rows = [
+            (
+                document["experiment_id"],
+                document["timestamp"],
+                document["event_type"],
+                document["protocol"],
+                document["video_id"],
+                json.dumps(document["payload"], separators=(",", ":")),
+                document["stored_at"].isoformat(),
+                document.get("session_id"),
+                document.get("seq")
+            )
+            for document in documents
+        ]
+        with STATS.time_write("sqlite_insert", len(rows)), self._write_lock:
+            with self._connection() as connection, connection:
+                if len(rows) == 1:
+                    cursor = connection.execute(_INSERT, rows[0])
+                    if not cursor.rowcount:
+                        return []
+                    documents[0]["_id"] = cursor.lastrowid
+                    return documents
+
+                # IMMEDIATE takes the write lock up front, so rows after
+                # last_id are this transaction's even with other writers
+                connection.execute("BEGIN IMMEDIATE")
+                last_id = connection.execute("SELECT MAX(id) FROM metrics").fetchone()[0] or 0
+                cursor = connection.executemany(_INSERT, rows)
+                if cursor.rowcount == len(rows):
+                    return documents
+                stored = set(connection.execute(
+                    "SELECT session_id, seq FROM metrics WHERE id > ? AND session_id IS NOT NULL",
+                    (last_id,)
+                ))
+        return [
+            document for document in documents
+            if document.get("session_id") is None
+            or (document["session_id"], document["seq"]) in stored
+        ]
+
+    @staticmethod
+    def _row_to_document(row):
+        """Turn a metrics row back into a metric document."""
+        document = {
+            "_id": row[0],
+            "experiment_id": row[1],
+            "timestamp": row[2],
+            "event_type": row[3],
+            "protocol": row[4],
+            "video_id": row[5],
+            "payload": json.loads(row[6]) if row[6] is not None else None,
+            "stored_at": datetime.fromisoformat(row[7]) if row[7] else None
+        }
+        if row[8] is not None:
+            document["session_id"] = row[8]
+            document["seq"] = row[9]
+        return document
+
+    def iter_metrics(self, experiment_id, event_type=None, start_time=None, end_time=None,
+                     after=None, limit=None, batch_size=None):
+        conditions, parameters = ["experiment_id = ?"], [experiment_id]
+        if event_type:
+            conditions.append("event_type = ?")
+            parameters.append(event_type)
+        if start_time is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(start_time)
+        if end_time is not None:
+            conditions.append("timestamp <= ?")
+            parameters.append(end_time)
+        if after is not None:
+            after_timestamp, after_id = after
+            conditions.append("(timestamp > ? OR (timestamp = ? AND id > ?))")
+            parameters.extend([after_timestamp, after_timestamp, after_id])
+
+        query = (f"SELECT {_COLUMNS} FROM metrics WHERE {' AND '.join(conditions)} "
+                 "ORDER BY timestamp, id")
+        if limit:
+            query += " LIMIT ?"
+            parameters.append(limit)
+
+        return self._iter_rows(query, parameters, batch_size or config.EXPORT_BATCH_SIZE)
+
+    def _iter_rows(self, query, parameters, batch_size):
+        """Run a query on a dedicated connection and yield documents batch by batch."""
+        # A separate connection keeps a long-running read (e.g. a streamed
+        # export) from holding a pooled connection, and its read transaction,
+        # for the whole response
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            cursor = connection.execute(query, parameters)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield self._row_to_document(row)
+        finally:
+            connection.close()
+
+    def summarize(self, experiment_id):
+        """
+        Compute QoE summary numbers for an experiment.
+
+        Session bounds come from an index-only aggregate; the remaining facets
+        are computed in Python over the low-frequency events and the video
+        buffer levels (see summary.compute_facets).
+        """
+        with self._connection() as connection:
+            events, first, last = connection.execute(
+                "SELECT COUNT(*), MIN(timestamp), MAX(timestamp) FROM metrics WHERE experiment_id = ?",
+                (experiment_id,)
+            ).fetchone()
+
+        event_types = ["stream_initialized", "playback_started", "rebuffer_event",
+                       "rebuffer_ended", "quality_change_rendered", "buffer_level_updated"]
+        query = (f"SELECT {_COLUMNS} FROM metrics WHERE experiment_id = ? "
+                 f"AND event_type IN ({', '.join('?' * len(event_types))}) "
+                 "ORDER BY timestamp, id")
+        facets = compute_facets(self._iter_rows(
+            query, [experiment_id] + event_types, config.EXPORT_BATCH_SIZE
+        ))
+        facets["bounds"] = [{"first": first, "last": last, "events": events}] if events else []
+        return build_summary(experiment_id, facets)
+
+    def save_aggregates(self, partials):
+        updated_at = datetime.utcnow().isoformat()
+        rows = [
+            (partial_id, experiment_id, json.dumps(state), updated_at)
+            for partial_id, experiment_id, state in partials
+        ]
+        with self._write_lock, self._connection() as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO aggregates (partial_id, experiment_id, state, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                rows
+            )
+
+    def load_aggregates(self, experiment_id):
+        with self._connection() as connection:
+            rows = connection.execute(
+                "SELECT partial_id, state FROM aggregates WHERE experiment_id = ?", (experiment_id,)
+            ).fetchall()
+        return [(partial_id, json.loads(state)) for partial_id, state in rows]
+
+    def replace_aggregate(self, partial_id, experiment_id, state, version):
+        updated_at = datetime.utcnow().isoformat()
+        with self._write_lock, self._connection() as connection, connection:
+            if version is None:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO aggregates (partial_id, experiment_id, state, updated_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (partial_id, experiment_id, json.dumps(state), updated_at)
+                )
+            else:
+                cursor = connection.execute(
+                    "UPDATE aggregates SET state = ?, updated_at = ? "
+                    "WHERE partial_id = ? AND json_extract(state, '$.version') = ?",
+                    (json.dumps(state), updated_at, partial_id, version)
+                )
+            return cursor.rowcount == 1
+
+    def delete_aggregates(self, partial_ids):
+        with self._write_lock, self._connection() as connection, connection:
+            connection.executemany(
+                "DELETE FROM aggregates WHERE partial_id = ?",
+                [(partial_id,) for partial_id in partial_ids]
+            )
+
+    def list_experiments(self):
+        with self._connection() as connection:
+            return [row[0] for row in connection.execute(
+                "SELECT DISTINCT experiment_id FROM metrics ORDER BY experiment_id"
+            )]
+
+    def last_timestamp(self, experiment_id):
+        with self._connection() as connection:
+            return connection.execute(
+                "SELECT MAX(timestamp) FROM metrics WHERE experiment_id = ?", (experiment_id,)
+            ).fetchone()[0]
+
+    def count_metrics(self, experiment_id):
+        with self._connection() as connection:
+            return connection.execute(
+                "SELECT COUNT(*) FROM metrics WHERE experiment_id = ?", (experiment_id,)
+            ).fetchone()[0]
+
+    def rollup_rows(self, experiment_id, resolution_s):
+        """Roll up an experiment's events into interval rows with one GROUP BY query."""
+        with self._connection() as connection:
+            rows = connection.execute(
+                ROLLUP_SQL, (resolution_s, resolution_s, experiment_id)
+            ).fetchall()
+        return [
+            {
+                "t": t,
+                "events": events,
+                "buffer_min_s": buffer_min,
+                "buffer_max_s": buffer_max,
+                "buffer_avg_s": buffer_avg,
+                "fragments": int(fragments),
+                "fragment_bytes": int(fragment_bytes),
+                "fragment_download_ms": fragment_download_ms,
+                "rebuffers": int(rebuffers)
+            }
+            for (t, events, buffer_min, buffer_max, buffer_avg, fragments, fragment_bytes,
+                 fragment_download_ms, rebuffers) in rows
+        ]
+
+    def claim_rollup(self, experiment_id, resolution_s, stale_before):
+        """Claim an experiment with an upsert that only overwrites stale in-progress claims."""
+        with self._write_lock, self._connection() as connection, connection:
+            cursor = connection.execute(
+                "INSERT INTO rollup_experiments (experiment_id, status, claimed_at, record) "
+                "VALUES (?, 'in_progress', ?, ?) "
+                "ON CONFLICT (experiment_id) DO UPDATE SET "
+                "claimed_at = excluded.claimed_at, record = excluded.record "
+                "WHERE status = 'in_progress' AND claimed_at < ?",
+                (experiment_id, datetime.utcnow().isoformat(),
+                 json.dumps({"resolution_s": resolution_s}), stale_before.isoformat())
+            )
+        return cursor.rowcount > 0
+
+    def save_rollup(self, experiment_id, record, chunks=None):
+        record = dict(record)
+        status = record.pop("status", None)
+        if isinstance(record.get("rolled_up_at"), datetime):
+            record["rolled_up_at"] = record["rolled_up_at"].isoformat()
+
+        with self._write_lock, self._connection() as connection, connection:
+            if chunks is not None:
+                connection.execute("DELETE FROM rollups WHERE experiment_id = ?", (experiment_id,))
+                connection.executemany(
+                    "INSERT INTO rollups (experiment_id, start, columns) VALUES (?, ?, ?)",
+                    [(experiment_id, chunk["start"], json.dumps(chunk["columns"], separators=(",", ":")))
+                     for chunk in chunks]
+                )
+            existing = connection.execute(
+                "SELECT status, record FROM rollup_experiments WHERE experiment_id = ?",
+                (experiment_id,)
+            ).fetchone()
+            if existing is None:
+                return
+            merged = dict(json.loads(existing[1] or "{}"), **record)
+            connection.execute(
+                "UPDATE rollup_experiments SET status = ?, record = ? WHERE experiment_id = ?",
+                (status or existing[0], json.dumps(merged), experiment_id)
+            )
+
+    def load_rollup(self, experiment_id, with_chunks=True):
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT status, claimed_at, record FROM rollup_experiments WHERE experiment_id = ?",
+                (experiment_id,)
+            ).fetchone()
+            if row is None:
+                return None, []
+            record = json.loads(row[2] or "{}")
+            record.update(experiment_id=experiment_id, status=row[0],
+                          claimed_at=datetime.fromisoformat(row[1]) if row[1] else None)
+            if record.get("rolled_up_at"):
+                record["rolled_up_at"] = datetime.fromisoformat(record["rolled_up_at"])
+
+            chunks = []
+            if with_chunks:
+                chunks = [
+                    {"experiment_id": experiment_id, "start": start, "columns": json.loads(columns)}
+                    for start, columns in connection.execute(
+                        "SELECT start, columns FROM rollups WHERE experiment_id = ? ORDER BY start",
+                        (experiment_id,)
+                    )
+                ]
+        return record, chunks
+
+    def delete_rollup(self, experiment_id):
+        with self._write_lock, self._connection() as connection, connection:
+            connection.execute("DELETE FROM rollups WHERE experiment_id = ?", (experiment_id,))
+            connection.execute("DELETE FROM rollup_experiments WHERE experiment_id = ?", (experiment_id,))
+
+    def drop_metrics(self, experiment_id):
+        """
+        Delete an experiment's rows.
+
+        The database file does not shrink; SQLite reuses the freed pages for
+        new events (run VACUUM offline to return the space).
+        """
+        with self._write_lock, self._connection() as connection, connection:
+            connection.execute("DELETE FROM metrics WHERE experiment_id = ?", (experiment_id,))
+
+    def close(self):
+        """Flush queued writes and close the idle database connections."""
+        super().close()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
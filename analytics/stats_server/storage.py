@@ -2,25 +2,88 @@
 MongoDB storage interface for metrics.
 """
 
-from pymongo import MongoClient
+import heapq
+from bson import ObjectId
 from datetime import datetime
+from pymongo import MongoClient, ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from storage_base import BaseMetricsStorage
+from summary import build_summary_pipeline, build_summary
+from bucketing import (
+    is_bucketed, build_bucket_updates, bucket_range_match, bucket_start, unpack_bucket,
+    unpack_stages
+)
+from rollup import build_rollup_pipeline
+from instrumentation import STATS
 import config
 
 
-class MetricsStorage:
+# Collection holding checkpointed partial aggregates (see aggregator.py)
+AGGREGATES_COLLECTION = "aggregates"
+
+# Roll-ups of compacted experiments (see retention.py): one record per
+# experiment, with the column chunks in a second collection
+ROLLUP_EXPERIMENTS_COLLECTION = "rollup_experiments"
+ROLLUPS_COLLECTION = "rollups"
+
+# Indexes created on every metrics-{experiment_id} collection. The _id suffix
+# lets MongoDB serve the (timestamp, _id) sort used by iter_metrics from the
+# index, with or without an event_type filter.
+METRIC_INDEXES = [
+    [("timestamp", 1), ("_id", 1)],
+    [("event_type", 1), ("timestamp", 1), ("_id", 1)],
+]
+
+# Last-resort protection against duplicate events the in-memory deduper
+# misses; only documents with a session_id are indexed
+SESSION_SEQ_INDEX = [("session_id", 1), ("seq", 1)]
+
+
+def create_storage():
+    """
+    Create the storage backend selected by config.STORAGE_BACKEND.
+    
+    Returns:
+        BaseMetricsStorage instance
+    
+    Raises:
+        ValueError: If the backend is unknown
+    """
+    if config.STORAGE_BACKEND == "mongo":
+        return MetricsStorage()
+    if config.STORAGE_BACKEND == "sqlite":
+        from sqlite_storage import SQLiteMetricsStorage
+        return SQLiteMetricsStorage(config.SQLITE_PATH)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {config.STORAGE_BACKEND}")
+
+
+class MetricsStorage(BaseMetricsStorage):
     """Wrapper around MongoDB for storing metrics."""
     
+    backend = "mongodb"
+    
     def __init__(self):
         """Initialize MongoDB connection."""
         try:
-            self.client = MongoClient(config.MONGO_URI)
+            self.client = MongoClient(config.MONGO_URI, maxPoolSize=config.MONGO_MAX_POOL_SIZE)
             self.db = self.client[config.MONGO_DATABASE]
             print(f"Connected to MongoDB at {config.MONGO_HOST}:{config.MONGO_PORT}")
         except Exception as e:
             print(f"ERROR: Failed to connect to MongoDB: {e}")
             raise
+        
+        # Collections whose indexes are known to exist (checked once per process)
+        self._indexed_collections = set()
+        
+        # Optional write-behind queue (see config.ASYNC_WRITES)
+        super().__init__()
     
-    def store_metric(self, experiment_id, event_type, protocol, video_id, payload, timestamp):
+    def ping(self):
+        """Check that MongoDB is reachable."""
+        self.db.command("ping")
+    
+    def store_metric(self, experiment_id, event_type, protocol, video_id, payload, timestamp,
+                     session_id=None, seq=None):
         """
         Store a metric event in MongoDB.
         
@@ -31,78 +94,514 @@ class MetricsStorage:
             video_id: Video/MPD identifier
             payload: Event payload (dict)
             timestamp: Unix timestamp in seconds
+            session_id: Optional player session identifier
+            seq: Optional per-session event sequence number
+        
+        Returns:
+            Inserted document id, or None if the write was queued or the
+            event is a duplicate
+        
+        Raises:
+            QueueFullError: In write-behind mode, if the queue is full
         """
         collection_name = f"metrics-{experiment_id}"
         collection = self.db[collection_name]
         
-        document = {
-            "experiment_id": experiment_id,
-            "timestamp": timestamp,
-            "event_type": event_type,
-            "protocol": protocol,
-            "video_id": video_id,
-            "payload": payload,
-            "stored_at": datetime.utcnow()
-        }
+        document = self._build_document(
+            experiment_id, event_type, protocol, video_id, payload, timestamp,
+            session_id=session_id, seq=seq
+        )
+        if not self.deduper.filter([document]):
+            return None
+        
+        if self.write_queue:
+            self.write_queue.put(collection_name, [document])
+            self._accepted([document])
+            return None
         
         try:
-            result = collection.insert_one(document)
-            return result.inserted_id
+            if is_bucketed(event_type):
+                stored = self._store(collection_name, [document])
+            else:
+                self.ensure_indexes(collection_name)
+                with STATS.time_write("insert_one"):
+                    collection.insert_one(document)
+                stored = [document]
+        except DuplicateKeyError:
+            # Retried event already stored by another worker
+            return None
         except Exception as e:
             print(f"ERROR: Failed to store metric: {e}")
             raise
+        
+        if not stored:
+            # Retried event already in its bucket
+            return None
+        self._accepted(stored)
+        return document["_id"]
+    
+    def store_metrics(self, events):
+        """
+        Store a batch of metric events in MongoDB.
+        
+        Events are grouped by experiment and written with one unordered
+        insert_many per collection, so a batch costs one round trip per
+        experiment instead of one per event.
+        
+        Args:
+            events: List of event dicts with the same fields as store_metric
+        
+        Returns:
+            Number of documents stored (or queued in write-behind mode),
+            not counting duplicates
+        
+        Raises:
+            QueueFullError: In write-behind mode, if the queue is full
+        """
+        documents_by_collection = self._build_documents(events)
+        
+        if self.write_queue:
+            self.write_queue.put_many(documents_by_collection)
+            stored = 0
+            for documents in documents_by_collection.values():
+                self._accepted(documents)
+                stored += len(documents)
+            return stored
+        
+        stored = 0
+        try:
+            for collection_name, documents in documents_by_collection.items():
+                # Only documents not already stored (e.g. by another worker) are passed on
+                inserted = self._store(collection_name, documents)
+                if inserted:
+                    self._accepted(inserted)
+                stored += len(inserted)
+        except Exception as e:
+            print(f"ERROR: Failed to store metric batch: {e}")
+            raise
+        
+        return stored
+    
+    def _write_documents(self, collection_name, documents):
+        """Write-behind queue writer: store documents, returning the number stored."""
+        return len(self._store(collection_name, documents))
+    
+    def _store(self, collection_name, documents):
+        """
+        Write event documents to a collection in bulk.
+        
+        In the bucketed layout, high-frequency event types are appended to
+        bucket documents with one unordered bulk_write; everything else is
+        inserted with one unordered insert_many.
+        
+        Returns:
+            The documents actually stored, without duplicates of events
+            already in the collection
+        """
+        self.ensure_indexes(collection_name)
+        
+        bucketed = [document for document in documents if is_bucketed(document["event_type"])]
+        if not bucketed:
+            return self._insert_documents(collection_name, documents)
+        
+        stored = []
+        if len(bucketed) < len(documents):
+            plain = [document for document in documents if not is_bucketed(document["event_type"])]
+            stored += self._insert_documents(collection_name, plain)
+        return stored + self._push_samples(collection_name, bucketed)
+    
+    def _insert_documents(self, collection_name, documents):
+        """
+        Write documents to a collection with one unordered insert_many.
+        
+        Duplicate key errors are ignored so a retried write of a partially
+        applied batch (insert_many assigns _id in place) and events resent by
+        clients (unique session_id/seq) are idempotent.
+        
+        Returns:
+            The documents inserted, without those rejected as duplicates
+        """
+        try:
+            with STATS.time_write("insert_many", len(documents)):
+                self.db[collection_name].insert_many(documents, ordered=False)
+            return documents
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in write_errors):
+                raise
+            rejected = {error["index"] for error in write_errors}
+            return [document for i, document in enumerate(documents) if i not in rejected]
+    
+    def _push_samples(self, collection_name, documents):
+        """
+        Append documents to their buckets with one unordered bulk_write.
+        
+        The updates skip samples a bucket already holds (see
+        build_bucket_updates) without saying which, so the buckets are read
+        back for the ids of samples carrying a session_id.
+        
+        Returns:
+            The documents stored, without resent events already in a bucket
+        """
+        collection = self.db[collection_name]
+        with STATS.time_write("bulk_write", len(documents)):
+            collection.bulk_write(build_bucket_updates(documents), ordered=False)
+        
+        sessions = [document for document in documents if "session_id" in document]
+        if not sessions:
+            return documents
+        held = set()
+        for bucket in collection.find(
+            {
+                "_bucket": True,
+                "timestamp": {"$in": sorted({bucket_start(document["timestamp"]) for document in sessions})},
+                "samples._id": {"$in": [document["_id"] for document in sessions]}
+            },
+            {"samples._id": 1}
+        ):
+            held.update(sample["_id"] for sample in bucket["samples"])
+        return [document for document in documents if "session_id" not in document or document["_id"] in held]
+    
+    def ensure_indexes(self, collection_name):
+        """
+        Create the metric indexes on a collection the first time it is used.
+        
+        create_index is idempotent, so racing workers are harmless; after the
+        first call for a collection this is a set lookup.
+        """
+        if collection_name in self._indexed_collections:
+            return
+        collection = self.db[collection_name]
+        for keys in METRIC_INDEXES:
+            collection.create_index(keys)
+        collection.create_index(
+            SESSION_SEQ_INDEX,
+            unique=True,
+            partialFilterExpression={"session_id": {"$exists": True}}
+        )
+        self._indexed_collections.add(collection_name)
     
-    def get_metrics(self, experiment_id, event_type=None, start_time=None, end_time=None):
+    def ensure_all_indexes(self):
         """
-        Retrieve metrics for an experiment.
+        Create the metric indexes on every existing metrics-* collection.
+        
+        Returns:
+            List of collection names that were checked
+        """
+        collection_names = sorted(self.db.list_collection_names(
+            filter={"name": {"$regex": "^metrics-"}}
+        ))
+        for collection_name in collection_names:
+            self.ensure_indexes(collection_name)
+        return collection_names
+    
+    def iter_metrics(self, experiment_id, event_type=None, start_time=None, end_time=None,
+                     after=None, limit=None, batch_size=None):
+        """
+        Iterate over metrics for an experiment without materializing them.
+        
+        Documents are returned in (timestamp, _id) order straight from the
+        MongoDB cursor, which fetches them batch_size at a time. In the
+        bucketed layout, buckets are unpacked into per-event documents as
+        they are read (see _iter_unpacked_metrics).
         
         Args:
             experiment_id: Experiment identifier
             event_type: Optional filter by event type
             start_time: Optional start timestamp filter
             end_time: Optional end timestamp filter
+            after: Optional (timestamp, id) keyset position; only documents
+                   strictly after it are returned
+            limit: Optional maximum number of documents
+            batch_size: Documents per cursor batch (default: config.EXPORT_BATCH_SIZE)
         
         Returns:
-            List of metric documents
+            Iterator of metric documents
         """
         collection_name = f"metrics-{experiment_id}"
         collection = self.db[collection_name]
         
+        if config.STORAGE_LAYOUT == "bucketed":
+            return self._iter_unpacked_metrics(
+                collection, event_type, start_time, end_time, after, limit, batch_size
+            )
+        
         query = {}
         if event_type:
             query["event_type"] = event_type
-        if start_time:
+        if start_time is not None:
             query["timestamp"] = {"$gte": start_time}
-        if end_time:
+        if end_time is not None:
             if "timestamp" in query:
                 query["timestamp"]["$lte"] = end_time
             else:
                 query["timestamp"] = {"$lte": end_time}
         
-        return list(collection.find(query).sort("timestamp", 1))
+        if after is not None:
+            query = {"$and": [query, self._after_match(after)]}
+        
+        cursor = collection.find(query).sort([("timestamp", 1), ("_id", 1)])
+        cursor = cursor.batch_size(batch_size or config.EXPORT_BATCH_SIZE)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+    
+    def _iter_unpacked_metrics(self, collection, event_type, start_time, end_time,
+                               after, limit, batch_size):
+        """
+        iter_metrics for the bucketed layout.
+        
+        Buckets and event documents are read in (timestamp, _id) order from
+        the index, where a bucket's timestamp is its window start, a lower
+        bound for its samples. Unpacked events wait in a heap until the
+        stored documents pass their timestamp, so only the documents up to
+        the last event returned are read and at most a window of events is
+        held in memory, instead of unpacking and sorting the whole range.
+        """
+        lower_bound = start_time
+        if after is not None and (lower_bound is None or after[0] > lower_bound):
+            lower_bound = after[0]
+        
+        pre_match = bucket_range_match(lower_bound, end_time)
+        if event_type:
+            pre_match["event_type"] = event_type
+        
+        cursor = collection.find(pre_match).sort([("timestamp", 1), ("_id", 1)])
+        cursor = cursor.batch_size(batch_size or config.EXPORT_BATCH_SIZE)
+        
+        def in_range(event):
+            timestamp = event["timestamp"]
+            if start_time is not None and timestamp < start_time:
+                return False
+            if end_time is not None and timestamp > end_time:
+                return False
+            return after is None or (timestamp, event["_id"]) > after
+        
+        pending = []
+        returned = 0
+        try:
+            for document in cursor:
+                # Stored documents start at or after this timestamp, so
+                # earlier pending events are final
+                while pending and pending[0][0] < document["timestamp"]:
+                    yield heapq.heappop(pending)[2]
+                    returned += 1
+                    if limit and returned >= limit:
+                        return
+                for event in unpack_bucket(document):
+                    if in_range(event):
+                        heapq.heappush(pending, (event["timestamp"], event["_id"], event))
+            while pending and not (limit and returned >= limit):
+                yield heapq.heappop(pending)[2]
+                returned += 1
+        finally:
+            cursor.close()
+    
+    def parse_metric_id(self, metric_id):
+        """ObjectId from its hex string."""
+        if not ObjectId.is_valid(metric_id):
+            raise ValueError(f"Invalid metric id: {metric_id}")
+        return ObjectId(metric_id)
+    
+    @staticmethod
+    def _after_match(after):
+        """Match documents strictly after a (timestamp, ObjectId) keyset position."""
+        after_timestamp, after_id = after
+        return {"$or": [
+            {"timestamp": {"$gt": after_timestamp}},
+            {"timestamp": after_timestamp, "_id": {"$gt": after_id}}
+        ]}
     
-    def export_to_json(self, experiment_id, output_file):
+    def summarize(self, experiment_id):
         """
-        Export all metrics for an experiment to a JSON file.
+        Compute QoE summary numbers for an experiment inside MongoDB.
         
         Args:
             experiment_id: Experiment identifier
-            output_file: Path to output JSON file
+        
+        Returns:
+            Summary dict (see summary.build_summary)
+        """
+        collection = self.db[f"metrics-{experiment_id}"]
+        pipeline = build_summary_pipeline()
+        if config.STORAGE_LAYOUT == "bucketed":
+            pipeline = unpack_stages() + pipeline
+        facets = next(collection.aggregate(pipeline, allowDiskUse=True))
+        return build_summary(experiment_id, facets)
+    
+    def save_aggregates(self, partials):
         """
-        import json
-        metrics = self.get_metrics(experiment_id)
+        Upsert checkpointed partial aggregates, one document per partial.
         
-        # Convert ObjectId to string for JSON serialization
-        for metric in metrics:
-            if "_id" in metric:
-                metric["_id"] = str(metric["_id"])
+        Args:
+            partials: List of (partial_id, experiment_id, state dict)
+        """
+        updated_at = datetime.utcnow()
+        self._aggregates_collection().bulk_write([
+            ReplaceOne(
+                {"_id": partial_id},
+                {"experiment_id": experiment_id, "state": state, "updated_at": updated_at},
+                upsert=True
+            )
+            for partial_id, experiment_id, state in partials
+        ], ordered=False)
+    
+    def load_aggregates(self, experiment_id):
+        """
+        Load the checkpointed partial aggregates of an experiment.
         
-        with open(output_file, 'w') as f:
-            json.dump(metrics, f, indent=2, default=str)
+        Returns:
+            List of (partial_id, state dict)
+        """
+        return [
+            (document["_id"], document["state"])
+            for document in self.db[AGGREGATES_COLLECTION].find({"experiment_id": experiment_id})
+        ]
+    
+    def replace_aggregate(self, partial_id, experiment_id, state, version):
+        """
+        Save a partial aggregate unless another process changed it first.
         
-        return len(metrics)
+        Returns:
+            True if saved, False if the saved state's version did not match
+        """
+        collection = self._aggregates_collection()
+        document = {"experiment_id": experiment_id, "state": state, "updated_at": datetime.utcnow()}
+        if version is None:
+            try:
+                collection.insert_one(dict(document, _id=partial_id))
+            except DuplicateKeyError:
+                return False
+            return True
+        result = collection.replace_one({"_id": partial_id, "state.version": version}, document)
+        return result.matched_count == 1
+    
+    def _aggregates_collection(self):
+        """The aggregates collection, indexed on first use."""
+        collection = self.db[AGGREGATES_COLLECTION]
+        if AGGREGATES_COLLECTION not in self._indexed_collections:
+            collection.create_index("experiment_id")
+            self._indexed_collections.add(AGGREGATES_COLLECTION)
+        return collection
+    
+    def delete_aggregates(self, partial_ids):
+        """Delete checkpointed partial aggregates by partial id."""
+        self.db[AGGREGATES_COLLECTION].delete_many({"_id": {"$in": list(partial_ids)}})
+    
+    def list_experiments(self):
+        """List the experiments that have a metrics-{experiment_id} collection."""
+        return sorted(
+            collection_name[len("metrics-"):]
+            for collection_name in self.db.list_collection_names(
+                filter={"name": {"$regex": "^metrics-"}}
+            )
+        )
+    
+    def last_timestamp(self, experiment_id):
+        """
+        Timestamp of an experiment's latest raw event.
+        
+        Served by the (timestamp, _id) index; in the bucketed layout only the
+        buckets of the latest window are unpacked.
+        """
+        collection = self.db[f"metrics-{experiment_id}"]
+        latest = collection.find_one({}, {"timestamp": 1}, sort=[("timestamp", -1)])
+        if latest is None or config.STORAGE_LAYOUT != "bucketed":
+            return latest["timestamp"] if latest else None
+        
+        pipeline = [{"$match": {"timestamp": {"$gte": bucket_start(latest["timestamp"])}}}]
+        pipeline += unpack_stages() + [{"$group": {"_id": None, "last": {"$max": "$timestamp"}}}]
+        return next(collection.aggregate(pipeline))["last"]
+    
+    def count_metrics(self, experiment_id):
+        """Number of an experiment's raw events; a bucket counts its samples."""
+        collection = self.db[f"metrics-{experiment_id}"]
+        if config.STORAGE_LAYOUT != "bucketed":
+            return collection.count_documents({})
+        result = list(collection.aggregate([{"$group": {
+            "_id": None,
+            "events": {"$sum": {"$cond": [{"$eq": ["$_bucket", True]}, "$count", 1]}}
+        }}]))
+        return result[0]["events"] if result else 0
+    
+    def rollup_rows(self, experiment_id, resolution_s):
+        """Roll up an experiment's events into interval rows inside MongoDB."""
+        pipeline = build_rollup_pipeline(resolution_s)
+        if config.STORAGE_LAYOUT == "bucketed":
+            pipeline = unpack_stages() + pipeline
+        rows = []
+        for document in self.db[f"metrics-{experiment_id}"].aggregate(pipeline, allowDiskUse=True):
+            document["t"] = document.pop("_id")
+            rows.append(document)
+        return rows
+    
+    def claim_rollup(self, experiment_id, resolution_s, stale_before):
+        """
+        Claim an experiment by inserting its roll-up record.
+        
+        The upsert only matches a stale in-progress claim; if the record
+        exists in any other state, inserting it fails on the _id.
+        """
+        try:
+            self.db[ROLLUP_EXPERIMENTS_COLLECTION].update_one(
+                {"_id": experiment_id, "status": "in_progress", "claimed_at": {"$lt": stale_before}},
+                {"$set": {"claimed_at": datetime.utcnow(), "resolution_s": resolution_s}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+    
+    def save_rollup(self, experiment_id, record, chunks=None):
+        """
+        Update a claimed roll-up record and replace its chunks.
+        
+        Args:
+            experiment_id: Experiment identifier
+            record: Roll-up fields
+            chunks: Optional chunk documents replacing any saved before
+        """
+        if chunks is not None:
+            collection = self.db[ROLLUPS_COLLECTION]
+            if ROLLUPS_COLLECTION not in self._indexed_collections:
+                collection.create_index([("experiment_id", 1), ("start", 1)])
+                self._indexed_collections.add(ROLLUPS_COLLECTION)
+            collection.delete_many({"experiment_id": experiment_id})
+            if chunks:
+                collection.insert_many([dict(chunk) for chunk in chunks], ordered=False)
+        self.db[ROLLUP_EXPERIMENTS_COLLECTION].update_one({"_id": experiment_id}, {"$set": record})
+    
+    def load_rollup(self, experiment_id, with_chunks=True):
+        """
+        Load an experiment's roll-up.
+        
+        Returns:
+            (record dict, list of chunks), or (None, []) if there is none
+        """
+        record = self.db[ROLLUP_EXPERIMENTS_COLLECTION].find_one({"_id": experiment_id})
+        if record is None:
+            return None, []
+        record["experiment_id"] = record.pop("_id")
+        chunks = []
+        if with_chunks:
+            chunks = list(self.db[ROLLUPS_COLLECTION].find(
+                {"experiment_id": experiment_id}, {"_id": 0}
+            ).sort("start", 1))
+        return record, chunks
+    
+    def delete_rollup(self, experiment_id):
+        """Delete an experiment's roll-up chunks and record."""
+        self.db[ROLLUPS_COLLECTION].delete_many({"experiment_id": experiment_id})
+        self.db[ROLLUP_EXPERIMENTS_COLLECTION].delete_one({"_id": experiment_id})
+    
+    def drop_metrics(self, experiment_id):
+        """Drop an experiment's metrics collection."""
+        collection_name = f"metrics-{experiment_id}"
+        self.db.drop_collection(collection_name)
+        self._indexed_collections.discard(collection_name)
     
     def close(self):
-        """Close MongoDB connection."""
+        """Flush queued writes and close MongoDB connection."""
+        super().close()
         self.client.close()
 
@@ -0,0 +1,423 @@
+"""
+Storage interface shared by the metrics storage backends.
+
+A backend stores metric event documents and reads them back in
+(timestamp, _id) order. The write-behind queue, exports and document layout
+are common to all backends and live here; backends implement the methods
+that raise NotImplementedError.
+
+Events carrying a session_id and seq are deduplicated (see dedupe.py):
+backends drop duplicates while building documents and report stored
+documents with _accepted(), which also passes them to the components that
+subscribed to ingest with subscribe() (e.g. live aggregates).
+"""
+
+from datetime import datetime
+from write_queue import WriteBehindQueue
+from dedupe import SessionDeduper
+from exporters import write_export
+import config
+
+
+class BaseMetricsStorage:
+    """Base class for metrics storage backends."""
+
+    # Backend name, reported by the health check
+    backend = None
+
+    def __init__(self):
+        """Set up the optional write-behind queue (see config.ASYNC_WRITES)."""
+        self._subscribers = []
+        self._close_callbacks = []
+        self.deduper = SessionDeduper(config.DEDUPE_MAX_SESSIONS, config.DEDUPE_WINDOW)
+        self.write_queue = None
+        if config.ASYNC_WRITES:
+            self.write_queue = WriteBehindQueue(
+                write_fn=self._write_documents,
+                max_size=config.WRITE_QUEUE_MAX_SIZE,
+                batch_size=config.WRITE_BATCH_SIZE,
+                flush_interval=config.WRITE_FLUSH_INTERVAL_MS / 1000.0
+            )
+            print(f"Write-behind enabled (queue size {config.WRITE_QUEUE_MAX_SIZE})")
+
+    @property
+    def async_writes(self):
+        """True if writes are acknowledged before they reach the database."""
+        return self.write_queue is not None
+
+    def subscribe(self, callback):
+        """
+        Register a callback for accepted documents.
+
+        Args:
+            callback: Callable(documents) called with each list of documents
+                      accepted by store_metric/store_metrics, in the request
+                      thread; it must be fast and must not raise
+        """
+        self._subscribers.append(callback)
+
+    def on_close(self, callback):
+        """Register a callable run at the start of close(), e.g. a final checkpoint."""
+        self._close_callbacks.append(callback)
+
+    def _accepted(self, documents):
+        """Record documents as stored (or queued) and pass them to the subscribers."""
+        self.deduper.mark(documents)
+        for callback in self._subscribers:
+            try:
+                callback(documents)
+            except Exception as e:
+                print(f"ERROR: Metric subscriber failed: {e}")
+
+    def ping(self):
+        """
+        Check that the database is reachable.
+
+        Raises:
+            Exception: If it is not
+        """
+        raise NotImplementedError
+
+    def store_metric(self, experiment_id, event_type, protocol, video_id, payload, timestamp,
+                     session_id=None, seq=None):
+        """
+        Store a metric event.
+
+        Args:
+            experiment_id: Experiment identifier
+            event_type: Type of event (e.g., 'fragment_loading_completed')
+            protocol: Protocol name (e.g., 'dash')
+            video_id: Video/MPD identifier
+            payload: Event payload (dict)
+            timestamp: Unix timestamp in seconds
+            session_id: Optional player session identifier
+            seq: Optional per-session event sequence number
+
+        Returns:
+            Stored document id, or None if the write was queued or the event
+            is a duplicate
+
+        Raises:
+            QueueFullError: In write-behind mode, if the queue is full
+        """
+        raise NotImplementedError
+
+    def store_metrics(self, events):
+        """
+        Store a batch of metric events.
+
+        Args:
+            events: List of event dicts with the same fields as store_metric
+
+        Returns:
+            Number of documents stored (or queued in write-behind mode),
+            not counting duplicates
+
+        Raises:
+            QueueFullError: In write-behind mode, if the queue is full
+        """
+        raise NotImplementedError
+
+    def _write_documents(self, collection_name, documents):
+        """
+        Write event documents of one experiment in bulk (write-behind flusher).
+
+        Args:
+            collection_name: metrics-{experiment_id}
+            documents: Documents built by _build_document
+
+        Returns:
+            Number of events written
+        """
+        raise NotImplementedError
+
+    def parse_metric_id(self, metric_id):
+        """
+        Convert the string form of a document id (e.g. from a pagination
+        cursor) into the id iter_metrics expects in its after position.
+
+        Raises:
+            ValueError: If metric_id is not a valid id for this backend
+        """
+        raise NotImplementedError
+
+    def iter_metrics(self, experiment_id, event_type=None, start_time=None, end_time=None,
+                     after=None, limit=None, batch_size=None):
+        """
+        Iterate over metrics for an experiment in (timestamp, _id) order
+        without materializing them.
+
+        Args:
+            experiment_id: Experiment identifier
+            event_type: Optional filter by event type
+            start_time: Optional start timestamp filter
+            end_time: Optional end timestamp filter
+            after: Optional (timestamp, id) keyset position, the id as
+                   returned by parse_metric_id; only documents strictly
+                   after it are returned
+            limit: Optional maximum number of documents
+            batch_size: Documents fetched per batch (default: config.EXPORT_BATCH_SIZE)
+
+        Returns:
+            Iterator of metric documents
+        """
+        raise NotImplementedError
+
+    def summarize(self, experiment_id):
+        """
+        Compute QoE summary numbers for an experiment.
+
+        Returns:
+            Summary dict (see summary.build_summary)
+        """
+        raise NotImplementedError
+
+    def load_summary(self, experiment_id):
+        """
+        QoE summary of an experiment, from its raw events or, once the
+        retention job compacted it, from its roll-up.
+
+        Returns:
+            Summary dict; event_count is 0 if the experiment is unknown
+        """
+        summary = self.summarize(experiment_id)
+        if summary["event_count"] == 0:
+            record, _ = self.load_rollup(experiment_id, with_chunks=False)
+            if record is not None and record["status"] == "complete":
+                return record["summary"]
+        return summary
+
+    def save_aggregates(self, partials):
+        """
+        Save (replace) checkpointed partial aggregates.
+
+        Args:
+            partials: List of (partial_id, experiment_id, state dict)
+        """
+        raise NotImplementedError
+
+    def load_aggregates(self, experiment_id):
+        """
+        Load the checkpointed partial aggregates of an experiment.
+
+        Returns:
+            List of (partial_id, state dict)
+        """
+        raise NotImplementedError
+
+    def replace_aggregate(self, partial_id, experiment_id, state, version):
+        """
+        Save a partial aggregate unless another process changed it first.
+
+        Args:
+            partial_id: Id of the partial
+            experiment_id: Experiment of the partial
+            state: New state dict, with a "version" field
+            version: "version" of the saved state this one was derived
+                     from, or None if the partial must not exist yet
+
+        Returns:
+            True if saved, False if the saved version did not match
+        """
+        raise NotImplementedError
+
+    def delete_aggregates(self, partial_ids):
+        """
+        Delete checkpointed partial aggregates.
+
+        Args:
+            partial_ids: Ids of the partials to delete; unknown ids are ignored
+        """
+        raise NotImplementedError
+
+    def list_experiments(self):
+        """
+        List the experiments that have raw metric events.
+
+        Returns:
+            List of experiment ids
+        """
+        raise NotImplementedError
+
+    def last_timestamp(self, experiment_id):
+        """
+        Timestamp of an experiment's latest raw event (index-only lookup).
+
+        Returns:
+            Unix timestamp, or None if the experiment has no raw events
+        """
+        raise NotImplementedError
+
+    def count_metrics(self, experiment_id):
+        """
+        Number of an experiment's raw events.
+
+        Returns:
+            Event count, 0 if the experiment has no raw events
+        """
+        raise NotImplementedError
+
+    def rollup_rows(self, experiment_id, resolution_s):
+        """
+        Roll up an experiment's raw events into interval rows.
+
+        Returns:
+            List of row dicts (see rollup.ROLLUP_COLUMNS) in t order, without
+            bitrate_bps
+        """
+        raise NotImplementedError
+
+    def claim_rollup(self, experiment_id, resolution_s, stale_before):
+        """
+        Atomically claim an experiment for compaction (see retention.py).
+
+        Args:
+            experiment_id: Experiment identifier
+            resolution_s: Roll-up resolution in seconds
+            stale_before: datetime; in-progress claims older than this are
+                          taken over
+
+        Returns:
+            True if claimed, False if the experiment has a roll-up or a
+            live claim
+        """
+        raise NotImplementedError
+
+    def save_rollup(self, experiment_id, record, chunks=None):
+        """
+        Update a claimed roll-up.
+
+        Args:
+            experiment_id: Experiment identifier
+            record: Roll-up fields (status, resolution_s, event_count,
+                    summary, rolled_up_at, raw_dropped); fields not given
+                    are kept
+            chunks: Optional chunk documents (see rollup.pack_chunks)
+                    replacing any saved before
+        """
+        raise NotImplementedError
+
+    def load_rollup(self, experiment_id, with_chunks=True):
+        """
+        Load an experiment's roll-up.
+
+        Returns:
+            (record dict, list of chunks), or (None, []) if there is none
+        """
+        raise NotImplementedError
+
+    def delete_rollup(self, experiment_id):
+        """Delete an experiment's roll-up and claim."""
+        raise NotImplementedError
+
+    def drop_metrics(self, experiment_id):
+        """Delete all raw metric events of an experiment."""
+        raise NotImplementedError
+
+    @staticmethod
+    def _build_document(experiment_id, event_type, protocol, video_id, payload,
+                        timestamp, stored_at=None, session_id=None, seq=None):
+        """Build the stored document for a single metric event."""
+        document = {
+            "experiment_id": experiment_id,
+            "timestamp": timestamp,
+            "event_type": event_type,
+            "protocol": protocol,
+            "video_id": video_id,
+            "payload": payload,
+            "stored_at": stored_at or datetime.utcnow()
+        }
+        if session_id is not None and seq is not None:
+            document["session_id"] = session_id
+            document["seq"] = seq
+        return document
+
+    def _build_documents(self, events):
+        """
+        Build documents for a batch of events, grouped by experiment.
+        Duplicate events are left out.
+
+        Returns:
+            Dict of metrics-{experiment_id} -> list of documents
+        """
+        documents_by_collection = {}
+        stored_at = datetime.utcnow()
+        for event in self.deduper.filter(events):
+            document = self._build_document(
+                experiment_id=event["experiment_id"],
+                event_type=event["event_type"],
+                protocol=event["protocol"],
+                video_id=event.get("video_id", "unknown"),
+                payload=event["payload"],
+                timestamp=event["timestamp"],
+                stored_at=stored_at,
+                session_id=event.get("session_id"),
+                seq=event.get("seq")
+            )
+            collection_name = f"metrics-{event['experiment_id']}"
+            documents_by_collection.setdefault(collection_name, []).append(document)
+        return documents_by_collection
+
+    def get_metrics(self, experiment_id, event_type=None, start_time=None, end_time=None):
+        """
+        Retrieve metrics for an experiment.
+
+        Args:
+            experiment_id: Experiment identifier
+            event_type: Optional filter by event type
+            start_time: Optional start timestamp filter
+            end_time: Optional end timestamp filter
+
+        Returns:
+            List of metric documents
+        """
+        return list(self.iter_metrics(experiment_id, event_type, start_time, end_time))
+
+    def export_to_json(self, experiment_id, output_file):
+        """
+        Export all metrics for an experiment to a JSON file.
+
+        Args:
+            experiment_id: Experiment identifier
+            output_file: Path to output JSON file
+        """
+        return self.export_metrics(experiment_id, output_file, "json")
+
+    def export_metrics(self, experiment_id, output_file, export_format="json"):
+        """
+        Export all metrics for an experiment, streaming from the database.
+
+        Args:
+            experiment_id: Experiment identifier
+            output_file: Path to output file
+            export_format: One of exporters.EXPORT_FORMATS
+
+        Returns:
+            Number of metrics exported
+
+        Raises:
+            TimeoutError: If queued writes did not reach the database within
+                          config.FLUSH_TIMEOUT_S
+        """
+        if not self.flush(config.FLUSH_TIMEOUT_S):
+            raise TimeoutError(f"Queued writes not flushed within {config.FLUSH_TIMEOUT_S}s")
+        return write_export(self.iter_metrics(experiment_id), output_file, export_format)
+
+    def flush(self, timeout=None):
+        """
+        Wait until the writes queued before the call have reached the database.
+
+        Returns:
+            True if they were written, False on timeout
+        """
+        if self.write_queue:
+            return self.write_queue.flush(timeout)
+        return True
+
+    def close(self):
+        """Flush queued writes; backends also close their connections."""
+        for callback in self._close_callbacks:
+            callback()
+        if self.write_queue:
+            print(f"Flushing {self.write_queue.depth()} queued metrics...")
+            self.write_queue.close()
@@ -0,0 +1,360 @@
+"""
+QoE summary computed inside MongoDB with an aggregation pipeline.
+
+The pipeline reduces a metrics-{experiment_id} collection to a handful of
+small facets (session bounds, startup markers, stall/quality change sequences
+and a 100-bucket buffer level distribution); build_summary() turns those into
+the final QoE numbers. Only low-frequency events are pushed into arrays, so
+the pipeline stays within MongoDB's document size limit for long runs.
+
+Stall time relies on the player's rebuffer_event / rebuffer_ended pair; a
+stall still open at the end of the session counts until the last event.
+
+Backends without an aggregation framework compute the same facets in Python
+with compute_facets().
+"""
+
+# Buffer level percentiles reported by the summary
+BUFFER_PERCENTILES = [5, 25, 50, 75, 95]
+
+# Buckets used to approximate the buffer level distribution
+BUFFER_BUCKETS = 100
+
+# Events that end a stall
+STALL_END_EVENTS = ["rebuffer_ended", "playback_started"]
+
+# Stall and quality facet states before the first event (see advance_stalls
+# and advance_quality)
+NO_STALLS = {"since": None, "count": 0, "total": 0}
+NO_QUALITY = {"t": None, "bitrate": None, "weighted": 0, "first": None}
+
+
+def build_summary_pipeline():
+    """
+    Build the aggregation pipeline for an experiment collection.
+
+    Returns:
+        List of pipeline stages producing a single document of facets
+    """
+    return [
+        # Served by the (timestamp, _id) index; facets see events in order
+        {"$sort": {"timestamp": 1, "_id": 1}},
+        {"$facet": {
+            "bounds": [
+                {"$group": {
+                    "_id": None,
+                    "first": {"$min": "$timestamp"},
+                    "last": {"$max": "$timestamp"},
+                    "events": {"$sum": 1}
+                }}
+            ],
+            "startup": [
+                {"$match": {"event_type": {"$in": ["stream_initialized", "playback_started"]}}},
+                {"$group": {"_id": "$event_type", "first": {"$min": "$timestamp"}}}
+            ],
+            "stalls": [
+                {"$match": {"event_type": {"$in": ["rebuffer_event"] + STALL_END_EVENTS}}},
+                {"$group": {
+                    "_id": None,
+                    "events": {"$push": {
+                        "t": "$timestamp",
+                        "stall": {"$eq": ["$event_type", "rebuffer_event"]}
+                    }}
+                }},
+                {"$project": {
+                    "_id": 0,
+                    "state": {"$reduce": {
+                        "input": "$events",
+                        "initialValue": {"since": None, "count": 0, "total": 0},
+                        "in": {"$cond": [
+                            "$$this.stall",
+                            # Stall start: only counts if not already stalled
+                            {
+                                "since": {"$ifNull": ["$$value.since", "$$this.t"]},
+                                "count": {"$add": [
+                                    "$$value.count",
+                                    {"$cond": [{"$eq": ["$$value.since", None]}, 1, 0]}
+                                ]},
+                                "total": "$$value.total"
+                            },
+                            # Stall end: close the open stall, if any
+                            {
+                                "since": None,
+                                "count": "$$value.count",
+                                "total": {"$add": [
+                                    "$$value.total",
+                                    {"$cond": [
+                                        {"$eq": ["$$value.since", None]},
+                                        0,
+                                        {"$subtract": ["$$this.t", "$$value.since"]}
+                                    ]}
+                                ]}
+                            }
+                        ]}
+                    }}
+                }}
+            ],
+            "quality": [
+                {"$match": {"event_type": "quality_change_rendered"}},
+                {"$group": {
+                    "_id": None,
+                    "changes": {"$push": {
+                        "t": "$timestamp",
+                        "bitrate": "$payload.bitrate",
+                        "old": "$payload.old_quality",
+                        "new": "$payload.new_quality"
+                    }}
+                }},
+                {"$project": {
+                    "_id": 0,
+                    "state": {"$reduce": {
+                        "input": "$changes",
+                        "initialValue": {"t": None, "bitrate": None, "weighted": 0, "switches": 0},
+                        "in": {
+                            "t": "$$this.t",
+                            "bitrate": "$$this.bitrate",
+                            # Bitrate-seconds of the previous rendition
+                            "weighted": {"$add": [
+                                "$$value.weighted",
+                                {"$cond": [
+                                    {"$eq": ["$$value.t", None]},
+                                    0,
+                                    {"$multiply": [
+                                        {"$subtract": ["$$this.t", "$$value.t"]},
+                                        {"$ifNull": ["$$value.bitrate", 0]}
+                                    ]}
+                                ]}
+                            ]},
+                            "switches": {"$add": [
+                                "$$value.switches",
+                                {"$cond": [
+                                    {"$and": [
+                                        {"$ne": [{"$ifNull": ["$$this.old", None]}, None]},
+                                        {"$ne": ["$$this.old", "$$this.new"]}
+                                    ]},
+                                    1,
+                                    0
+                                ]}
+                            ]},
+                            "first": {"$ifNull": ["$$value.first", "$$this.t"]}
+                        }
+                    }}
+                }}
+            ],
+            "buffer": [
+                {"$match": {
+                    "event_type": "buffer_level_updated",
+                    "payload.media_type": {"$in": ["video", None]}
+                }},
+                {"$bucketAuto": {
+                    "groupBy": "$payload.buffer_level",
+                    "buckets": BUFFER_BUCKETS,
+                    "output": {
+                        "count": {"$sum": 1},
+                        "max": {"$max": "$payload.buffer_level"}
+                    }
+                }},
+                {"$project": {"_id": 0, "count": 1, "max": 1}}
+            ]
+        }}
+    ]
+
+
+def compute_facets(metrics):
+    """
+    Compute the facets of build_summary_pipeline() in a single pass.
+
+    Args:
+        metrics: Iterator of metric documents in (timestamp, _id) order
+
+    Returns:
+        Facet document accepted by build_summary()
+    """
+    bounds = None
+    startup = {}
+    stalls = None
+    quality = None
+    buffer_levels = []
+
+    for metric in metrics:
+        t = metric["timestamp"]
+        event_type = metric["event_type"]
+        payload = metric.get("payload") or {}
+
+        if bounds is None:
+            bounds = {"_id": None, "first": t, "last": t, "events": 0}
+        bounds["first"] = min(bounds["first"], t)
+        bounds["last"] = max(bounds["last"], t)
+        bounds["events"] += 1
+
+        if event_type in ("stream_initialized", "playback_started"):
+            startup.setdefault(event_type, t)
+
+        if event_type == "rebuffer_event" or event_type in STALL_END_EVENTS:
+            if stalls is None:
+                stalls = {"since": None, "count": 0, "total": 0}
+            if event_type == "rebuffer_event":
+                if stalls["since"] is None:
+                    stalls["since"] = t
+                    stalls["count"] += 1
+            elif stalls["since"] is not None:
+                stalls["total"] += t - stalls["since"]
+                stalls["since"] = None
+
+        elif event_type == "quality_change_rendered":
+            if quality is None:
+                quality = {"t": None, "bitrate": None, "weighted": 0, "switches": 0, "first": t}
+            if quality["t"] is not None:
+                quality["weighted"] += (t - quality["t"]) * (quality["bitrate"] or 0)
+            old = payload.get("old_quality")
+            if old is not None and old != payload.get("new_quality"):
+                quality["switches"] += 1
+            quality["t"] = t
+            quality["bitrate"] = payload.get("bitrate")
+
+        elif event_type == "buffer_level_updated":
+            level = payload.get("buffer_level")
+            if level is not None and payload.get("media_type") in ("video", None):
+                buffer_levels.append(level)
+
+    # Equal-count buckets, like $bucketAuto
+    buffer_levels.sort()
+    buckets = []
+    size = -(-len(buffer_levels) // BUFFER_BUCKETS)
+    for offset in range(0, len(buffer_levels), size or 1):
+        chunk = buffer_levels[offset:offset + size]
+        buckets.append({"count": len(chunk), "max": chunk[-1]})
+
+    return {
+        "bounds": [bounds] if bounds else [],
+        "startup": [{"_id": event_type, "first": t} for event_type, t in startup.items()],
+        "stalls": [{"state": stalls}] if stalls else [],
+        "quality": [{"state": quality}] if quality else [],
+        "buffer": buckets
+    }
+
+
+def advance_stalls(state, stall_events):
+    """
+    Run the stall state machine of the stalls facet over more events.
+
+    Args:
+        state: {"since", "count", "total"} as in the stalls facet
+        stall_events: [timestamp, True for rebuffer_event / False for a
+                      stall end event] pairs, in any order
+
+    Returns:
+        New state
+    """
+    since, count, total = state["since"], state["count"], state["total"]
+    for t, is_start in sorted(stall_events, key=lambda event: event[0]):
+        if is_start:
+            if since is None:
+                since = t
+                count += 1
+        elif since is not None:
+            total += t - since
+            since = None
+    return {"since": since, "count": count, "total": total}
+
+
+def advance_quality(state, quality_events):
+    """
+    Time-weight bitrates like the quality facet, over more events.
+
+    Args:
+        state: {"t", "bitrate", "weighted", "first"} as in the quality facet
+               (switches are counted separately)
+        quality_events: [timestamp, bitrate] of quality_change_rendered
+                        events, in any order
+
+    Returns:
+        New state
+    """
+    t_prev, bitrate = state["t"], state["bitrate"]
+    weighted, first = state["weighted"], state["first"]
+    for t, new_bitrate in sorted(quality_events, key=lambda event: event[0]):
+        if t_prev is None:
+            first = t
+        else:
+            weighted += (t - t_prev) * (bitrate or 0)
+        t_prev, bitrate = t, new_bitrate
+    return {"t": t_prev, "bitrate": bitrate, "weighted": weighted, "first": first}
+
+
+def _percentiles(buckets, percentiles):
+    """
+    Approximate percentiles from ordered $bucketAuto buckets.
+
+    Each percentile is the maximum of the bucket in which its rank falls.
+    """
+    total = sum(bucket["count"] for bucket in buckets)
+    if total == 0:
+        return {f"p{p}": None for p in percentiles}
+
+    result = {}
+    for p in percentiles:
+        rank = p / 100.0 * total
+        seen = 0
+        for bucket in buckets:
+            seen += bucket["count"]
+            if seen >= rank:
+                result[f"p{p}"] = bucket["max"]
+                break
+    return result
+
+
+def build_summary(experiment_id, facets):
+    """
+    Turn the pipeline's facet document into QoE summary numbers.
+
+    Args:
+        experiment_id: Experiment identifier
+        facets: Single result document of build_summary_pipeline()
+
+    Returns:
+        Summary dict
+    """
+    bounds = facets["bounds"][0] if facets["bounds"] else None
+    if bounds is None:
+        return {"experiment_id": experiment_id, "event_count": 0}
+
+    first, last = bounds["first"], bounds["last"]
+
+    startup = {item["_id"]: item["first"] for item in facets["startup"]}
+    startup_delay = None
+    if "stream_initialized" in startup and "playback_started" in startup:
+        startup_delay = startup["playback_started"] - startup["stream_initialized"]
+
+    rebuffer_count, stall_time = 0, 0.0
+    if facets["stalls"]:
+        state = facets["stalls"][0]["state"]
+        rebuffer_count = state["count"]
+        stall_time = state["total"]
+        if state["since"] is not None:
+            stall_time += last - state["since"]
+
+    avg_bitrate, switch_count = None, 0
+    if facets["quality"]:
+        state = facets["quality"][0]["state"]
+        switch_count = state["switches"]
+        weighted = state["weighted"] + (last - state["t"]) * (state["bitrate"] or 0)
+        span = last - state["first"]
+        if span > 0:
+            avg_bitrate = weighted / span
+        else:
+            avg_bitrate = state["bitrate"]
+
+    return {
+        "experiment_id": experiment_id,
+        "event_count": bounds["events"],
+        "first_timestamp": first,
+        "last_timestamp": last,
+        "duration_s": last - first,
+        "startup_delay_s": startup_delay,
+        "rebuffer_count": rebuffer_count,
+        "total_stall_time_s": stall_time,
+        "avg_bitrate_bps": avg_bitrate,
+        "switch_count": switch_count,
+        "buffer_level_percentiles_s": _percentiles(facets["buffer"], BUFFER_PERCENTILES)
+    }
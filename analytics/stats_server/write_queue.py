@@ -0,0 +1,180 @@
+"""
+Write-behind queue for metric documents.
+
+Documents are accepted into a bounded in-memory queue and written to the
+database by a background flusher thread, so request handlers never wait on
+database latency. When the queue is full, callers get a QueueFullError and
+are expected to ask the client to retry later.
+"""
+
+import math
+import threading
+import time
+import traceback
+from collections import deque
+from instrumentation import STATS
+
+
+class QueueFullError(Exception):
+    """Raised when the write queue cannot accept more documents."""
+
+    def __init__(self, retry_after):
+        """
+        Args:
+            retry_after: Suggested number of seconds before retrying
+        """
+        super().__init__(f"Write queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class WriteBehindQueue:
+    """Bounded queue drained by a background thread into bulk writes."""
+
+    def __init__(self, write_fn, max_size, batch_size, flush_interval, max_retries=5):
+        """
+        Start the background flusher.
+
+        Args:
+            write_fn: Callable(collection_name, documents) performing one bulk write
+            max_size: Maximum number of queued (not yet written) documents
+            batch_size: Number of queued documents that triggers an immediate flush
+            flush_interval: Maximum time in seconds a document waits before a flush
+            max_retries: Attempts per bulk write before the documents are dropped
+        """
+        self.write_fn = write_fn
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_after = max(1, math.ceil(flush_interval))
+
+        self._pending = deque()  # (collection_name, documents)
+        self._size = 0           # queued + in-flight documents
+        self._enqueued = 0       # documents accepted since start
+        self._done = 0           # documents written (or dropped) since start
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._closed = False
+
+        self._thread = threading.Thread(
+            target=self._run, name="metrics-write-behind", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, collection_name, documents):
+        """
+        Queue documents for a collection without blocking.
+
+        Raises:
+            QueueFullError: If accepting the documents would exceed max_size
+            RuntimeError: If the queue has been closed
+        """
+        self.put_many({collection_name: documents})
+
+    def put_many(self, documents_by_collection):
+        """
+        Queue documents for several collections as a unit: either all of
+        them are accepted or none are.
+
+        Args:
+            documents_by_collection: Dict of collection name -> list of documents
+
+        Raises:
+            QueueFullError: If accepting the documents would exceed max_size
+            RuntimeError: If the queue has been closed
+        """
+        count = sum(len(documents) for documents in documents_by_collection.values())
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Write queue is closed")
+            if self._size + count > self.max_size:
+                raise QueueFullError(self.retry_after)
+            self._pending.extend(documents_by_collection.items())
+            self._size += count
+            self._enqueued += count
+            if self._size >= self.batch_size:
+                self._wakeup.notify()
+
+    def depth(self):
+        """Number of documents accepted but not yet written."""
+        return self._size
+
+    def flush(self, timeout=None):
+        """
+        Block until every document queued before the call has been written.
+
+        Documents queued during the flush are not waited for, so the call
+        returns under steady ingest too. Request handlers should still pass
+        a finite timeout.
+
+        Returns:
+            True if the documents were written, False on timeout
+        """
+        with self._lock:
+            target = self._enqueued
+            self._wakeup.notify()
+            return self._drained.wait_for(lambda: self._done >= target, timeout)
+
+    def close(self, timeout=30):
+        """Stop accepting documents, flush what is queued and stop the flusher."""
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+        self._thread.join(timeout)
+
+    def _run(self):
+        """Flusher loop: wait for a full batch or the flush interval, then write."""
+        while True:
+            with self._lock:
+                if not self._closed and self._size < self.batch_size:
+                    self._wakeup.wait(self.flush_interval)
+                if not self._pending:
+                    if self._closed:
+                        return
+                    continue
+                items = list(self._pending)
+                self._pending.clear()
+
+            written = self._write_grouped(items)
+
+            with self._lock:
+                self._size -= written
+                self._done += written
+                self._drained.notify_all()
+
+    def _write_grouped(self, items):
+        """
+        Write queued items grouped into one bulk write per collection.
+
+        Returns:
+            Number of documents taken off the queue (written or dropped)
+        """
+        documents_by_collection = {}
+        for collection_name, documents in items:
+            documents_by_collection.setdefault(collection_name, []).extend(documents)
+
+        count = 0
+        for collection_name, documents in documents_by_collection.items():
+            for offset in range(0, len(documents), self.batch_size):
+                chunk = documents[offset:offset + self.batch_size]
+                self._write_with_retry(collection_name, chunk)
+                count += len(chunk)
+        return count
+
+    def _write_with_retry(self, collection_name, documents):
+        """Write one chunk, retrying with backoff before giving up on it."""
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self.write_fn(collection_name, documents)
+                return
+            except Exception as e:
+                STATS.count_error("write_behind_flush_failed")
+                print(f"ERROR: Write-behind flush to {collection_name} failed "
+                      f"(attempt {attempt}/{self.max_retries}): {e}")
+                if attempt == self.max_retries:
+                    print(traceback.format_exc())
+                    print(f"ERROR: Dropping {len(documents)} metrics for {collection_name}")
+                    STATS.count_error("write_behind_dropped_metrics", len(documents))
+                    return
+                time.sleep(min(0.1 * 2 ** attempt, 5.0))
@@ -3,25 +3,19 @@
 Apply static network profile using tc/netem.
 
 Reads a YAML configuration file and applies network conditions
-to the traffic shaper interfaces.
+to the traffic shaper interfaces. The netem parameters are changed in place
+(see shaping.py); the qdisc tree is only built if the interface lacks it.
 """
 
 import os
 import sys
 import yaml
-import subprocess
 import argparse
+from shaping import BACKENDS, DEFAULT_BACKEND, ShapingError, create_shaper
 
 
-def run_cmd(cmd, check=True):
-    """Run a shell command and return the result."""
-    result = subprocess.run(
-        cmd, shell=True, capture_output=True, text=True, check=check
-    )
-    return result.stdout.strip()
-
-
-def apply_netem_config(interface, delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None):
+def apply_netem_config(interface, delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None,
+                       backend=DEFAULT_BACKEND):
     """
     Apply netem configuration to an interface.
     
@@ -31,6 +25,10 @@ def apply_netem_config(interface, delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps
         jitter_ms: Jitter (delay variation) in milliseconds
         loss_pct: Packet loss percentage (0-100)
         rate_mbps: Rate limit in Mbps (optional)
+        backend: Shaping backend (see shaping.BACKENDS)
+    
+    Raises:
+        ShapingError: If the configuration could not be applied
     """
     print(f"Applying netem config to {interface}:")
     print(f"  Delay: {delay_ms}ms")
@@ -39,36 +37,8 @@ def apply_netem_config(interface, delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps
     if rate_mbps:
         print(f"  Rate: {rate_mbps}Mbps")
     
-    # Clear existing rules
-    run_cmd(f"tc qdisc del dev {interface} root", check=False)
-    
-    # Build netem command
-    netem_params = []
-    
-    if delay_ms > 0 or jitter_ms > 0:
-        if jitter_ms > 0:
-            netem_params.append(f"delay {delay_ms}ms {jitter_ms}ms")
-        else:
-            netem_params.append(f"delay {delay_ms}ms")
-    
-    if loss_pct > 0:
-        netem_params.append(f"loss {loss_pct}%")
-    
-    if rate_mbps:
-        netem_params.append(f"rate {rate_mbps}mbit")
-    
-    # Apply configuration
-    if netem_params:
-        netem_str = " ".join(netem_params)
-        # Use prio qdisc to allow filtering
-        run_cmd(f"tc qdisc add dev {interface} root handle 1: prio")
-        run_cmd(f"tc qdisc add dev {interface} parent 1:1 handle 2: netem {netem_str}")
-        run_cmd(f"tc filter add dev {interface} protocol ip parent 1:0 prio 1 u32 match ip dst 0.0.0.0/0 flowid 1:1")
-    else:
-        # Passthrough (no shaping)
-        run_cmd(f"tc qdisc add dev {interface} root handle 1: prio")
-        run_cmd(f"tc qdisc add dev {interface} parent 1:1 handle 2: netem delay 0ms")
-        run_cmd(f"tc filter add dev {interface} protocol ip parent 1:0 prio 1 u32 match ip dst 0.0.0.0/0 flowid 1:1")
+    with create_shaper(interface, backend) as shaper:
+        shaper.setup(delay_ms, jitter_ms, loss_pct, rate_mbps)
     
     print(f"✓ Configuration applied to {interface}")
 
@@ -77,6 +47,8 @@ def main():
     parser = argparse.ArgumentParser(description="Apply static network profile")
     parser.add_argument("profile_file", help="Path to YAML profile file")
     parser.add_argument("--interface", help="Interface to apply to (default: CLIENT_IF)", default=None)
+    parser.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help=f"Shaping backend (default: {DEFAULT_BACKEND})")
     
     args = parser.parse_args()
     
@@ -101,7 +73,11 @@ def main():
     rate_mbps = profile.get('rate_mbps', None)
     
     # Apply configuration
-    apply_netem_config(interface, delay_ms, jitter_ms, loss_pct, rate_mbps)
+    try:
+        apply_netem_config(interface, delay_ms, jitter_ms, loss_pct, rate_mbps, args.backend)
+    except ShapingError as e:
+        print(f"ERROR: Failed to apply profile to {interface}: {e}")
+        sys.exit(1)
     
     print("✓ Static profile applied successfully")
 
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Benchmark the shaping backends on a veth pair.
+
+Creates a veth pair, checks that each backend (see shaping.py) builds the
+traffic shaper's qdisc tree on an end without one, and times in-place netem
+changes with each backend, cycling through delay/jitter/loss/rate
+combinations like a trace replay does.
+Needs root (CAP_NET_ADMIN) and the sch_netem kernel module; run it in the
+traffic_shaper container:
+
+    docker exec traffic_shaper python3 /app/scripts/benchmark_shaping.py
+"""
+
+import sys
+import argparse
+import subprocess
+from shaping import (BACKENDS, ShapingError, build_tree, create_shaper, has_netem, run_tc,
+                     summarize_apply_times)
+
+# Parameter sets cycled through by the benchmark (delay_ms, jitter_ms, loss_pct, rate_mbps)
+STEPS = [
+    (20, 0, 0, None),
+    (35, 5, 0.5, 50),
+    (60, 10, 1.0, 20),
+    (45, 2, 0, 100),
+]
+
+
+def create_veth(name):
+    """Create and bring up a veth pair <name>a/<name>b; returns the first end."""
+    interface = f"{name}a"
+    subprocess.run(["ip", "link", "add", interface, "type", "veth", "peer", "name", f"{name}b"],
+                   check=True, capture_output=True, text=True)
+    for end in (interface, f"{name}b"):
+        subprocess.run(["ip", "link", "set", end, "up"], check=True)
+    return interface
+
+
+def delete_veth(interface):
+    """Delete a veth pair (removing one end removes both)."""
+    subprocess.run(["ip", "link", "del", interface], check=False, capture_output=True)
+
+
+def check_setup(interface, backend):
+    """
+    Check that a backend's setup() builds the qdisc tree on an interface
+    that has none, as on a fresh container.
+    
+    Returns:
+        True if the netem qdisc exists afterwards
+    """
+    run_tc(["qdisc", "del", "dev", interface, "root"], check=False)
+    with create_shaper(interface, backend) as shaper:
+        shaper.setup(*STEPS[0])
+    return has_netem(interface)
+
+
+def benchmark(interface, backend, steps):
+    """
+    Time in-place changes with one backend.
+    
+    Returns:
+        List of apply times in milliseconds
+    """
+    with create_shaper(interface, backend) as shaper:
+        # Warm up (first batch command starts tc, first send sets up the socket)
+        shaper.apply(*STEPS[0])
+        return [shaper.apply(*STEPS[i % len(STEPS)]) for i in range(steps)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark shaping backends on a veth pair")
+    parser.add_argument("--steps", type=int, default=2000, help="Changes per backend (default: 2000)")
+    parser.add_argument("--backend", action="append", choices=BACKENDS,
+                        help="Backend to benchmark (repeatable; default: all)")
+    parser.add_argument("--veth", default="shapebench", help="veth pair name prefix (default: shapebench)")
+    parser.add_argument("--target-ms", type=float, default=1.0,
+                        help="Required p99 apply time of the netlink backend (default: 1.0)")
+    
+    args = parser.parse_args()
+    
+    try:
+        interface = create_veth(args.veth)
+    except subprocess.CalledProcessError as e:
+        print(f"ERROR: Failed to create veth pair: {e.stderr.strip()}")
+        sys.exit(1)
+    
+    failed = False
+    try:
+        for backend in args.backend or BACKENDS:
+            if not check_setup(interface, backend):
+                print(f"✗ {backend} setup did not build the qdisc tree")
+                failed = True
+        
+        build_tree(interface, *STEPS[0])
+        for backend in args.backend or BACKENDS:
+            # Forking tc is slow: fewer steps give the same picture
+            steps = args.steps if backend != "tc" else min(args.steps, 200)
+            times = benchmark(interface, backend, steps)
+            print(f"{backend:8s} {summarize_apply_times(times)}")
+            if backend == "netlink":
+                p99 = sorted(times)[min(len(times) - 1, int(len(times) * 0.99))]
+                if p99 >= args.target_ms:
+                    print(f"✗ netlink p99 {p99:.3f}ms is not below {args.target_ms}ms")
+                    failed = True
+    except ShapingError as e:
+        print(f"ERROR: {e}")
+        failed = True
+    finally:
+        delete_veth(interface)
+    
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Compile a CSV network trace into the binary trace format.
+
+Validates the CSV with validate_trace.py's chunked checks (array operations
+with NumPy, row by row without), collapses consecutive points with
+identical network conditions and writes fixed-width records (see
+trace_format.py) that replay_trace.py and validate_trace.py memory-map:
+
+    python3 compile_trace.py trace.csv              # writes trace.trace
+    python3 compile_trace.py trace.csv -o /tmp/leo.trace
+    python3 replay_trace.py /tmp/leo.trace
+"""
+
+import os
+import sys
+import time
+import struct
+import argparse
+from trace_format import TraceWriter
+from validate_trace import ErrorReport, validate_csv_trace, np
+
+if np is not None:
+    from validate_trace import RECORD_DTYPE, RECORD_FIELDS
+
+# Largest value of the unsigned 32-bit record fields
+MAX_FIELD = 0xFFFFFFFF
+
+
+class _RecordSink:
+    """
+    Takes the place of validate_trace's TraceSummary: receives the encoded
+    points of every checked chunk and appends them to a TraceWriter.
+    """
+    
+    def __init__(self, writer):
+        self.writer = writer
+        self.rows = 0
+        self.out_of_range = 0
+    
+    def add_records(self, records):
+        """Append encoded points (tuples of RECORD fields), one at a time."""
+        for fields in records:
+            self.rows += 1
+            if min(fields[1:]) < 0:
+                # Already reported as a validation error
+                continue
+            try:
+                self.writer.add_fields(fields)
+            except struct.error:
+                self.out_of_range += 1
+    
+    def add_array(self, fields):
+        """Append encoded points (int64 array, one row of RECORD fields per point) at once."""
+        self.rows += len(fields)
+        too_large = (fields[:, 1:] > MAX_FIELD).any(axis=1)
+        if too_large.any():
+            # Compilation fails; nothing more needs to be written
+            self.out_of_range += int(too_large.sum())
+            return
+        
+        states = fields[:, 1:]
+        last = self.writer.last_state
+        changed = np.empty(len(fields), dtype=bool)
+        changed[0] = last is None or tuple(int(value) for value in states[0]) != last
+        changed[1:] = np.any(states[1:] != states[:-1], axis=1)
+        kept = fields[changed]
+        
+        # Negative values are validation errors; they wrap here but the
+        # trace is discarded anyway
+        records = np.empty(len(kept), dtype=RECORD_DTYPE)
+        for i, name in enumerate(RECORD_FIELDS):
+            records[name] = kept[:, i]
+        last_state = tuple(int(value) for value in kept[-1, 1:]) if len(kept) else last
+        self.writer.add_packed(records.tobytes(), len(kept), last_state, int(fields[-1, 0]))
+
+
+def compile_trace(csv_file, output_file):
+    """
+    Compile a CSV trace.
+    
+    Args:
+        csv_file: Path to the CSV trace
+        output_file: Path of the compiled trace
+    
+    Returns:
+        (errors, rows read, points written); nothing is written if there
+        are errors
+    """
+    report = ErrorReport()
+    writer = TraceWriter(output_file)
+    sink = _RecordSink(writer)
+    try:
+        validate_csv_trace(csv_file, report, sink)
+    except BaseException:
+        writer.abort()
+        raise
+    
+    if sink.out_of_range:
+        rows = "1 row" if sink.out_of_range == 1 else f"{sink.out_of_range} rows"
+        report.add(f"Values too large for the compiled format in {rows}")
+    if report:
+        writer.abort()
+        return report.messages(), sink.rows, 0
+    
+    writer.close()
+    return [], sink.rows, writer.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile a CSV network trace into the binary trace format")
+    parser.add_argument("trace_file", help="Path to CSV trace file")
+    parser.add_argument("-o", "--output", help="Output file (default: trace file with a .trace extension)")
+    
+    args = parser.parse_args()
+    
+    output_file = args.output or os.path.splitext(args.trace_file)[0] + ".trace"
+    
+    start = time.perf_counter()
+    try:
+        errors, rows, points = compile_trace(args.trace_file, output_file)
+    except OSError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    if errors:
+        print("Compilation FAILED:", file=sys.stderr)
+        for e in errors:
+            print(f"  ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    size = os.path.getsize(output_file)
+    print(f"✓ Compiled {rows} rows into {points} points ({size} bytes) in "
+          f"{time.perf_counter() - start:.2f}s: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,57 +2,43 @@
 """
 Replay time-varying network trace using tc/netem.
 
-Reads a CSV trace file and applies network conditions in real-time
-according to the trace timestamps.
+Reads a CSV trace file, or a trace compiled by compile_trace.py (memory-
+mapped and read point by point, so long traces start instantly and use
+flat memory), and applies network conditions in real-time according to the
+trace timestamps.
+
+The qdisc tree (prio root, netem child 2:, catch-all u32 filter) is built
+once at startup, or reused if the traffic shaper already set it up. Each
+trace step then only changes the netem parameters in place through a
+shaping backend (see shaping.py), which is atomic and keeps the packets
+queued in netem, so steps do not flush traffic in flight.
+
+Points are applied at absolute deadlines (replay start + time_ms) on the
+monotonic clock, so time spent applying a point or oversleeping never
+shifts the points after it. Points that are already overdue when the
+previous change completes are coalesced: only the latest of them is
+applied. With --log, every applied point is written to a CSV file:
+
+    index,time_ms,applied_ms,apply_ms,coalesced
+    1,1000,1000.412,0.031,0
+
+time_ms is the scheduled time and applied_ms the time the change completed,
+both relative to the replay start; apply_ms is how long the change took and
+coalesced the number of overdue points skipped in favour of this one.
 """
 
 import os
 import sys
 import csv
 import time
-import subprocess
+import bisect
 import argparse
-from datetime import datetime
-
-
-def run_cmd(cmd, check=True):
-    """Run a shell command and return the result."""
-    result = subprocess.run(
-        cmd, shell=True, capture_output=True, text=True, check=check
-    )
-    return result.stdout.strip()
-
+from shaping import BACKENDS, DEFAULT_BACKEND, ShapingError, create_shaper
+from trace_format import CompiledTrace, is_compiled_trace, parse_point
 
-def apply_netem_config(interface, delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None):
-    """Apply netem configuration to an interface."""
-    # Clear existing rules
-    run_cmd(f"tc qdisc del dev {interface} root", check=False)
-    
-    # Build netem command
-    netem_params = []
-    
-    if delay_ms > 0 or jitter_ms > 0:
-        if jitter_ms > 0:
-            netem_params.append(f"delay {delay_ms}ms {jitter_ms}ms")
-        else:
-            netem_params.append(f"delay {delay_ms}ms")
-    
-    if loss_pct > 0:
-        netem_params.append(f"loss {loss_pct}%")
-    
-    if rate_mbps:
-        netem_params.append(f"rate {rate_mbps}mbit")
-    
-    # Apply configuration
-    if netem_params:
-        netem_str = " ".join(netem_params)
-        run_cmd(f"tc qdisc add dev {interface} root handle 1: prio")
-        run_cmd(f"tc qdisc add dev {interface} parent 1:1 handle 2: netem {netem_str}")
-        run_cmd(f"tc filter add dev {interface} protocol ip parent 1:0 prio 1 u32 match ip dst 0.0.0.0/0 flowid 1:1")
-    else:
-        run_cmd(f"tc qdisc add dev {interface} root handle 1: prio")
-        run_cmd(f"tc qdisc add dev {interface} parent 1:1 handle 2: netem delay 0ms")
-        run_cmd(f"tc filter add dev {interface} protocol ip parent 1:0 prio 1 u32 match ip dst 0.0.0.0/0 flowid 1:1")
+# Resolution and range of the timing histograms (0.01 ms buckets up to 1 s)
+TIMING_BUCKET_MS = 0.01
+TIMING_BUCKETS = 100000
 
 
 def parse_trace_file(trace_file):
@@ -70,22 +56,161 @@ def parse_trace_file(trace_file):
     with open(trace_file, 'r') as f:
         reader = csv.DictReader(f)
         for row in reader:
-            trace_points.append({
-                'time_ms': int(row.get('time_ms', 0)),
-                'delay_ms': float(row.get('delay_ms', 0)),
-                'jitter_ms': float(row.get('jitter_ms', 0)),
-                'loss_pct': float(row.get('loss_pct', 0)),
-                'rate_mbps': float(row.get('rate_mbps', 0)) if row.get('rate_mbps') else None
-            })
+            trace_points.append(parse_point(row))
     
     return trace_points
 
 
+class TimingStats:
+    """Count, mean, approximate percentiles and max of durations in constant memory."""
+    
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = [0] * (TIMING_BUCKETS + 1)
+    
+    def add(self, value_ms):
+        value_ms = max(value_ms, 0.0)
+        self.count += 1
+        self.total += value_ms
+        self.max = max(self.max, value_ms)
+        self._buckets[min(int(value_ms / TIMING_BUCKET_MS), TIMING_BUCKETS)] += 1
+    
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile."""
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket, count in enumerate(self._buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((bucket + 1) * TIMING_BUCKET_MS, self.max)
+        return self.max
+    
+    def summary(self):
+        if not self.count:
+            return "none"
+        return (f"mean {self.total / self.count:.3f}ms, p50 {self.percentile(50):.3f}ms, "
+                f"p99 {self.percentile(99):.3f}ms, max {self.max:.3f}ms")
+
+
+class ReplayLog:
+    """Timing of every applied trace point, summarized and optionally logged to CSV."""
+    
+    COLUMNS = ["index", "time_ms", "applied_ms", "apply_ms", "coalesced"]
+    
+    def __init__(self, log_file=None):
+        """
+        Args:
+            log_file: Optional CSV file receiving one row per applied point
+        """
+        self.apply_times = TimingStats()
+        self.lateness = TimingStats()
+        self.coalesced = 0
+        self.failed = 0
+        self._file = None
+        self._writer = None
+        if log_file:
+            self._file = open(log_file, 'w', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(self.COLUMNS)
+    
+    def record(self, index, time_ms, applied_ms, apply_ms, coalesced):
+        """
+        Record an applied point.
+        
+        Args:
+            index: Index of the point in the trace
+            time_ms: Scheduled time, relative to the replay start
+            applied_ms: Time the change completed, relative to the replay start
+            apply_ms: Duration of the change, or None if it failed
+            coalesced: Number of overdue points skipped for this one
+        """
+        self.coalesced += coalesced
+        if apply_ms is None:
+            self.failed += 1
+        else:
+            self.apply_times.add(apply_ms)
+            self.lateness.add(applied_ms - time_ms)
+        if self._writer:
+            self._writer.writerow([
+                index, time_ms, f"{applied_ms:.3f}", "" if apply_ms is None else f"{apply_ms:.3f}", coalesced
+            ])
+    
+    def summary(self):
+        """Multi-line summary of apply times and scheduling error."""
+        return "\n".join([
+            f"{self.apply_times.count} points applied, {self.coalesced} coalesced, {self.failed} failed",
+            f"  Apply time: {self.apply_times.summary()}",
+            f"  Applied after deadline: {self.lateness.summary()}",
+        ])
+    
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def replay(shaper, trace_points, log, start_offset_s=0.0, verbose=False):
+    """
+    Apply trace points 1..n at their deadlines (point 0 is applied at setup).
+    
+    Args:
+        shaper: Shaper (see shaping.py) with the qdisc tree set up
+        trace_points: Points in time_ms order (list or CompiledTrace)
+        log: ReplayLog
+        start_offset_s: Delay of every deadline in seconds
+        verbose: Print every applied point
+    """
+    if isinstance(trace_points, CompiledTrace):
+        times_ms = trace_points.times_ms
+    else:
+        times_ms = [point['time_ms'] for point in trace_points]
+    start = time.monotonic() + start_offset_s
+    index = 1
+    
+    while index < len(trace_points):
+        deadline = start + times_ms[index] / 1000.0
+        remaining = deadline - time.monotonic()
+        while remaining > 0:
+            time.sleep(remaining)
+            remaining = deadline - time.monotonic()
+        
+        # Coalesce overdue points: apply only the latest one that is due
+        elapsed_ms = (time.monotonic() - start) * 1000
+        due = max(index, bisect.bisect_right(times_ms, elapsed_ms, index) - 1)
+        point = trace_points[due]
+        
+        try:
+            apply_ms = shaper.apply(
+                delay_ms=point['delay_ms'],
+                jitter_ms=point.get('jitter_ms', 0),
+                loss_pct=point['loss_pct'],
+                rate_mbps=point['rate_mbps']
+            )
+        except ShapingError as e:
+            print(f"ERROR: Failed to apply trace point at {point['time_ms']}ms: {e}")
+            apply_ms = None
+        applied_ms = (time.monotonic() - start) * 1000
+        log.record(due, point['time_ms'], applied_ms, apply_ms, due - index)
+        
+        if verbose and apply_ms is not None:
+            rate = f"{point['rate_mbps']}Mbps" if point['rate_mbps'] else "unlimited"
+            print(f"[{point['time_ms']}ms] delay={point['delay_ms']}ms loss={point['loss_pct']}% "
+                  f"rate={rate} applied at {applied_ms:.3f}ms in {apply_ms:.3f}ms")
+        
+        index = due + 1
+
+
 def main():
     parser = argparse.ArgumentParser(description="Replay network trace")
-    parser.add_argument("trace_file", help="Path to CSV trace file")
+    parser.add_argument("trace_file", help="Path to CSV or compiled trace file")
     parser.add_argument("--interface", help="Interface to apply to (default: CLIENT_IF)", default=None)
     parser.add_argument("--start-time", help="Start time offset in seconds", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true", help="Print every step and its apply time")
+    parser.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help=f"Shaping backend (default: {DEFAULT_BACKEND})")
+    parser.add_argument("--log", help="Write per-point timing (scheduled, applied, apply duration) to this CSV file")
     
     args = parser.parse_args()
     
@@ -95,9 +220,12 @@ def main():
         print("ERROR: No interface specified. Set CLIENT_IF environment variable or use --interface")
         sys.exit(1)
     
-    # Parse trace
+    # Parse trace (compiled traces were validated by compile_trace.py)
     try:
-        trace_points = parse_trace_file(args.trace_file)
+        if is_compiled_trace(args.trace_file):
+            trace_points = CompiledTrace(args.trace_file)
+        else:
+            trace_points = parse_trace_file(args.trace_file)
     except Exception as e:
         print(f"ERROR: Failed to parse trace file: {e}")
         sys.exit(1)
@@ -106,53 +234,59 @@ def main():
         print("ERROR: Trace file is empty")
         sys.exit(1)
     
+    if isinstance(trace_points, list) and any(
+        a['time_ms'] > b['time_ms'] for a, b in zip(trace_points, trace_points[1:])
+    ):
+        print("ERROR: time_ms must be monotonically increasing (see validate_trace.py)")
+        sys.exit(1)
+    
     print(f"Loaded {len(trace_points)} trace points")
-    print(f"Starting trace replay on {interface}...")
+    
+    # Build (or reuse) the qdisc tree once, with the first point applied
+    first = trace_points[0]
+    try:
+        shaper = create_shaper(interface, args.backend)
+        shaper.setup(first['delay_ms'], first['jitter_ms'], first['loss_pct'], first['rate_mbps'])
+    except ShapingError as e:
+        print(f"ERROR: Failed to set up qdiscs on {interface}: {e}")
+        sys.exit(1)
+    
+    print(f"Starting trace replay on {interface} ({shaper.backend} backend)...")
     print("Press Ctrl+C to stop")
     
-    start_time = time.time() + args.start_time
-    trace_index = 0
+    try:
+        log = ReplayLog(args.log)
+    except OSError as e:
+        print(f"ERROR: Failed to open log file: {e}")
+        shaper.close()
+        sys.exit(1)
     
     try:
-        while trace_index < len(trace_points):
-            current_time = time.time()
-            elapsed_ms = (current_time - start_time) * 1000
-            
-            # Find the appropriate trace point
-            while (trace_index < len(trace_points) - 1 and 
-                   trace_points[trace_index + 1]['time_ms'] <= elapsed_ms):
-                trace_index += 1
-            
-            point = trace_points[trace_index]
-            
-            # Apply configuration
-            apply_netem_config(
-                interface,
-                delay_ms=point['delay_ms'],
-                jitter_ms=point.get('jitter_ms', 0),
-                loss_pct=point['loss_pct'],
-                rate_mbps=point['rate_mbps']
-            )
-            
-            # Calculate sleep time until next point
-            if trace_index < len(trace_points) - 1:
-                next_time_ms = trace_points[trace_index + 1]['time_ms']
-                sleep_ms = next_time_ms - elapsed_ms
-                if sleep_ms > 0:
-                    time.sleep(sleep_ms / 1000.0)
-                trace_index += 1
-            else:
-                # Last point, keep it applied
-                print(f"Trace complete. Final state: delay={point['delay_ms']}ms, loss={point['loss_pct']}%")
-                time.sleep(1)
+        replay(shaper, trace_points, log, args.start_time, args.verbose)
+        
+        # Last point, keep it applied
+        point = trace_points[-1]
+        print(f"Trace complete. Final state: delay={point['delay_ms']}ms, loss={point['loss_pct']}%")
+        print(log.summary())
+        log.close()
+        log = None
+        while True:
+            time.sleep(1)
     
     except KeyboardInterrupt:
         print("\nTrace replay interrupted")
+        if log:
+            print(log.summary())
         # Reset to passthrough
-        apply_netem_config(interface, delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None)
+        shaper.reset()
         print("Reset to passthrough configuration")
+    finally:
+        if log:
+            log.close()
+        shaper.close()
+        if isinstance(trace_points, CompiledTrace):
+            trace_points.close()
 
 
 if __name__ == "__main__":
     main()
-
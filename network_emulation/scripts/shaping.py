@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""
+Shaping backends shared by apply_static_profile.py and replay_trace.py.
+
+The traffic shaper's qdisc tree (prio root 1:, netem child 2:, catch-all u32
+filter) is built once with tc, or reused if entrypoint.sh already built it.
+Network conditions are then changed in place on the netem qdisc, atomically
+and without flushing the packets it holds, by one of these backends:
+
+- netlink: RTM_NEWQDISC requests on one long-lived rtnetlink socket; no
+  process is forked per change (default)
+- batch: commands piped into one persistent `tc -batch -` process
+- tc: one tc process per change
+
+The backend can be chosen with --backend or the SHAPING_BACKEND environment
+variable. benchmark_shaping.py measures them on a veth pair.
+"""
+
+import errno
+import math
+import os
+import socket
+import struct
+import subprocess
+import time
+
+BACKENDS = ["netlink", "batch", "tc"]
+
+DEFAULT_BACKEND = os.getenv("SHAPING_BACKEND", "netlink")
+
+# netem queue limit in packets (tc's default; a change always sets it)
+NETEM_LIMIT = 1000
+
+# tc cannot drop a netem rate limit in place (it omits "rate" when none is
+# given and the kernel keeps the old one), so the tc backends lift a limit
+# with a rate far above any link the testbed emulates
+UNLIMITED_RATE = "100gbit"
+
+# Handles of the tree built by build_tree()
+ROOT_HANDLE = "1:"
+NETEM_PARENT = "1:1"
+NETEM_HANDLE = "2:"
+
+
+class ShapingError(Exception):
+    """Raised when the kernel or tc rejects a shaping change."""
+
+
+class NetemMissingError(ShapingError):
+    """Raised when the interface has no netem qdisc to change (no tree yet)."""
+
+
+def shows_netem(output):
+    """
+    True if `tc qdisc show dev <interface> parent 1:1` output lists the
+    tree's netem qdisc.
+    
+    >>> shows_netem("qdisc netem 2: parent 1:1 limit 1000 delay 20ms\\n")
+    True
+    >>> shows_netem("")
+    False
+    >>> shows_netem("qdisc pfifo 10: parent 1:1 limit 1000p\\n")
+    False
+    """
+    return any(line.split()[:3] == ["qdisc", "netem", NETEM_HANDLE] for line in output.splitlines())
+
+
+def has_netem(interface):
+    """
+    True if the interface has the netem qdisc of the tree.
+    
+    Raises:
+        ShapingError: If tc cannot list the interface's qdiscs (e.g. no
+                      such device)
+    """
+    result = run_tc(["qdisc", "show", "dev", interface, "parent", NETEM_PARENT], check=False)
+    if result.returncode != 0:
+        raise ShapingError(result.stderr.strip() or f"tc exited with {result.returncode}")
+    return shows_netem(result.stdout)
+
+
+def _tc_error(interface, message):
+    """
+    Error for a rejected tc change: NetemMissingError if the interface has
+    no netem qdisc, otherwise ShapingError with tc's message.
+    
+    The messages differ across iproute2 and kernel versions, so the qdiscs
+    are listed rather than the message matched.
+    """
+    if not has_netem(interface):
+        return NetemMissingError(message)
+    return ShapingError(message)
+
+
+def check_netem_params(delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None):
+    """
+    Validate netem parameters before they reach tc or the kernel.
+    
+    Raises:
+        ShapingError: If a value is negative, not finite or out of range
+    """
+    for name, value in (("delay_ms", delay_ms), ("jitter_ms", jitter_ms), ("loss_pct", loss_pct)):
+        if not math.isfinite(value) or value < 0:
+            raise ShapingError(f"Invalid {name}: {value} (must be a finite value >= 0)")
+    if loss_pct > 100:
+        raise ShapingError(f"Invalid loss_pct: {loss_pct} (must be at most 100)")
+    if rate_mbps is not None and (not math.isfinite(rate_mbps) or rate_mbps < 0):
+        raise ShapingError(f"Invalid rate_mbps: {rate_mbps} (must be a finite value >= 0)")
+
+
+def run_tc(args, check=True):
+    """Run a tc command (argument list, no shell) and return the result."""
+    return subprocess.run(
+        ["tc"] + args, capture_output=True, text=True, check=check
+    )
+
+
+def netem_args(delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None, unlimited_rate=False):
+    """
+    Build netem parameters for tc.
+    
+    Args:
+        delay_ms: Base delay in milliseconds
+        jitter_ms: Jitter (delay variation) in milliseconds
+        loss_pct: Packet loss percentage (0-100)
+        rate_mbps: Rate limit in Mbps (optional)
+        unlimited_rate: Without rate_mbps, set UNLIMITED_RATE to lift a
+                        previously applied limit
+    
+    Returns:
+        List of tc arguments following "netem"
+    """
+    params = ["delay", f"{delay_ms}ms"]
+    if jitter_ms > 0:
+        params.append(f"{jitter_ms}ms")
+    
+    if loss_pct > 0:
+        params += ["loss", f"{loss_pct}%"]
+    
+    if rate_mbps:
+        params += ["rate", f"{rate_mbps}mbit"]
+    elif unlimited_rate:
+        params += ["rate", UNLIMITED_RATE]
+    
+    return params
+
+
+def change_args(interface, params):
+    """tc arguments changing the netem qdisc of the tree in place."""
+    return ["qdisc", "change", "dev", interface, "parent", NETEM_PARENT, "handle", NETEM_HANDLE,
+            "netem"] + params
+
+
+def build_tree(interface, delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None):
+    """
+    (Re)build the qdisc tree of an interface; packets queued in the old
+    tree are dropped.
+    
+    Raises:
+        ShapingError: If a parameter is invalid or tc failed
+    """
+    check_netem_params(delay_ms, jitter_ms, loss_pct, rate_mbps)
+    run_tc(["qdisc", "del", "dev", interface, "root"], check=False)
+    commands = [
+        ["qdisc", "add", "dev", interface, "root", "handle", ROOT_HANDLE, "prio"],
+        ["qdisc", "add", "dev", interface, "parent", NETEM_PARENT, "handle", NETEM_HANDLE, "netem"]
+        + netem_args(delay_ms, jitter_ms, loss_pct, rate_mbps),
+        ["filter", "add", "dev", interface, "protocol", "ip", "parent", "1:0", "prio", "1",
+         "u32", "match", "ip", "dst", "0.0.0.0/0", "flowid", NETEM_PARENT],
+    ]
+    for command in commands:
+        result = run_tc(command, check=False)
+        if result.returncode != 0:
+            raise ShapingError(f"tc {' '.join(command)}: {result.stderr.strip()}")
+
+
+def summarize_apply_times(apply_times_ms):
+    """Format count, mean, median, p99 and max of the step apply times."""
+    if not apply_times_ms:
+        return "no steps applied"
+    
+    ordered = sorted(apply_times_ms)
+    mean = sum(ordered) / len(ordered)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return (f"{len(ordered)} steps, apply time mean {mean:.3f}ms, p50 {p50:.3f}ms, "
+            f"p99 {p99:.3f}ms, max {ordered[-1]:.3f}ms")
+
+
+class Shaper:
+    """Netem qdisc of an interface, changed in place by a backend."""
+    
+    backend = None
+    
+    def __init__(self, interface):
+        """
+        Args:
+            interface: Network interface name
+        """
+        self.interface = interface
+    
+    def setup(self, delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None):
+        """
+        Apply an initial configuration, building the qdisc tree if the
+        interface does not have its netem qdisc yet. Any other error is
+        raised as is rather than tearing down a working tree.
+        
+        Raises:
+            ShapingError: If a parameter is invalid, the change was rejected
+                          or the tree could not be built
+        """
+        check_netem_params(delay_ms, jitter_ms, loss_pct, rate_mbps)
+        try:
+            self._change(delay_ms, jitter_ms, loss_pct, rate_mbps, initial=True)
+        except NetemMissingError:
+            build_tree(self.interface, delay_ms, jitter_ms, loss_pct, rate_mbps)
+            self._built(rate_mbps)
+    
+    def apply(self, delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None):
+        """
+        Change the netem parameters in place.
+        
+        Returns:
+            Time taken in milliseconds
+        
+        Raises:
+            ShapingError: If a parameter is invalid or the change was rejected
+        """
+        check_netem_params(delay_ms, jitter_ms, loss_pct, rate_mbps)
+        start = time.perf_counter()
+        self._change(delay_ms, jitter_ms, loss_pct, rate_mbps)
+        return (time.perf_counter() - start) * 1000
+    
+    def reset(self):
+        """Return to passthrough (no delay, loss or rate limit)."""
+        self.apply(delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None)
+    
+    def close(self):
+        """Release the backend's socket or process."""
+    
+    def _change(self, delay_ms, jitter_ms, loss_pct, rate_mbps, initial=False):
+        raise NotImplementedError
+    
+    def _built(self, rate_mbps):
+        """Called after build_tree() applied a configuration."""
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TcShaper(Shaper):
+    """Runs one tc process per change."""
+    
+    backend = "tc"
+    
+    def __init__(self, interface):
+        super().__init__(interface)
+        self.rate_limited = False
+    
+    def _tc_change(self, args):
+        result = run_tc(args, check=False)
+        if result.returncode != 0:
+            raise _tc_error(self.interface, result.stderr.strip() or f"tc exited with {result.returncode}")
+    
+    def _change(self, delay_ms, jitter_ms, loss_pct, rate_mbps, initial=False):
+        # Initially, a rate set before we started may be in effect: lift it
+        params = netem_args(delay_ms, jitter_ms, loss_pct, rate_mbps,
+                            unlimited_rate=initial or self.rate_limited)
+        self._tc_change(change_args(self.interface, params))
+        self.rate_limited = bool(rate_mbps)
+    
+    def _built(self, rate_mbps):
+        self.rate_limited = bool(rate_mbps)
+
+
+class BatchShaper(TcShaper):
+    """Pipes changes into one persistent `tc -batch -` process."""
+    
+    backend = "batch"
+    
+    # Answered by tc after the preceding command completed: tc runs batch
+    # commands in order and flushes its output after each one
+    SYNC_COMMAND = "qdisc show dev lo\n"
+    
+    def __init__(self, interface):
+        super().__init__(interface)
+        self._process = subprocess.Popen(
+            ["tc", "-force", "-batch", "-"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0
+        )
+        os.set_blocking(self._process.stderr.fileno(), False)
+    
+    def _tc_change(self, args):
+        if self._process.poll() is not None:
+            raise ShapingError(f"tc -batch exited with {self._process.returncode}")
+        # Drop output of earlier commands that is still pending
+        self._read_errors()
+        self._process.stdin.write((" ".join(args) + "\n" + self.SYNC_COMMAND).encode())
+        if not os.read(self._process.stdout.fileno(), 65536):
+            raise ShapingError("tc -batch exited")
+        # Errors of the change are written before the sync command runs
+        errors = self._read_errors()
+        if errors:
+            raise _tc_error(self.interface, errors.splitlines()[0])
+    
+    def _read_errors(self):
+        try:
+            return (os.read(self._process.stderr.fileno(), 65536) or b"").decode(errors="replace")
+        except BlockingIOError:
+            return ""
+    
+    def close(self):
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            self._process.wait()
+        self._process.stdout.close()
+        self._process.stderr.close()
+
+
+# rtnetlink constants (linux/netlink.h, linux/rtnetlink.h, linux/pkt_sched.h)
+RTM_NEWQDISC = 36
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_CAPPED = 0x100
+NLM_F_ACK_TLVS = 0x200
+SOL_NETLINK = 270
+NETLINK_CAP_ACK = 10
+NETLINK_EXT_ACK = 11
+NLMSGERR_ATTR_MSG = 1
+TCA_KIND = 1
+TCA_OPTIONS = 2
+TCA_NETEM_RATE = 6
+TCA_NETEM_RATE64 = 8
+TCA_NETEM_LATENCY64 = 10
+TCA_NETEM_JITTER64 = 11
+
+# The kernel's packet scheduler clock: 1 tick = 64 ns (PSCHED_SHIFT)
+PSCHED_SHIFT = 6
+
+
+def _tc_handle(handle):
+    """Parse a tc handle such as "1:1" or "2:" into its 32-bit value."""
+    major, _, minor = handle.partition(":")
+    return (int(major or "0", 16) << 16) | int(minor or "0", 16)
+
+
+def _attribute(attribute_type, data):
+    """Encode a netlink attribute, padded to 4 bytes."""
+    length = 4 + len(data)
+    return struct.pack("=HH", length, attribute_type) + data + b"\0" * (-length % 4)
+
+
+def netem_options(delay_ms=0, jitter_ms=0, loss_pct=0, rate_mbps=None):
+    """
+    Encode netem parameters as the TCA_OPTIONS payload (struct
+    tc_netem_qopt followed by netem attributes), as tc does.
+    
+    A missing rate_mbps is sent as rate 0, which lifts a previous limit.
+    
+    Raises:
+        ShapingError: If a parameter is invalid
+    """
+    check_netem_params(delay_ms, jitter_ms, loss_pct, rate_mbps)
+    latency_ns = int(round(delay_ms * 1e6))
+    jitter_ns = int(round(jitter_ms * 1e6))
+    loss = min(0xFFFFFFFF, int(round(loss_pct / 100.0 * 0xFFFFFFFF)))
+    options = struct.pack(
+        "=6I",
+        min(0xFFFFFFFF, latency_ns >> PSCHED_SHIFT),
+        NETEM_LIMIT,
+        loss,
+        0,  # gap
+        0,  # duplicate
+        min(0xFFFFFFFF, jitter_ns >> PSCHED_SHIFT)
+    )
+    
+    rate_bytes = int(rate_mbps * 1e6 / 8) if rate_mbps else 0
+    try:
+        if rate_bytes >= 1 << 32:
+            options += _attribute(TCA_NETEM_RATE64, struct.pack("=Q", rate_bytes))
+            rate_bytes = 0xFFFFFFFF
+        options += _attribute(TCA_NETEM_RATE, struct.pack("=IiIi", rate_bytes, 0, 0, 0))
+        options += _attribute(TCA_NETEM_LATENCY64, struct.pack("=q", latency_ns))
+        options += _attribute(TCA_NETEM_JITTER64, struct.pack("=q", jitter_ns))
+    except struct.error as e:
+        raise ShapingError(f"Netem parameters out of range: {e}")
+    return options
+
+
+class NetlinkShaper(Shaper):
+    """Sends netem changes over one long-lived rtnetlink socket."""
+    
+    backend = "netlink"
+    
+    def __init__(self, interface):
+        super().__init__(interface)
+        try:
+            self._ifindex = socket.if_nametoindex(interface)
+        except OSError:
+            raise ShapingError(f"Unknown interface: {interface}")
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self._socket.bind((0, 0))
+        # Short acks with the kernel's error message
+        for option in (NETLINK_CAP_ACK, NETLINK_EXT_ACK):
+            try:
+                self._socket.setsockopt(SOL_NETLINK, option, 1)
+            except OSError:
+                pass
+        self._seq = 0
+        self._header = struct.pack(
+            "=BxxxiII", socket.AF_UNSPEC, self._ifindex, _tc_handle(NETEM_HANDLE), _tc_handle(NETEM_PARENT)
+        ) + struct.pack("=I", 0) + _attribute(TCA_KIND, b"netem\0")
+    
+    def _change(self, delay_ms, jitter_ms, loss_pct, rate_mbps, initial=False):
+        self._seq += 1
+        body = self._header + _attribute(TCA_OPTIONS, netem_options(delay_ms, jitter_ms, loss_pct, rate_mbps))
+        # No NLM_F_CREATE: only change the existing netem qdisc
+        message = struct.pack("=IHHII", 16 + len(body), RTM_NEWQDISC, NLM_F_REQUEST | NLM_F_ACK, self._seq, 0)
+        self._socket.send(message + body)
+        self._wait_ack(self._seq)
+    
+    def _wait_ack(self, seq):
+        """
+        Wait for the kernel's ack of a request.
+        
+        Raises:
+            ShapingError: If the kernel rejected it
+        """
+        while True:
+            data = self._socket.recv(65536)
+            offset = 0
+            while offset + 16 <= len(data):
+                length, message_type, flags, message_seq, _ = struct.unpack_from("=IHHII", data, offset)
+                if message_type == NLMSG_ERROR and message_seq == seq:
+                    error = struct.unpack_from("=i", data, offset + 16)[0]
+                    if error == 0:
+                        return
+                    message = self._error_message(data[offset:offset + length], flags, error)
+                    if error == -errno.ENOENT:
+                        raise NetemMissingError(message)
+                    raise ShapingError(message)
+                offset += (length + 3) & ~3
+    
+    @staticmethod
+    def _error_message(message, flags, error):
+        """The kernel's extended ack message if present, otherwise strerror."""
+        if flags & NLM_F_ACK_TLVS:
+            # Error code, echoed request header (capped) or whole request
+            offset = 20 + (16 if flags & NLM_F_CAPPED else struct.unpack_from("=I", message, 20)[0])
+            while offset + 4 <= len(message):
+                length, attribute_type = struct.unpack_from("=HH", message, offset)
+                if length < 4:
+                    break
+                if attribute_type == NLMSGERR_ATTR_MSG:
+                    return message[offset + 4:offset + length].rstrip(b"\0").decode(errors="replace")
+                offset += (length + 3) & ~3
+        return os.strerror(-error)
+    
+    def close(self):
+        self._socket.close()
+
+
+_SHAPERS = {
+    "netlink": NetlinkShaper,
+    "batch": BatchShaper,
+    "tc": TcShaper,
+}
+
+
+def create_shaper(interface, backend=DEFAULT_BACKEND):
+    """
+    Create a shaper for an interface.
+    
+    Args:
+        interface: Network interface name
+        backend: One of BACKENDS
+    
+    Raises:
+        ValueError: If the backend is unknown
+        ShapingError: If the backend could not be started
+    """
+    if backend not in _SHAPERS:
+        raise ValueError(f"Unknown shaping backend: {backend} (expected one of {', '.join(BACKENDS)})")
+    try:
+        return _SHAPERS[backend](interface)
+    except OSError as e:
+        raise ShapingError(f"Failed to start {backend} backend: {e}")
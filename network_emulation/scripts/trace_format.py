@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Compiled binary trace format.
+
+compile_trace.py turns a CSV trace into a file of fixed-width records that
+replay_trace.py and validate_trace.py memory-map and read point by point,
+so startup is immediate and memory stays flat whatever the trace length.
+
+Layout (little-endian):
+
+    header  magic "NETRACE\\0", version u32, record size u32,
+            point count u64, end time_ms i64 (time of the last CSV row)
+    records time_ms i64, delay_us u32, jitter_us u32, loss_ppm u32,
+            rate_kbps u32 (0: no rate limit)
+
+Values are stored in fixed point (microseconds, parts per million of
+packets, kbit/s), so compiled points compare exactly and consecutive
+identical points can be collapsed.
+"""
+
+import mmap
+import os
+import struct
+
+MAGIC = b"NETRACE\0"
+VERSION = 1
+
+HEADER = struct.Struct("<8sIIQq")
+RECORD = struct.Struct("<qIIII")
+
+# Records decoded per chunk when streaming through a trace
+CHUNK_RECORDS = 65536
+
+
+class TraceFormatError(Exception):
+    """Raised when a compiled trace file is malformed."""
+
+
+def parse_point(row):
+    """
+    Build a trace point from a CSV row (dict from csv.DictReader).
+    
+    Raises:
+        ValueError: If a value is not numeric
+    """
+    return {
+        'time_ms': int(row.get('time_ms', 0)),
+        'delay_ms': float(row.get('delay_ms', 0)),
+        'jitter_ms': float(row.get('jitter_ms') or 0),
+        'loss_pct': float(row.get('loss_pct', 0)),
+        'rate_mbps': float(row.get('rate_mbps')) if row.get('rate_mbps') else None
+    }
+
+
+def encode_point(point):
+    """
+    Fixed-point record fields of a trace point (see module docstring).
+    
+    A rate that is not > 0 (invalid, or NaN) is encoded as 0, no rate
+    limit, as validate_trace.py's vectorized check does.
+    """
+    rate_mbps = point['rate_mbps']
+    return (
+        point['time_ms'],
+        int(round(point['delay_ms'] * 1000)),
+        int(round(point['jitter_ms'] * 1000)),
+        int(round(point['loss_pct'] * 10000)),
+        max(1, int(round(rate_mbps * 1000))) if rate_mbps is not None and rate_mbps > 0 else 0
+    )
+
+
+def decode_point(fields):
+    """Trace point dict from record fields."""
+    time_ms, delay_us, jitter_us, loss_ppm, rate_kbps = fields
+    return {
+        'time_ms': time_ms,
+        'delay_ms': delay_us / 1000.0,
+        'jitter_ms': jitter_us / 1000.0,
+        'loss_pct': loss_ppm / 10000.0,
+        'rate_mbps': rate_kbps / 1000.0 if rate_kbps else None
+    }
+
+
+def is_compiled_trace(path):
+    """True if the file starts with the compiled trace magic."""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class TraceWriter:
+    """Writes a compiled trace, collapsing consecutive identical points."""
+    
+    def __init__(self, path):
+        """
+        The trace is written to a temporary file next to path and renamed
+        by close(), so a failed compile never leaves a partial trace.
+        """
+        self.path = path
+        self.count = 0
+        self.end_time_ms = 0
+        self._last = None
+        self._tmp_path = f"{path}.part"
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, 0, 0))
+    
+    def add(self, point):
+        """
+        Append a point, unless it only repeats the previous one.
+        
+        Returns:
+            True if the point was written, False if it was collapsed
+        """
+        return self.add_fields(encode_point(point))
+    
+    def add_fields(self, fields):
+        """
+        add() for a point already encoded by encode_point().
+        
+        Raises:
+            struct.error: If a value does not fit its record field
+        """
+        self.end_time_ms = fields[0]
+        if self._last is not None and tuple(fields[1:]) == self._last:
+            return False
+        self._file.write(RECORD.pack(*fields))
+        self._last = tuple(fields[1:])
+        self.count += 1
+        return True
+    
+    @property
+    def last_state(self):
+        """(delay_us, jitter_us, loss_ppm, rate_kbps) of the last written point, or None."""
+        return self._last
+    
+    def add_packed(self, data, count, last_state, end_time_ms):
+        """
+        Append count records already packed in RECORD layout (e.g. from a
+        NumPy array), with repeated points already collapsed against
+        last_state and each other.
+        
+        Args:
+            data: Packed records
+            count: Number of records in data
+            last_state: last_state after the final record
+            end_time_ms: time_ms of the last CSV row they cover
+        """
+        self._file.write(data)
+        self.count += count
+        if count:
+            self._last = last_state
+        self.end_time_ms = end_time_ms
+    
+    def close(self):
+        """Write the header and move the trace into place."""
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, self.count, self.end_time_ms))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+    
+    def abort(self):
+        """Discard the trace."""
+        self._file.close()
+        os.remove(self._tmp_path)
+
+
+class _Times:
+    """Sequence view of the time_ms of a trace's points (e.g. for bisect)."""
+    
+    def __init__(self, trace):
+        self._trace = trace
+    
+    def __len__(self):
+        return len(self._trace)
+    
+    def __getitem__(self, index):
+        return self._trace.time_ms(index)
+
+
+class CompiledTrace:
+    """Memory-mapped compiled trace; a read-only sequence of point dicts."""
+    
+    def __init__(self, path):
+        """
+        Raises:
+            TraceFormatError: If the file is not a valid compiled trace
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise TraceFormatError("File is too short for a compiled trace header")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        magic, version, record_size, self.count, self.end_time_ms = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self.close()
+            raise TraceFormatError("Not a compiled trace (bad magic)")
+        if version != VERSION or record_size != RECORD.size:
+            self.close()
+            raise TraceFormatError(f"Unsupported compiled trace version {version} (record size {record_size})")
+        if size != HEADER.size + self.count * RECORD.size:
+            self.close()
+            raise TraceFormatError(f"File size {size} does not match {self.count} points (truncated?)")
+        self.times_ms = _Times(self)
+    
+    def __len__(self):
+        return self.count
+    
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return decode_point(RECORD.unpack_from(self._mmap, HEADER.size + index * RECORD.size))
+    
+    def time_ms(self, index):
+        """time_ms of a point, without decoding the rest of it."""
+        return struct.unpack_from("<q", self._mmap, HEADER.size + index * RECORD.size)[0]
+    
+    def iter_chunks(self):
+        """Iterate over the raw bytes of up to CHUNK_RECORDS records at a time."""
+        end = HEADER.size + self.count * RECORD.size
+        chunk_size = CHUNK_RECORDS * RECORD.size
+        for offset in range(HEADER.size, end, chunk_size):
+            yield self._mmap[offset:min(offset + chunk_size, end)]
+    
+    def iter_records(self):
+        """Iterate over raw record field tuples (see RECORD) in file order."""
+        for chunk in self.iter_chunks():
+            yield from RECORD.iter_unpack(chunk)
+    
+    def __iter__(self):
+        return (decode_point(fields) for fields in self.iter_records())
+    
+    def close(self):
+        self._mmap.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
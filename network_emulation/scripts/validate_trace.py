@@ -1,89 +1,682 @@
 #!/usr/bin/env python3
 """
 Validate network trace CSV file format and content.
+
+Compiled traces (see compile_trace.py) are validated too: the header is
+checked and the memory-mapped points are streamed through.
+
+Traces are checked CHUNK_ROWS rows at a time, so memory does not grow with
+the trace length. With NumPy, each chunk is parsed and checked with array
+operations, and only rows with invalid values (or chunks with malformed
+lines) are checked row by row; without NumPy, every row is. The trace is
+summarized as it is checked:
+
+    Points: 2000000 (600115 netem changes, 95819 distinct netem states)
+    Duration: 19999.990s
+    Step interval (ms): min 10, p5 10, p50 10, p95 10, p99 10, max 10
+    Delay (ms): min 20, p5 23.01, p50 50.01, p95 76.99, p99 79.4, max 80
+    ...
+
+Errors are grouped by message, each with a count and its first rows:
+
+    ERROR: delay_ms must be >= 0: 1994 rows (1001, 2001, 3001, 4001, 5001, ...)
 """
 
 import sys
 import csv
+import math
+import time
+import bisect
 import argparse
+import itertools
+from collections import Counter
+from trace_format import (
+    RECORD, CompiledTrace, TraceFormatError, encode_point, is_compiled_trace, parse_point
+)
 
+try:
+    import numpy as np
+except ImportError:  # chunks are checked row by row
+    np = None
 
-def validate_trace_file(trace_file):
-    """Validate trace file format."""
-    errors = []
-    warnings = []
+REQUIRED_COLUMNS = ['time_ms', 'delay_ms', 'loss_pct']
+OPTIONAL_COLUMNS = ['jitter_ms', 'rate_mbps']
+
+# Rows read and checked at a time
+CHUNK_ROWS = 65536
+
+# Line numbers listed per error message, and distinct messages reported
+MAX_ERROR_ROWS = 5
+MAX_ERROR_MESSAGES = 20
+
+# Error messages shared by the row-by-row and array checks
+TIME_ERROR = "time_ms must be monotonically increasing"
+DELAY_ERROR = "delay_ms must be >= 0"
+JITTER_ERROR = "jitter_ms must be >= 0"
+LOSS_ERROR = "loss_pct must be between 0 and 100"
+RATE_ERROR = "rate_mbps must be > 0"
+
+# Percentiles in the summary, besides min and max
+SUMMARY_PERCENTILES = [5, 50, 95, 99]
+
+# Summary distributions: key, label, fixed-point scale (see trace_format.py)
+SUMMARY_FIELDS = [
+    ('interval_ms', 'Step interval (ms)', 1),
+    ('delay_us', 'Delay (ms)', 1000),
+    ('jitter_us', 'Jitter (ms)', 1000),
+    ('loss_ppm', 'Loss (%)', 10000),
+    ('rate_kbps', 'Rate (Mbps)', 1000),
+]
+
+# Fields of a compiled trace record (trace_format.RECORD)
+RECORD_FIELDS = ['time_ms', 'delay_us', 'jitter_us', 'loss_ppm', 'rate_kbps']
+if np is not None:
+    RECORD_DTYPE = np.dtype(list(zip(RECORD_FIELDS, ['<i8', '<u4', '<u4', '<u4', '<u4'])))
+
+
+class ErrorReport:
+    """
+    Validation errors grouped by message.
     
-    try:
-        with open(trace_file, 'r') as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-            
+    Each message keeps a count and the first MAX_ERROR_ROWS line numbers it
+    was found on; past MAX_ERROR_MESSAGES distinct messages, errors are
+    only counted.
+    """
+    
+    def __init__(self, label="Row"):
+        """
+        Args:
+            label: What the numbers refer to ("Row" for CSV lines,
+                "Point" for compiled trace points)
+        """
+        self.label = label
+        self.total = 0
+        self.other = 0
+        self._counts = {}
+        self._rows = {}
+    
+    def add(self, message, rows=None):
+        """
+        Record an error.
+        
+        Args:
+            message: Error message, without a row number
+            rows: Line numbers the error was found on (list or array), or
+                None for an error about the whole file
+        """
+        count = 1 if rows is None else len(rows)
+        if not count:
+            return
+        self.total += count
+        if message not in self._counts and len(self._counts) >= MAX_ERROR_MESSAGES:
+            self.other += count
+            return
+        self._counts[message] = self._counts.get(message, 0) + count
+        first = self._rows.setdefault(message, [])
+        if rows is not None:
+            first.extend(int(row) for row in rows[:MAX_ERROR_ROWS - len(first)])
+    
+    def __bool__(self):
+        return self.total > 0
+    
+    def messages(self):
+        """One line per message, with its row, or its count and first rows (in row order)."""
+        lines = []
+        for message in sorted(self._counts, key=lambda message: self._rows[message][:1]):
+            count = self._counts[message]
+            rows = self._rows[message]
             if not rows:
-                errors.append("Trace file is empty")
-                return errors, warnings
-            
-            # Check required columns
-            required_cols = ['time_ms', 'delay_ms', 'loss_pct']
-            for col in required_cols:
-                if col not in reader.fieldnames:
-                    errors.append(f"Missing required column: {col}")
-            
-            if errors:
-                return errors, warnings
-            
-            # Validate data
-            prev_time = -1
-            for i, row in enumerate(rows, start=2):
-                try:
-                    time_ms = int(row['time_ms'])
-                    delay_ms = float(row['delay_ms'])
-                    loss_pct = float(row['loss_pct'])
-                    
+                lines.append(message)
+            elif count == 1:
+                lines.append(f"{self.label} {rows[0]}: {message}")
+            else:
+                listed = ", ".join(str(row) for row in rows)
+                more = ", ..." if count > len(rows) else ""
+                lines.append(f"{message}: {count} {self.label.lower()}s ({listed}{more})")
+        if self.other:
+            lines.append(f"{self.other} more errors with other messages")
+        return lines
+
+
+class DistinctCounts:
+    """Distinct values and how often each occurs, added chunk by chunk."""
+    
+    def __init__(self):
+        self._counter = Counter()
+        self._values = None
+        self._counts = None
+        self._pending = []
+        self._pending_size = 0
+    
+    def add(self, values):
+        """Add a chunk of values (a list, or an array with NumPy)."""
+        if np is None:
+            self._counter.update(values)
+            return
+        if not len(values):
+            return
+        values, counts = np.unique(values, return_counts=True)
+        self._pending.append((values, counts))
+        self._pending_size += len(values)
+        # Merge once the pending values outgrow the merged ones, so every
+        # value is only re-sorted a logarithmic number of times
+        if self._pending_size > max(CHUNK_ROWS, 0 if self._values is None else len(self._values)):
+            self._merge()
+    
+    def _merge(self):
+        parts = self._pending
+        if self._values is not None:
+            parts = [(self._values, self._counts)] + parts
+        self._pending = []
+        self._pending_size = 0
+        if parts:
+            self._values, inverse = np.unique(np.concatenate([v for v, _ in parts]), return_inverse=True)
+            counts = np.concatenate([c for _, c in parts])
+            self._counts = np.bincount(inverse, weights=counts).astype(np.int64)
+    
+    def items(self):
+        """(sorted distinct values, their counts) as lists."""
+        if np is None:
+            values = sorted(self._counter)
+            return values, [self._counter[value] for value in values]
+        self._merge()
+        if self._values is None:
+            return [], []
+        return self._values.tolist(), self._counts.tolist()
+    
+    def __len__(self):
+        if np is None:
+            return len(self._counter)
+        self._merge()
+        return 0 if self._values is None else len(self._values)
+
+
+def _percentiles(values, counts):
+    """(name, value) of the min, SUMMARY_PERCENTILES and max (nearest rank)."""
+    cumulative = list(itertools.accumulate(counts))
+    total = cumulative[-1]
+    result = [('min', values[0])]
+    for p in SUMMARY_PERCENTILES:
+        rank = max(1, math.ceil(p * total / 100))
+        result.append((f"p{p}", values[bisect.bisect_left(cumulative, rank)]))
+    result.append(('max', values[-1]))
+    return result
+
+
+class TraceSummary:
+    """
+    Statistics of a trace, added chunk by chunk as fixed-point record
+    fields (see trace_format.py).
+    
+    Only distinct values are kept, so memory grows with the number of
+    distinct delays, rates, etc. rather than with the trace length.
+    """
+    
+    def __init__(self):
+        self.points = 0
+        self.changes = 0
+        self.unlimited = 0
+        self.first_time_ms = None
+        self.end_time_ms = None
+        self._last_state = None
+        self._values = {key: DistinctCounts() for key, _, _ in SUMMARY_FIELDS}
+        self._states = DistinctCounts()
+    
+    def add_records(self, records):
+        """Add a chunk of record field tuples (see trace_format.RECORD)."""
+        if not records:
+            return
+        if np is not None:
+            with np.errstate(invalid='ignore'):
+                self.add_array(np.array(records, dtype=np.float64).astype(np.int64))
+            return
+        
+        intervals, rates, states = [], [], []
+        for record in records:
+            time_ms, state = record[0], tuple(record[1:])
+            if self.end_time_ms is None:
+                self.first_time_ms = time_ms
+            else:
+                intervals.append(time_ms - self.end_time_ms)
+            self.end_time_ms = time_ms
+            if state[3]:
+                rates.append(state[3])
+            else:
+                self.unlimited += 1
+            if state != self._last_state:
+                states.append(state)
+                self._last_state = state
+        
+        columns = list(zip(*records))
+        self._values['interval_ms'].add(intervals)
+        for key, column in zip(RECORD_FIELDS[1:4], columns[1:4]):
+            self._values[key].add(column)
+        self._values['rate_kbps'].add(rates)
+        self._states.add(states)
+        self.changes += len(states)
+        self.points += len(records)
+    
+    def add_array(self, fields):
+        """Add a chunk of record fields as an (n, 5) int64 array (NumPy only)."""
+        times = fields[:, 0]
+        if self.end_time_ms is None:
+            self.first_time_ms = int(times[0])
+            intervals = np.diff(times)
+        else:
+            intervals = np.diff(times, prepend=self.end_time_ms)
+        self.end_time_ms = int(times[-1])
+        self._values['interval_ms'].add(intervals)
+        for key, column in zip(RECORD_FIELDS[1:4], fields[:, 1:4].T):
+            self._values[key].add(column)
+        rates = fields[:, 4]
+        limited = rates[rates != 0]
+        self._values['rate_kbps'].add(limited)
+        self.unlimited += len(rates) - len(limited)
+        
+        # Netem changes: points whose state differs from the previous point
+        states = fields[:, 1:]
+        changed = np.empty(len(states), dtype=bool)
+        changed[0] = self._last_state is None or not np.array_equal(states[0], self._last_state)
+        changed[1:] = np.any(states[1:] != states[:-1], axis=1)
+        self._last_state = states[-1].copy()
+        self.changes += int(changed.sum())
+        changes = np.ascontiguousarray(states[changed])
+        self._states.add(changes.view(np.dtype((np.void, changes.itemsize * 4))).ravel())
+        self.points += len(fields)
+    
+    def lines(self):
+        """Summary as printable lines."""
+        lines = [f"Points: {self.points} ({self.changes} netem changes, "
+                 f"{len(self._states)} distinct netem states)"]
+        if self.first_time_ms is None:
+            return lines
+        
+        lines.append(f"Duration: {(self.end_time_ms - self.first_time_ms) / 1000:.3f}s")
+        for key, label, scale in SUMMARY_FIELDS:
+            values, counts = self._values[key].items()
+            if values:
+                stats = ", ".join(
+                    f"{name} {value / scale:.3f}".rstrip('0').rstrip('.') for name, value in _percentiles(values, counts)
+                )
+            else:
+                stats = "none"
+            if key == 'rate_kbps' and self.unlimited:
+                stats += f" ({self.unlimited} points unlimited)"
+            lines.append(f"{label}: {stats}")
+        return lines
+
+
+def _value_problems(row):
+    """Errors of the values of a CSV row that are missing, not numeric or not finite."""
+    problems = []
+    for col in REQUIRED_COLUMNS + OPTIONAL_COLUMNS:
+        value = row.get(col)
+        if not value:
+            if col in REQUIRED_COLUMNS:
+                problems.append(f"Missing value in {col}")
+            continue
+        try:
+            number = int(value) if col == 'time_ms' else float(value)
+        except ValueError:
+            number = math.nan
+        if not math.isfinite(number):
+            problems.append(f"Invalid numeric value in {col}")
+    return problems
+
+
+def row_problems(row, prev_time):
+    """
+    Parse and validate one data row of a CSV trace.
+    
+    Args:
+        row: Row dict from csv.DictReader
+        prev_time: time_ms of the previous valid row (-1 for the first row)
+    
+    Returns:
+        (list of error messages, trace point, or None if a value is missing
+        or not numeric)
+    """
+    try:
+        point = parse_point(row)
+    except (TypeError, ValueError):
+        return _value_problems(row), None
+    
+    # One check for NaN and infinity in any value (a NaN or infinite sum)
+    if not math.isfinite(point['delay_ms'] + point['jitter_ms'] + point['loss_pct'] + (point['rate_mbps'] or 0)):
+        problems = _value_problems(row)
+        if problems:
+            return problems, None
+    
+    problems = []
+    if point['time_ms'] < prev_time:
+        problems.append(TIME_ERROR)
+    
+    if point['delay_ms'] < 0:
+        problems.append(DELAY_ERROR)
+    
+    if point['jitter_ms'] < 0:
+        problems.append(JITTER_ERROR)
+    
+    if point['loss_pct'] < 0 or point['loss_pct'] > 100:
+        problems.append(LOSS_ERROR)
+    
+    if point['rate_mbps'] is not None and point['rate_mbps'] <= 0:
+        problems.append(RATE_ERROR)
+    
+    return problems, point
+
+
+def check_row(i, row, prev_time):
+    """
+    Parse and validate one data row of a CSV trace.
+    
+    Args:
+        i: Line number of the row
+        row: Row dict from csv.DictReader
+        prev_time: time_ms of the previous valid row (-1 for the first row)
+    
+    Returns:
+        (list of errors, trace point, or None if a value is not numeric)
+    """
+    problems, point = row_problems(row, prev_time)
+    if problems:
+        problems = [f"Row {i}: {problem}" for problem in problems]
+    return problems, point
+
+
+def _converter(col, strict):
+    """
+    np.loadtxt converter of a column.
+    
+    Empty optional values become their parse_point defaults (jitter 0, rate
+    NaN for no limit). Invalid values (missing, not numeric, not finite)
+    raise ValueError if strict, else become -inf.
+    """
+    parse = int if col == 'time_ms' else float
+    empty = {'jitter_ms': 0.0, 'rate_mbps': math.nan}.get(col)
+    
+    def convert(text):
+        if not text and empty is not None:
+            return empty
+        try:
+            value = parse(text)
+        except ValueError:
+            value = math.nan
+        if not math.isfinite(value):
+            if strict:
+                raise ValueError(f"invalid {col} value {text!r}")
+            return -math.inf
+        return value
+    
+    return convert
+
+
+def _load_chunk(lines, fieldnames):
+    """
+    Parse a chunk of CSV lines into columns with np.loadtxt.
+    
+    Chunks of plain numbers are parsed by NumPy directly; others are parsed
+    again with converters that turn invalid values into -inf.
+    
+    Returns:
+        Dict of column name -> array
+    
+    Raises:
+        ValueError: If the lines do not split into the header's columns
+    """
+    columns = [col for col in REQUIRED_COLUMNS + OPTIONAL_COLUMNS if col in fieldnames]
+    usecols = [fieldnames.index(col) for col in columns]
+    try:
+        data = np.loadtxt(
+            lines, delimiter=',', comments=None, ndmin=1, usecols=usecols,
+            dtype=[(col, '<i8' if col == 'time_ms' else '<f8') for col in columns],
+            converters={index: _converter(col, True) for col, index in zip(columns, usecols) if col in OPTIONAL_COLUMNS}
+        )
+        if np.isfinite(data['delay_ms']).all() and np.isfinite(data['loss_pct']).all():
+            return {col: data[col] for col in columns}
+    except ValueError:
+        pass
+    
+    data = np.loadtxt(
+        lines, delimiter=',', comments=None, ndmin=2, usecols=usecols,
+        converters={index: _converter(col, False) for col, index in zip(columns, usecols)}
+    )
+    return {col: data[:, i] for i, col in enumerate(columns)}
+
+
+def _check_rows(lines, fieldnames, first_line, prev_time, report, summary):
+    """
+    Check a chunk of CSV lines row by row.
+    
+    Returns:
+        (time_ms of the last valid row, number of rows)
+    """
+    reader = csv.DictReader(lines, fieldnames=fieldnames)
+    records = []
+    rows = 0
+    for row in reader:
+        problems, point = row_problems(row, prev_time)
+        for problem in problems:
+            report.add(problem, [first_line + reader.line_num - 1])
+        if point is not None:
+            prev_time = point['time_ms']
+            records.append(encode_point(point))
+        rows += 1
+    
+    summary.add_records(records)
+    return prev_time, rows
+
+
+def _check_chunk(lines, fieldnames, first_line, prev_time, report, summary):
+    """
+    Check a chunk of CSV lines with array operations (NumPy only).
+    
+    Rows with invalid values are reported and left out, as _check_rows
+    does; chunks with blank or malformed lines are left to _check_rows.
+    
+    Returns:
+        (time_ms of the last valid row, number of rows)
+    """
+    try:
+        columns = _load_chunk(lines, fieldnames)
+    except ValueError:
+        return _check_rows(lines, fieldnames, first_line, prev_time, report, summary)
+    if len(columns['time_ms']) != len(lines):
+        # Blank lines were skipped
+        return _check_rows(lines, fieldnames, first_line, prev_time, report, summary)
+    
+    invalid = np.zeros(len(lines), dtype=bool)
+    for values in columns.values():
+        invalid |= values == -np.inf
+    line_numbers = first_line + np.arange(len(lines))
+    if invalid.any():
+        problems = {}
+        for index in np.flatnonzero(invalid):
+            problems[index] = _value_problems(next(csv.DictReader([lines[index]], fieldnames=fieldnames)))
+            if not problems[index]:
+                # Valid to the csv module (e.g. quoted values)
+                return _check_rows(lines, fieldnames, first_line, prev_time, report, summary)
+        for index, row_problems in problems.items():
+            for problem in row_problems:
+                report.add(problem, [first_line + index])
+        columns = {col: values[~invalid] for col, values in columns.items()}
+        line_numbers = line_numbers[~invalid]
+        if not len(line_numbers):
+            return prev_time, len(lines)
+    
+    times = columns['time_ms'].astype(np.int64)
+    delay = columns['delay_ms']
+    loss = columns['loss_pct']
+    jitter = columns.get('jitter_ms', np.zeros(len(times)))
+    rate = columns.get('rate_mbps', np.full(len(times), np.nan))
+    previous = np.concatenate(([prev_time], times[:-1]))
+    
+    report.add(TIME_ERROR, line_numbers[times < previous])
+    report.add(DELAY_ERROR, line_numbers[delay < 0])
+    report.add(JITTER_ERROR, line_numbers[jitter < 0])
+    report.add(LOSS_ERROR, line_numbers[(loss < 0) | (loss > 100)])
+    report.add(RATE_ERROR, line_numbers[rate <= 0])
+    
+    # Fixed-point record fields, as encode_point computes them
+    with np.errstate(invalid='ignore'):
+        rate_kbps = np.where(rate > 0, np.maximum(np.rint(rate * 1000), 1), 0)
+        fields = np.column_stack([
+            times, np.rint(delay * 1000), np.rint(jitter * 1000), np.rint(loss * 10000), rate_kbps
+        ]).astype(np.int64)
+    summary.add_array(fields)
+    
+    return int(times[-1]), len(lines)
+
+
+def _check_count(rows, report):
+    """Empty trace error, or warnings about short traces."""
+    if rows == 0:
+        report.add("Trace file is empty")
+    elif rows < 2:
+        return ["Trace file has fewer than 2 data points"]
+    return []
+
+
+def validate_csv_trace(trace_file, report, summary):
+    """
+    Validate a CSV trace, CHUNK_ROWS rows at a time.
+    
+    Args:
+        trace_file: Path to the CSV trace
+        report: ErrorReport receiving the errors
+        summary: TraceSummary receiving the valid rows
+    
+    Returns:
+        List of warnings
+    """
+    with open(trace_file, 'r', newline='') as f:
+        fieldnames = next(csv.reader([f.readline()]), None)
+        if not fieldnames:
+            report.add("Trace file is empty")
+            return []
+        
+        # Check required columns
+        for col in REQUIRED_COLUMNS:
+            if col not in fieldnames:
+                report.add(f"Missing required column: {col}")
+        
+        if report:
+            return []
+        
+        # Validate data
+        check_chunk = _check_rows if np is None else _check_chunk
+        prev_time = -1
+        rows = 0
+        line = 2
+        while True:
+            lines = list(itertools.islice(f, CHUNK_ROWS))
+            if not lines:
+                break
+            prev_time, chunk_rows = check_chunk(lines, fieldnames, line, prev_time, report, summary)
+            rows += chunk_rows
+            line += len(lines)
+    
+    return _check_count(rows, report)
+
+
+def validate_compiled_trace(trace_file, report, summary):
+    """
+    Validate a compiled trace, streaming through its memory-mapped points.
+    
+    Args:
+        trace_file: Path to the compiled trace
+        report: ErrorReport receiving the errors
+        summary: TraceSummary receiving the points
+    
+    Returns:
+        List of warnings
+    """
+    with CompiledTrace(trace_file) as trace:
+        prev_time = -1
+        index = 0
+        for chunk in trace.iter_chunks():
+            if np is not None:
+                records = np.frombuffer(chunk, dtype=RECORD_DTYPE)
+                times = records['time_ms']
+                previous = np.concatenate(([prev_time], times[:-1]))
+                report.add(TIME_ERROR, index + np.flatnonzero(times < previous))
+                report.add(LOSS_ERROR, index + np.flatnonzero(records['loss_ppm'] > 1000000))
+                summary.add_array(np.column_stack([records[name].astype(np.int64) for name in RECORD_FIELDS]))
+                prev_time = int(times[-1])
+            else:
+                records = list(RECORD.iter_unpack(chunk))
+                for i, (time_ms, _, _, loss_ppm, _) in enumerate(records, start=index):
                     if time_ms < prev_time:
-                        errors.append(f"Row {i}: time_ms must be monotonically increasing")
-                    
-                    if delay_ms < 0:
-                        errors.append(f"Row {i}: delay_ms must be >= 0")
-                    
-                    if loss_pct < 0 or loss_pct > 100:
-                        errors.append(f"Row {i}: loss_pct must be between 0 and 100")
-                    
-                    if 'rate_mbps' in row and row['rate_mbps']:
-                        rate_mbps = float(row['rate_mbps'])
-                        if rate_mbps <= 0:
-                            errors.append(f"Row {i}: rate_mbps must be > 0")
-                    
+                        report.add(TIME_ERROR, [i])
+                    if loss_ppm > 1000000:
+                        report.add(LOSS_ERROR, [i])
                     prev_time = time_ms
-                    
-                except ValueError as e:
-                    errors.append(f"Row {i}: Invalid numeric value - {e}")
-            
-            if len(rows) < 2:
-                warnings.append("Trace file has fewer than 2 data points")
-            
+                summary.add_records(records)
+            index += len(records)
+        
+        if len(trace):
+            # Collapsed points end before the last CSV row
+            summary.end_time_ms = trace.end_time_ms
+        
+        return _check_count(len(trace), report)
+
+
+def validate_trace(trace_file):
+    """
+    Validate and summarize a trace file (CSV or compiled).
+    
+    Returns:
+        (ErrorReport, list of warnings, TraceSummary)
+    """
+    report = ErrorReport()
+    summary = TraceSummary()
+    warnings = []
+    try:
+        if is_compiled_trace(trace_file):
+            report.label = "Point"
+            warnings = validate_compiled_trace(trace_file, report, summary)
+        else:
+            warnings = validate_csv_trace(trace_file, report, summary)
     except FileNotFoundError:
-        errors.append(f"File not found: {trace_file}")
+        report.add(f"File not found: {trace_file}")
+    except TraceFormatError as e:
+        report.add(f"Invalid compiled trace: {e}")
     except Exception as e:
-        errors.append(f"Error reading file: {e}")
+        report.add(f"Error reading file: {e}")
     
-    return errors, warnings
+    return report, warnings, summary
+
+
+def validate_trace_file(trace_file):
+    """Validate trace file format (CSV or compiled); returns (errors, warnings)."""
+    report, warnings, _ = validate_trace(trace_file)
+    return report.messages(), warnings
 
 
 def main():
     parser = argparse.ArgumentParser(description="Validate network trace file")
-    parser.add_argument("trace_file", help="Path to CSV trace file")
+    parser.add_argument("trace_file", help="Path to CSV or compiled trace file")
+    parser.add_argument("--no-summary", action="store_true", help="Do not print the trace summary")
     
     args = parser.parse_args()
     
-    errors, warnings = validate_trace_file(args.trace_file)
+    start = time.perf_counter()
+    report, warnings, summary = validate_trace(args.trace_file)
+    summary_lines = summary.lines() if summary.points else []
+    elapsed = time.perf_counter() - start
     
     if warnings:
         for w in warnings:
             print(f"WARNING: {w}", file=sys.stderr)
     
-    if errors:
-        print("Validation FAILED:", file=sys.stderr)
-        for e in errors:
+    if summary_lines and not args.no_summary:
+        print(f"Trace summary (checked in {elapsed:.2f}s):")
+        for line in summary_lines:
+            print(f"  {line}")
+    
+    if report:
+        print(f"Validation FAILED ({report.total} errors):", file=sys.stderr)
+        for e in report.messages():
             print(f"  ERROR: {e}", file=sys.stderr)
         sys.exit(1)
     else:
@@ -93,4 +686,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
@@ -11,32 +11,380 @@ let experimentId = window.EXPERIMENT_ID || 'default_experiment';
 let lastBufferLevel = 0;
 let lastBitrate = 0;
 let rebufferCount = 0;
+let stallStartedAt = null;
 let lastPlaybackState = 'unknown';
 
+// Metric batching: events are buffered and flushed to /api/submit_batch
+// when the buffer reaches METRIC_BATCH_SIZE events, every
+// METRIC_FLUSH_INTERVAL_MS milliseconds, and when the page is hidden/unloaded.
+const METRIC_BATCH_SIZE = window.METRIC_BATCH_SIZE || 50;
+const METRIC_FLUSH_INTERVAL_MS = window.METRIC_FLUSH_INTERVAL_MS || 1000;
+// Batch encoding: 'json', or 'msgpack' if the @msgpack/msgpack library
+// (global MessagePack) is loaded. Batches are gzip-compressed when the
+// browser supports CompressionStream, unless METRIC_COMPRESSION is false.
+const METRIC_ENCODING = window.METRIC_ENCODING || 'json';
+const METRIC_COMPRESSION = window.METRIC_COMPRESSION !== false;
+// Failed flushes are retried with exponential backoff (or after the
+// server's Retry-After). Events wait in the buffer meanwhile, up to
+// METRIC_MAX_BUFFERED events; beyond that the oldest are dropped.
+const METRIC_MAX_BUFFERED = window.METRIC_MAX_BUFFERED || 5000;
+const METRIC_RETRY_BASE_MS = 500;
+const METRIC_RETRY_MAX_MS = 30000;
+let metricBuffer = [];
+let metricFlushTimer = null;
+let metricInFlight = false;
+let metricRetryDelayMs = 0;
+
+// Every event carries the session ID and a sequence number that increases
+// by one per event, so the stats server can drop duplicates of retried
+// batches
+const sessionId = window.SESSION_ID || newSessionId();
+let metricSeq = 0;
+
+// Coalescing rules per event type, fetched from the stats server's
+// /api/client_policy at player start (or set as window.METRIC_POLICY).
+// Events of a type with a rule are merged per media type into at most one
+// event per min_interval_ms; see coalesceMetric.
+let metricPolicy = window.METRIC_POLICY || null;
+const coalesceWindows = {};
+
+/**
+ * Fetch the coalescing rules for this experiment (once per page).
+ *
+ * Until they arrive, and if the request fails, every event is sent as-is.
+ */
+function loadMetricPolicy() {
+    if (metricPolicy !== null) {
+        return;
+    }
+    metricPolicy = {};
+    const url = `${statsServerUrl}/api/client_policy?experiment_id=${encodeURIComponent(experimentId)}`;
+    fetch(url).then(response => {
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        return response.json();
+    }).then(policy => {
+        metricPolicy = policy.rules || {};
+        logEvent(`Metric policy: ${Object.keys(metricPolicy).length} coalesced event types`);
+    }).catch(error => {
+        console.warn('Failed to load metric policy, sending every event:', error);
+    });
+}
+
+/**
+ * Random session identifier
+ */
+function newSessionId() {
+    if (window.crypto && typeof window.crypto.randomUUID === 'function') {
+        return window.crypto.randomUUID();
+    }
+    // randomUUID needs a secure context (HTTPS or localhost)
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+}
+
 /**
  * Send metric event to stats server
+ *
+ * Events of types with a coalescing rule are merged first (see
+ * coalesceMetric); all others are buffered for the next batch.
  */
 function sendMetric(eventType, payload) {
+    const rule = metricPolicy && metricPolicy[eventType];
+    if (rule) {
+        coalesceMetric(eventType, payload, rule);
+    } else {
+        queueMetric(eventType, payload, Date.now());
+    }
+}
+
+/**
+ * Coalesce a high-frequency event.
+ *
+ * Samples are collected per event type and media type. An event is sent for
+ * the first sample, when min_interval_ms has passed since the last sent
+ * event, or early when a min_delta field moved at least that much since the
+ * last sent event; a timer sends the last window if no further sample
+ * arrives. The sent payload is the last sample's, with <field>_min and
+ * <field>_max for summarize fields, window totals for sum fields, and the
+ * number of merged samples in coalesced_count.
+ */
+function coalesceMetric(eventType, payload, rule) {
+    const now = Date.now();
+    const key = eventType + ':' + (payload.media_type || '');
+    let state = coalesceWindows[key];
+    if (!state) {
+        state = coalesceWindows[key] = {
+            eventType: eventType, lastSent: null, lastSentAt: 0, window: null, timer: null
+        };
+    }
+
+    let pending = state.window;
+    if (pending === null) {
+        pending = state.window = { count: 0, last: null, lastAt: 0, min: {}, max: {}, sum: {} };
+    }
+    pending.count++;
+    pending.last = payload;
+    pending.lastAt = now;
+    (rule.summarize || []).forEach(field => {
+        const value = payload[field];
+        if (typeof value === 'number') {
+            pending.min[field] = field in pending.min ? Math.min(pending.min[field], value) : value;
+            pending.max[field] = field in pending.max ? Math.max(pending.max[field], value) : value;
+        }
+    });
+    (rule.sum || []).forEach(field => {
+        if (typeof payload[field] === 'number') {
+            pending.sum[field] = (pending.sum[field] || 0) + payload[field];
+        }
+    });
+
+    const interval = rule.min_interval_ms || 0;
+    const minDelta = rule.min_delta || {};
+    const moved = state.lastSent !== null && Object.keys(minDelta).some(field =>
+        typeof payload[field] === 'number' && typeof state.lastSent[field] === 'number' &&
+        Math.abs(payload[field] - state.lastSent[field]) >= minDelta[field]
+    );
+    if (state.lastSent === null || moved || now - state.lastSentAt >= interval) {
+        emitCoalesced(state);
+    } else if (state.timer === null) {
+        state.timer = setTimeout(() => emitCoalesced(state), interval - (now - state.lastSentAt));
+    }
+}
+
+/**
+ * Queue the pending window of a coalesced event type as one event.
+ */
+function emitCoalesced(state) {
+    if (state.timer !== null) {
+        clearTimeout(state.timer);
+        state.timer = null;
+    }
+    const pending = state.window;
+    if (pending === null) {
+        return;
+    }
+    state.window = null;
+
+    const payload = Object.assign({}, pending.last);
+    Object.keys(pending.min).forEach(field => {
+        payload[field + '_min'] = pending.min[field];
+        payload[field + '_max'] = pending.max[field];
+    });
+    Object.assign(payload, pending.sum);
+    payload.coalesced_count = pending.count;
+
+    state.lastSent = pending.last;
+    state.lastSentAt = pending.lastAt;
+    queueMetric(state.eventType, payload, pending.lastAt);
+}
+
+/**
+ * Queue the pending windows of all coalesced event types.
+ */
+function flushCoalescedMetrics() {
+    Object.keys(coalesceWindows).forEach(key => emitCoalesced(coalesceWindows[key]));
+}
+
+/**
+ * Buffer an event for the next batch
+ *
+ * Session constants (experiment, protocol, video) are not repeated per
+ * event; they are sent once per batch as "common" fields.
+ *
+ * @param {number} timeMs - Event time (milliseconds since the epoch)
+ */
+function queueMetric(eventType, payload, timeMs) {
     const metric = {
-        experiment_id: experimentId,
-        timestamp: Date.now() / 1000.0,  // Unix timestamp in seconds
+        timestamp: timeMs / 1000.0,  // Unix timestamp in seconds
+        seq: metricSeq++,
         event_type: eventType,
-        protocol: 'dash',
-        video_id: window.currentMpdUrl || 'unknown',
         payload: payload
     };
 
-    fetch(`${statsServerUrl}/api/submit`, {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
+    metricBuffer.push(metric);
+    if (metricBuffer.length > METRIC_MAX_BUFFERED) {
+        metricBuffer.shift();
+    }
+
+    // While a retry is pending, events wait for its timer
+    if (metricRetryDelayMs > 0) {
+        return;
+    }
+    if (metricBuffer.length >= METRIC_BATCH_SIZE) {
+        flushMetrics();
+    } else if (metricFlushTimer === null) {
+        metricFlushTimer = setTimeout(flushMetrics, METRIC_FLUSH_INTERVAL_MS);
+    }
+}
+
+/**
+ * Encode a batch of events as a request body.
+ *
+ * @param {Array} events - Buffered events
+ * @param {boolean} compress - gzip the body if the browser supports it
+ * @returns {Promise<{body: (string|Uint8Array|ArrayBuffer), headers: Object}>}
+ */
+async function encodeMetricBatch(events, compress) {
+    const batch = {
+        common: {
+            experiment_id: experimentId,
+            protocol: 'dash',
+            video_id: window.currentMpdUrl || 'unknown',
+            session_id: sessionId
         },
-        body: JSON.stringify(metric)
-    }).catch(error => {
-        console.error('Failed to send metric:', error);
+        events: events
+    };
+
+    let body;
+    const headers = {};
+    if (METRIC_ENCODING === 'msgpack' && window.MessagePack) {
+        body = window.MessagePack.encode(batch);
+        headers['Content-Type'] = 'application/msgpack';
+    } else {
+        body = JSON.stringify(batch);
+        headers['Content-Type'] = 'application/json';
+    }
+
+    if (compress && METRIC_COMPRESSION && typeof CompressionStream !== 'undefined') {
+        const stream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+        body = await new Response(stream).arrayBuffer();
+        headers['Content-Encoding'] = 'gzip';
+    }
+
+    return { body: body, headers: headers };
+}
+
+/**
+ * POST a batch of events to /api/submit_batch.
+ *
+ * @param {Array} events - Events to send
+ * @param {boolean} unloading - Send uncompressed with a keepalive request
+ * @returns {Promise<Response>} Rejects on network errors and non-2xx
+ *     responses; the error's retryable and retryAfterMs fields tell whether
+ *     and when to send the batch again
+ */
+async function postMetricBatch(events, unloading) {
+    // Compression is asynchronous, which an unloading page cannot wait for
+    const encoded = await encodeMetricBatch(events, !unloading);
+    const response = await fetch(`${statsServerUrl}/api/submit_batch`, {
+        method: 'POST',
+        headers: encoded.headers,
+        body: encoded.body,
+        keepalive: unloading
+    });
+    if (!response.ok) {
+        const error = new Error(`HTTP ${response.status}`);
+        // Other 4xx responses reject the batch itself; resending cannot help
+        error.retryable = response.status >= 500 || response.status === 408 || response.status === 429;
+        const retryAfter = parseFloat(response.headers.get('Retry-After'));
+        if (!isNaN(retryAfter)) {
+            error.retryAfterMs = retryAfter * 1000;
+        }
+        throw error;
+    }
+    return response;
+}
+
+/**
+ * Flush buffered metric events to the stats server.
+ *
+ * One batch of up to METRIC_BATCH_SIZE events is in flight at a time;
+ * a failed batch goes back to the front of the buffer and is retried with
+ * exponential backoff. Resent events keep their seq, so the server drops
+ * any that were stored before the failure.
+ *
+ * @param {boolean} unloading - Send everything now with keepalive requests
+ *     (uncompressed, not retried) so the flush survives page unload
+ */
+function flushMetrics(unloading = false) {
+    if (metricFlushTimer !== null) {
+        clearTimeout(metricFlushTimer);
+        metricFlushTimer = null;
+    }
+
+    if (metricBuffer.length === 0) {
+        return;
+    }
+
+    if (unloading) {
+        while (metricBuffer.length > 0) {
+            const events = metricBuffer.splice(0, METRIC_BATCH_SIZE);
+            postMetricBatch(events, true).catch(error => {
+                console.error(`Failed to send ${events.length} metrics:`, error);
+            });
+        }
+        return;
+    }
+
+    // The in-flight request flushes the rest when it completes
+    if (metricInFlight) {
+        return;
+    }
+
+    const events = metricBuffer.splice(0, METRIC_BATCH_SIZE);
+    const videoId = window.currentMpdUrl || 'unknown';
+    metricInFlight = true;
+    postMetricBatch(events, false).then(() => {
+        metricInFlight = false;
+        metricRetryDelayMs = 0;
+        if (metricBuffer.length >= METRIC_BATCH_SIZE) {
+            flushMetrics();
+        } else if (metricBuffer.length > 0 && metricFlushTimer === null) {
+            metricFlushTimer = setTimeout(flushMetrics, METRIC_FLUSH_INTERVAL_MS);
+        }
+    }, error => {
+        metricInFlight = false;
+        if (error.retryable === false) {
+            console.error(`Dropping ${events.length} metrics rejected by the server:`, error);
+            metricRetryDelayMs = 0;
+            if (metricBuffer.length > 0 && metricFlushTimer === null) {
+                metricFlushTimer = setTimeout(flushMetrics, METRIC_FLUSH_INTERVAL_MS);
+            }
+            return;
+        }
+
+        // The player may have moved on to another video by the retry
+        events.forEach(event => {
+            if (event.video_id === undefined) {
+                event.video_id = videoId;
+            }
+        });
+        metricBuffer = events.concat(metricBuffer);
+        if (metricBuffer.length > METRIC_MAX_BUFFERED) {
+            const dropped = metricBuffer.length - METRIC_MAX_BUFFERED;
+            metricBuffer = metricBuffer.slice(dropped);
+            console.warn(`Metric buffer full, dropped ${dropped} oldest metrics`);
+        }
+
+        metricRetryDelayMs = Math.min(
+            METRIC_RETRY_MAX_MS, Math.max(METRIC_RETRY_BASE_MS, metricRetryDelayMs * 2)
+        );
+        // Jitter spreads the retries of players that failed together
+        let delay = metricRetryDelayMs * (0.5 + Math.random() / 2);
+        if (error.retryAfterMs !== undefined) {
+            delay = Math.max(delay, error.retryAfterMs);
+        }
+        console.warn(`Failed to send ${events.length} metrics, retrying in ${(delay / 1000).toFixed(1)}s:`, error);
+        if (metricFlushTimer !== null) {
+            clearTimeout(metricFlushTimer);
+        }
+        metricFlushTimer = setTimeout(flushMetrics, delay);
     });
 }
 
+// Flush remaining metrics when the page is hidden or unloaded
+window.addEventListener('pagehide', function() {
+    flushCoalescedMetrics();
+    flushMetrics(true);
+});
+document.addEventListener('visibilitychange', function() {
+    if (document.visibilityState === 'hidden') {
+        flushCoalescedMetrics();
+        flushMetrics(true);
+    }
+});
+
 /**
  * Initialize DASH player
  */
@@ -45,6 +393,10 @@ function initializeDashPlayer(mpdUrl) {
         dashPlayer.destroy();
     }
 
+    // Buffered events belong to the previous video
+    flushCoalescedMetrics();
+    flushMetrics();
+    loadMetricPolicy();
     window.currentMpdUrl = mpdUrl;
     const video = document.getElementById('videoPlayer');
     
@@ -75,6 +427,11 @@ function initializeDashPlayer(mpdUrl) {
         if (e && e.request) {
             const request = e.request;
             const quality = dashPlayer.getQualityFor('video');
+            // Size and download time give the server the segment throughput
+            let downloadMs = null;
+            if (request.requestStartDate && request.requestEndDate) {
+                downloadMs = request.requestEndDate.getTime() - request.requestStartDate.getTime();
+            }
             
             sendMetric('fragment_loading_completed', {
                 type: request.type,
@@ -82,7 +439,9 @@ function initializeDashPlayer(mpdUrl) {
                 quality: quality,
                 media_type: request.mediaType,
                 start_time: request.startTime,
-                duration: request.duration
+                duration: request.duration,
+                bytes_loaded: request.bytesLoaded,
+                download_ms: downloadMs
             });
         }
     });
@@ -165,6 +524,9 @@ function initializeDashPlayer(mpdUrl) {
 
     // Rebuffer events (stall detection)
     dashPlayer.on(dashjs.MediaPlayer.events.PLAYBACK_STALLED, function() {
+        if (stallStartedAt === null) {
+            stallStartedAt = Date.now();
+        }
         rebufferCount++;
         logEvent(`Rebuffer detected (#${rebufferCount})`);
         
@@ -175,6 +537,20 @@ function initializeDashPlayer(mpdUrl) {
         });
     });
 
+    // End of a stall: playback resumed
+    dashPlayer.on(dashjs.MediaPlayer.events.PLAYBACK_PLAYING, function() {
+        if (stallStartedAt !== null) {
+            const stallDuration = (Date.now() - stallStartedAt) / 1000.0;
+            stallStartedAt = null;
+            logEvent(`Rebuffer ended after ${stallDuration.toFixed(2)}s`);
+            
+            sendMetric('rebuffer_ended', {
+                stall_duration_s: stallDuration,
+                buffer_level: lastBufferLevel
+            });
+        }
+    });
+
     dashPlayer.on(dashjs.MediaPlayer.events.PLAYBACK_STARTED, function() {
         updateStatus('Playing');
         logEvent('Playback started');
@@ -191,6 +567,8 @@ function initializeDashPlayer(mpdUrl) {
         sendMetric('playback_ended', {
             total_rebuffers: rebufferCount
         });
+        flushCoalescedMetrics();
+        flushMetrics();
     });
 
     // Periodic metrics collection
@@ -231,4 +609,5 @@ function updateMetric(id, value) {
 
 // Export for use in HTML
 window.initializeDashPlayer = initializeDashPlayer;
+window.flushMetrics = flushMetrics;
 
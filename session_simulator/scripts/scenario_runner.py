@@ -3,7 +3,7 @@
 Scenario Runner - Executes streaming session scenarios.
 
 Reads a scenario YAML file and orchestrates:
-1. Network profile application
+1. Network profile application (trace profiles are validated first)
 2. Media server startup
 3. Client instructions
 4. Metrics collection
@@ -15,11 +15,21 @@ import yaml
 import json
 import argparse
 import subprocess
+import shutil
+import tempfile
 import time
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
 from pathlib import Path
 from datetime import datetime
 
 
+# Bytes copied per read when downloading metric exports
+EXPORT_CHUNK_SIZE = 1024 * 1024
+
+
 def load_scenario(scenario_file):
     """Load and validate scenario YAML file."""
     try:
@@ -47,6 +57,35 @@ def validate_scenario(scenario):
         print(f"WARNING: Protocol {scenario['protocol']} may not be fully implemented")
 
 
+def preflight_trace(container_path, traffic_shaper_container):
+    """
+    Validate a trace inside the traffic shaper before it is replayed.
+    
+    Prints the validator's trace summary and exits if the trace is
+    invalid, so no session runs against a broken trace.
+    
+    Args:
+        container_path: Path of the trace in the traffic shaper container
+        traffic_shaper_container: Name of traffic shaper container
+    """
+    cmd = [
+        'docker', 'exec', traffic_shaper_container,
+        'python3', '/app/scripts/validate_trace.py',
+        container_path
+    ]
+    
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.stdout:
+        print(result.stdout, end='')
+    # Errors, and warnings of a trace that passed, are on stderr
+    if result.stderr:
+        print(result.stderr, end='', file=sys.stderr)
+    if result.returncode != 0:
+        print(f"ERROR: Trace preflight failed for {container_path}")
+        sys.exit(1)
+    print("✓ Trace preflight passed")
+
+
 def apply_network_profile(network_profile, traffic_shaper_container):
     """
     Apply network profile to traffic shaper container.
@@ -98,6 +137,8 @@ def apply_network_profile(network_profile, traffic_shaper_container):
             container_path
         ]
     elif profile_type == 'trace':
+        preflight_trace(container_path, traffic_shaper_container)
+        
         # Start trace replay in background
         cmd = [
             'docker', 'exec', '-d', traffic_shaper_container,
@@ -136,72 +177,54 @@ def create_result_directory(scenario, base_results_dir):
     
     # Copy scenario file to results
     scenario_copy = os.path.join(result_dir, 'scenario.yaml')
-    import shutil
     shutil.copy(scenario['_source_file'], scenario_copy)
     
     return result_dir, run_id
 
 
-def export_metrics(experiment_id, stats_server_container, result_dir):
+def export_metrics(experiment_id, stats_server_url, result_dir, export_format="json"):
     """
-    Export metrics from MongoDB to JSON file.
+    Export metrics for an experiment into the result directory.
+    
+    The stats server streams the export from its database cursor over HTTP
+    and it is written straight to result_dir/stats/ in one pass. The file is
+    written under a unique temporary name and renamed when complete, so
+    concurrent exports never clobber each other and a failed export never
+    leaves a truncated metrics file behind.
     
     Args:
         experiment_id: Experiment identifier
-        stats_server_container: Name of stats server container
+        stats_server_url: Base URL of the stats server
         result_dir: Result directory path
+        export_format: Export format (json, ndjson, ndjson.gz, ndjson.zst, parquet)
     """
-    print(f"Exporting metrics for experiment: {experiment_id}")
+    print(f"Exporting metrics for experiment: {experiment_id} ({export_format})")
     
-    # Use Python script inside stats_server container to export
-    export_script = f"""
-from storage import MetricsStorage
-import json
-import sys
-
-storage = MetricsStorage()
-metrics = storage.get_metrics('{experiment_id}')
-
-# Convert ObjectId to string
-for metric in metrics:
-    if '_id' in metric:
-        metric['_id'] = str(metric['_id'])
-
-output_file = '/tmp/metrics_export.json'
-with open(output_file, 'w') as f:
-    json.dump(metrics, f, indent=2, default=str)
-
-print(f'Exported {{len(metrics)}} metrics to {{output_file}}')
-"""
-    
-    # Write script to temp file
-    script_file = '/tmp/export_metrics.py'
-    with open(script_file, 'w') as f:
-        f.write(export_script)
+    stats_dir = os.path.join(result_dir, 'stats')
+    output_file = os.path.join(stats_dir, f"metrics.{export_format}")
+    url = (
+        f"{stats_server_url}/api/export/{urllib.parse.quote(experiment_id, safe='')}"
+        f"?format={urllib.parse.quote(export_format)}"
+    )
     
-    # Copy script to container and execute
+    tmp_fd, tmp_file = tempfile.mkstemp(dir=stats_dir, prefix='.metrics-', suffix='.part')
     try:
-        subprocess.run([
-            'docker', 'cp', script_file, f'{stats_server_container}:/tmp/export_metrics.py'
-        ], check=True)
-        
-        result = subprocess.run([
-            'docker', 'exec', stats_server_container,
-            'python3', '/tmp/export_metrics.py'
-        ], capture_output=True, text=True, check=True)
-        
-        # Copy exported file back
-        subprocess.run([
-            'docker', 'cp', f'{stats_server_container}:/tmp/metrics_export.json',
-            os.path.join(result_dir, 'stats', 'metrics.json')
-        ], check=True)
-        
-        print(f"✓ Metrics exported to {result_dir}/stats/metrics.json")
-        print(result.stdout)
-        
-    except subprocess.CalledProcessError as e:
+        with os.fdopen(tmp_fd, 'wb') as f, urllib.request.urlopen(url, timeout=60) as response:
+            shutil.copyfileobj(response, f, EXPORT_CHUNK_SIZE)
+            size = f.tell()
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, output_file)
+        print(f"✓ Metrics exported to {output_file} ({size} bytes)")
+    
+    except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        detail = ''
+        if isinstance(e, urllib.error.HTTPError):
+            detail = e.read().decode(errors='replace')
         print(f"WARNING: Failed to export metrics: {e}")
-        print(e.stderr)
+        if detail:
+            print(detail)
 
 
 def main():
@@ -213,15 +236,22 @@ def main():
                        default="../../experiments/results")
     parser.add_argument("--traffic-shaper", help="Traffic shaper container name",
                        default="traffic_shaper")
-    parser.add_argument("--stats-server", help="Stats server container name",
-                       default="stats_server")
+    parser.add_argument("--stats-server", help="Deprecated and ignored: metrics are now "
+                       "downloaded from --server-ip:--stats-port")
     parser.add_argument("--skip-network", action="store_true",
                        help="Skip network profile application")
     parser.add_argument("--skip-export", action="store_true",
                        help="Skip metrics export")
+    parser.add_argument("--export-format", default="json",
+                       choices=["json", "ndjson", "ndjson.gz", "ndjson.zst", "parquet"],
+                       help="Metrics export format (default: json)")
     
     args = parser.parse_args()
     
+    if args.stats_server:
+        print("WARNING: --stats-server is deprecated and ignored; metrics are "
+              "exported over HTTP from --server-ip:--stats-port")
+    
     # Load scenario
     scenario = load_scenario(args.scenario_file)
     scenario['_source_file'] = args.scenario_file  # Store source for copying
@@ -269,7 +299,7 @@ def main():
     
     # Export metrics
     if not args.skip_export:
-        export_metrics(scenario['id'], args.stats_server, result_dir)
+        export_metrics(scenario['id'], stats_server_url, result_dir, args.export_format)
     else:
         print("Skipping metrics export")
     